@@ -1,14 +1,18 @@
 from django.contrib import admin
-from .models import PatientProfile, UrineAnalysis, SerumLabs, OxalateContent, ManagementPlan
+from .models import (
+    PatientProfile, UrineAnalysis, SerumLabs, OxalateContent, ManagementPlan, QuantileSketch,
+    FoodDiaryEntry, OxalateIntakeRollup, UrineTrend,
+)
 
 
 @admin.register(PatientProfile)
 class PatientProfileAdmin(admin.ModelAdmin):
     list_display = ['id', 'age', 'gender',
-                    'num_prior_stones', 'bmi', 'created_at']
+                    'num_prior_stones', 'bmi', 'recurrence_risk_5y', 'created_at']
     list_filter = ['gender', 'family_history', 'created_at']
     search_fields = ['id', 'age', 'gender']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['created_at', 'updated_at',
+                       'recurrence_risk_5y', 'recurrence_risk_10y', 'recurrence_version']
 
     fieldsets = (
         ('Basic Information', {
@@ -20,6 +24,9 @@ class PatientProfileAdmin(admin.ModelAdmin):
         ('Dietary Information', {
             'fields': ('fluid_intake_L',)
         }),
+        ('Recurrence Risk', {
+            'fields': ('recurrence_risk_5y', 'recurrence_risk_10y', 'recurrence_version')
+        }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
@@ -100,20 +107,51 @@ class OxalateContentAdmin(admin.ModelAdmin):
 
 @admin.register(ManagementPlan)
 class ManagementPlanAdmin(admin.ModelAdmin):
-    list_display = ['id', 'patient_profile', 'stone_type', 'created_at']
-    list_filter = ['stone_type', 'created_at']
+    list_display = ['id', 'patient_profile', 'stone_type', 'rule_version', 'created_at']
+    list_filter = ['stone_type', 'rule_version', 'created_at']
     search_fields = ['patient_profile__id', 'stone_type']
-    readonly_fields = ['created_at']
+    readonly_fields = ['created_at', 'rule_version']
 
     fieldsets = (
         ('Patient Information', {
             'fields': ('patient_profile', 'urine_analysis', 'serum_labs')
         }),
         ('Plan Details', {
-            'fields': ('stone_type', 'urine_interpretation', 'recommendations')
+            'fields': ('stone_type', 'urine_interpretation', 'recommendations', 'rule_version')
         }),
         ('Timestamps', {
             'fields': ('created_at',),
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(QuantileSketch)
+class QuantileSketchAdmin(admin.ModelAdmin):
+    list_display = ['field', 'count', 'minimum', 'maximum', 'updated_at']
+    readonly_fields = ['field', 'count', 'minimum', 'maximum', 'means', 'weights', 'buffer',
+                       'updated_at']
+
+
+@admin.register(FoodDiaryEntry)
+class FoodDiaryEntryAdmin(admin.ModelAdmin):
+    list_display = ['id', 'patient_profile', 'food_name', 'portions', 'oxalate_mg', 'eaten_at']
+    list_filter = ['eaten_at']
+    search_fields = ['patient_profile__id', 'food_name']
+    readonly_fields = ['created_at']
+
+
+@admin.register(OxalateIntakeRollup)
+class OxalateIntakeRollupAdmin(admin.ModelAdmin):
+    list_display = ['patient_profile', 'period', 'start', 'oxalate_mg', 'entries']
+    list_filter = ['period']
+    search_fields = ['patient_profile__id']
+    readonly_fields = ['patient_profile', 'period', 'start', 'oxalate_mg', 'entries']
+
+
+@admin.register(UrineTrend)
+class UrineTrendAdmin(admin.ModelAdmin):
+    list_display = ['urine_analysis', 'patient_profile', 'visit', 'collected_at', 'days_since_previous',
+                    'rule_version']
+    search_fields = ['patient_profile__id']
+    readonly_fields = [field.name for field in UrineTrend._meta.fields]
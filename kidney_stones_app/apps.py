@@ -4,3 +4,20 @@ from django.apps import AppConfig
 class KidneyStonesAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "kidney_stones_app"
+
+    def ready(self):
+        from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
+        from kidney_stones_engine import rulepack, tracing
+        from . import signals  # noqa: F401
+
+        config = getattr(settings, 'RULE_TRACING', {})
+        if config.get('ENABLED'):
+            tracing.enable(history=config.get('HISTORY', 0))
+
+        config = getattr(settings, 'RULE_PACK', {})
+        if config.get('PATH'):
+            try:
+                rulepack.watch(config['PATH'], config.get('POLL_INTERVAL', 2.0))
+            except rulepack.RulePackError as error:
+                raise ImproperlyConfigured(f"RULE_PACK: {error}") from error
@@ -0,0 +1,219 @@
+"""
+Vectorized batch versions of the urine interpretation and management plan services.
+Every threshold rule of interpret_24hr_urine is evaluated as a NumPy mask over
+column arrays, so whole cohorts can be re-scored without a per-row Python loop.
+"""
+import numpy as np
+
+from .services import (
+    URINE_FIELDS, SERUM_FIELDS, Finding, FINDING_MESSAGES, PLAN_STEPS, PH_RAISING_MEDICATIONS,
+    active_rule_set,
+)
+
+
+# Interpretation key reported by interpret_24hr_urine for each finding code
+FINDING_KEYS = {finding: key for finding, key, _ in FINDING_MESSAGES}
+
+# Medical conditions consulted by generate_management_plan
+PLAN_CONDITIONS = {
+    'rta': ("Renal Tubular Acidosis",),
+    'malabsorption': ("Malabsorption (IBD, Bariatric Surgery, etc.)",),
+    'chronic_diarrhea': ("chronic_diarrhea",),
+}
+
+
+def _column(columns, name, n=None, default=None):
+    """Fetch a column from a mapping or DataFrame as a float array"""
+    if name not in columns:
+        if default is None:
+            raise KeyError(f"Missing column '{name}'")
+        return np.full(n, default, dtype=float)
+    return np.asarray(columns[name], dtype=float)
+
+
+def _membership(rows, groups, n):
+    """
+    One boolean array per named group, telling which rows' lists contain any
+    of the group's entries. Each distinct list is only checked once.
+    """
+    if rows is None:
+        return {key: np.zeros(n, dtype=bool) for key in groups}
+    distinct = {}
+    ids = np.fromiter(
+        (distinct.setdefault(tuple(row) if row else (), len(distinct)) for row in rows),
+        dtype=np.intp, count=n)
+    return {
+        key: np.array([any(name in row for name in names) for row in distinct],
+                      dtype=bool)[ids]
+        for key, names in groups.items()
+    }
+
+
+def _variant_ids(rule_set, n, ages, genders):
+    """Index into rule_set.variants of every row's reference range, via searchsorted"""
+    index = rule_set.reference_index
+    ages = np.full(n, np.nan) if ages is None else np.asarray(ages, dtype=float)
+    genders = np.broadcast_to(np.asarray(genders, dtype=object), (n,))
+    known_age = ~np.isnan(ages)
+    ids = np.empty(n, dtype=np.intp)
+    unlisted = np.ones(n, dtype=bool)
+    for sex in sorted(index, key=lambda sex: sex is None):
+        if sex is None:
+            rows = unlisted
+        else:
+            rows = genders == sex
+            unlisted &= ~rows
+        breakpoints, segments, unknown_age = index[sex]
+        segment = np.asarray(segments)[np.searchsorted(breakpoints, ages[rows], side='right')]
+        ids[rows] = np.where(known_age[rows], segment, unknown_age)
+    return ids
+
+
+def _limits(rule_set, n, ages, genders):
+    """
+    Thresholds for every row: the rule set's own mapping, or arrays of
+    per-row limits when it has age/sex reference ranges.
+    """
+    rule_set = rule_set or active_rule_set()
+    if rule_set.reference_index is None:
+        return rule_set.thresholds
+    ids = _variant_ids(rule_set, n, ages, genders)
+    return {
+        name: np.array([variant.thresholds[name] for variant in rule_set.variants])[ids]
+        for name in rule_set.thresholds
+    }
+
+
+def interpret_24hr_urine_batch(columns, medical_conditions=None, rule_set=None,
+                               ages=None, genders=None):
+    """
+    Vectorized interpret_24hr_urine.
+    columns maps every UrineAnalysis field to an array (cystine_mg is optional),
+    medical_conditions is an optional per-row sequence of condition lists and
+    rule_set defaults to the active one. ages (NaN when unknown) and genders
+    select each row's reference ranges, as PatientProfile.age/gender would.
+    Returns a uint32 array of finding codes, one bitmask per row.
+    """
+    volume = _column(columns, 'volume_L')
+    n = len(volume)
+    limits = _limits(rule_set, n, ages, genders)
+    ph = _column(columns, 'ph')
+    calcium = _column(columns, 'calcium_mg')
+    oxalate = _column(columns, 'oxalate_mg')
+    citrate = _column(columns, 'citrate_mg')
+    uric_acid = _column(columns, 'uric_acid_mg')
+    sodium = _column(columns, 'sodium_mEq')
+    sulfate = _column(columns, 'sulfate_mmol')
+    ammonium = _column(columns, 'ammonium_mmol')
+    cystine = _column(columns, 'cystine_mg', n, default=0)
+
+    rta = _membership(medical_conditions, {'rta': ("Renal Tubular Acidosis",)}, n)['rta']
+    acidic = ph < limits['ph_acidic_below']
+    hypercalciuria = calcium > limits['calcium_mg_max']
+    hyperoxaluria = oxalate > limits['oxalate_mg_max']
+    cystine_high = cystine > limits['cystine_mg_max']
+
+    masks = (
+        (Finding.URINE_VOLUME_LOW, volume < limits['volume_L_min']),
+        (Finding.URINE_PH_ACIDIC, acidic),
+        (Finding.URINE_PH_ALKALINE_RTA, ~acidic & rta),
+        (Finding.URINE_PH_VERY_ALKALINE, ~acidic & ~rta & (ph > limits['ph_alkaline_above'])),
+        (Finding.URINE_CALCIUM_HIGH, hypercalciuria),
+        (Finding.URINE_OXALATE_HIGH, hyperoxaluria),
+        (Finding.URINE_OXALATE_VERY_HIGH,
+         hyperoxaluria & (oxalate > limits['oxalate_mg_primary_hyperoxaluria'])),
+        (Finding.URINE_CITRATE_LOW, citrate < limits['citrate_mg_min']),
+        (Finding.URINE_URIC_ACID_HIGH, uric_acid > limits['uric_acid_mg_max']),
+        (Finding.URINE_SODIUM_HIGH, hypercalciuria & (sodium > limits['sodium_mEq_max'])),
+        (Finding.URINE_SULFATE_HIGH, sulfate > limits['sulfate_mmol_max']),
+        (Finding.URINE_AMMONIUM_HIGH, ammonium > limits['ammonium_mmol_max']),
+        (Finding.URINE_CYSTINE_HIGH, cystine_high),
+        (Finding.URINE_CYSTINE_VERY_HIGH, cystine_high & (cystine > limits['cystine_mg_cystinuria'])),
+    )
+
+    codes = np.zeros(n, dtype=np.uint32)
+    for code, mask in masks:
+        codes[mask] |= np.uint32(code)
+    return codes
+
+
+def finding_keys(code):
+    """Interpretation keys for one row's finding code, in interpret_24hr_urine order"""
+    keys = []
+    for bit, key in FINDING_KEYS.items():
+        if code & bit and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def generate_management_plan_batch(stone_types, codes, medical_conditions, medications=None,
+                                   serum_columns=None, rule_set=None, ages=None, genders=None):
+    """
+    Vectorized generate_management_plan.
+    stone_types is a single stone type or one per row, codes come from
+    interpret_24hr_urine_batch and serum_columns optionally maps SerumLabs
+    fields to arrays. A missing field or a NaN (as load_columns gives patients
+    without serum labs) is an unknown lab and fires no serum condition.
+    Pass the rule_set, ages and genders the codes were computed with.
+    Returns (plan_ids, plan_table): plan_table holds each distinct plan once
+    and plan_ids gives the index of every row's plan in that table.
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    limits = _limits(rule_set, n, ages, genders)
+    stone_types = np.broadcast_to(np.asarray(stone_types, dtype=object), (n,))
+
+    if serum_columns is not None:
+        serum_calcium = _column(serum_columns, 'calcium_mg_dL', n, default=np.nan)
+        serum_pth = _column(serum_columns, 'intact_pth_pg_mL', n, default=np.nan)
+        serum_potassium = _column(serum_columns, 'potassium_mEq_L', n, default=np.nan)
+        serum_bicarbonate = _column(serum_columns, 'bicarbonate_mEq_L', n, default=np.nan)
+        hyperparathyroidism = ((serum_calcium >= limits['serum_calcium_mg_dL_high'])
+                               & (serum_pth >= limits['serum_pth_pg_mL_high']))
+        hypokalemia = serum_potassium < limits['serum_potassium_mEq_L_low']
+        low_bicarbonate = serum_bicarbonate < limits['serum_bicarbonate_mEq_L_low']
+    else:
+        hyperparathyroidism = hypokalemia = low_bicarbonate = np.zeros(n, dtype=bool)
+
+    patient = _membership(medical_conditions, PLAN_CONDITIONS, n)
+    medication = _membership(medications, {'alkalinizing': PH_RAISING_MEDICATIONS}, n)
+    conditions = {
+        'hypercalciuria': (codes & Finding.URINE_CALCIUM_HIGH) != 0,
+        'hypocitraturia': (codes & Finding.URINE_CITRATE_LOW) != 0,
+        'hyperoxaluria': (codes & Finding.URINE_OXALATE_HIGH) != 0,
+        'hyperuricosuria': (codes & Finding.URINE_URIC_ACID_HIGH) != 0,
+        'malabsorption': patient['malabsorption'],
+        'chronic_diarrhea': patient['chronic_diarrhea'],
+        'alkalinizing_medication': ((codes & Finding.URINE_PH_ALKALINE_RTA) != 0)
+        & medication['alkalinizing'],
+        'hyperparathyroidism': hyperparathyroidism,
+        'hypokalemia': hypokalemia,
+        'acidosis': patient['rta'] | low_bicarbonate,
+    }
+
+    # Pack the fired steps of every row into one integer so identical plans
+    # are built only once
+    type_masks = {}
+    packed = np.zeros(n, dtype=np.uint64)
+    for index, (stone_type, condition, _) in enumerate(PLAN_STEPS):
+        if stone_type is None:
+            fired = np.ones(n, dtype=bool)
+        else:
+            if stone_type not in type_masks:
+                type_masks[stone_type] = stone_types == stone_type
+            fired = type_masks[stone_type]
+        if condition is not None:
+            fired = fired & conditions[condition]
+        packed[fired] |= np.uint64(1 << index)
+
+    patterns, plan_ids = np.unique(packed, return_inverse=True)
+    plan_table = [
+        [text for index, (_, _, text) in enumerate(PLAN_STEPS) if int(pattern) >> index & 1]
+        for pattern in patterns
+    ]
+    return plan_ids, plan_table
+
+
+def expand_plans(plan_ids, plan_table):
+    """Expand a batch result into one independent plan list per row"""
+    return [list(plan_table[plan_id]) for plan_id in plan_ids]
@@ -0,0 +1,139 @@
+"""
+Bounded LRU/TTL memoization in front of the clinical services.
+Urine panels are entered through discrete Select widgets, so identical inputs
+recur often; results are cached on a canonical tuple of the inputs each rule
+actually reads.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+
+from .services import (
+    UrineProfile, PatientContext, active_rule_set, evaluate_24hr_urine, plan_conditions,
+    plan_from_conditions,
+)
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with an optional time-to-live"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def _build_cache(name, default_size):
+    config = getattr(settings, 'SERVICES_CACHE', {})
+    return LRUCache(
+        maxsize=config.get(f'{name}_MAXSIZE', default_size),
+        ttl=config.get('TTL'),
+    )
+
+
+interpretation_cache = _build_cache('INTERPRETATION', 4096)
+plan_cache = _build_cache('PLAN', 1024)
+
+
+def _urine_key(urine_profile, patient_profile, rule_set):
+    """
+    Canonical key of a urine panel. The value type is part of the key because
+    the rendered text depends on it (200 and 200.0 hash alike but print apart),
+    and so is the rule set for the patient's age and sex, which also keeps a
+    reloaded rule pack from serving stale entries.
+    """
+    values = tuple((value.__class__, value) for value in urine_profile)
+    rta = "Renal Tubular Acidosis" in patient_profile.medical_conditions
+    return values, rta, rule_set
+
+
+def cached_interpretation(urine_profile, patient_profile=None):
+    """
+    Memoized evaluate_24hr_urine.
+    Returns (findings, interpretation), where the interpretation is the
+    shared read-only Interpretation of the cached findings: each message is
+    rendered once, the first time a page displays it.
+    """
+    urine_profile = UrineProfile.coerce(urine_profile)
+    patient_profile = PatientContext.coerce(patient_profile)
+    rule_set = active_rule_set().for_patient(patient_profile.age, patient_profile.gender)
+    key = _urine_key(urine_profile, patient_profile, rule_set)
+    interpretation = interpretation_cache.get(key)
+    if interpretation is None:
+        interpretation = evaluate_24hr_urine(
+            urine_profile, patient_profile, rule_set).interpretation()
+        interpretation_cache.set(key, interpretation)
+    return interpretation.findings, interpretation
+
+
+def cached_management_plan(stone_type, findings, patient_profile, serum_labs=None):
+    """
+    Memoized generate_management_plan, keyed on the stone type and the
+    conditions the plan steps depend on. Returns a fresh list.
+    """
+    conditions = plan_conditions(findings, patient_profile, serum_labs)
+    key = (stone_type, tuple(conditions.values()))
+    plan = plan_cache.get(key)
+    if plan is None:
+        plan = plan_from_conditions(stone_type, conditions)
+        plan_cache.set(key, plan)
+    return list(plan)
+
+
+def cache_stats():
+    """Counters of every services cache, for sizing SERVICES_CACHE"""
+    return {
+        'interpretation': interpretation_cache.stats(),
+        'plan': plan_cache.stats(),
+    }
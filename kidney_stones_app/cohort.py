@@ -0,0 +1,215 @@
+"""
+Scoring of cohort exports (CSV or NDJSON lab files) too large to load at once.
+
+The file is read in chunks of whole records. Every chunk is turned into column
+arrays and scored with the vectorized interpretation and plan services of
+batch.py, optionally split across cores by parallel.py, so only one chunk is
+ever in memory. Each record keeps the byte offset it starts at, and every
+chunk ends on a record boundary, so a run can resume exactly where it stopped
+by seeking to the offset after the last written chunk.
+
+Columns are named after the UrineAnalysis, SerumLabs and PatientProfile
+fields: the urine fields are required (cystine_mg defaults to 0), the serum
+fields are optional (a row without serum values gets no serum-based plan
+steps) and stone_type, medical_conditions, medications, age, gender and id
+are optional too. In CSV, medical_conditions and medications list their
+entries separated by ';'; in NDJSON they may also be JSON lists.
+"""
+import csv
+import io
+import json
+
+import numpy as np
+
+from .parallel import interpret_cohort
+from .services import URINE_FIELDS, SERUM_FIELDS, Finding, active_rule_set
+
+
+COHORT_FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+# Stone type of rows that do not give one
+DEFAULT_STONE_TYPE = 'Unknown'
+
+OPTIONAL_URINE_FIELDS = {'cystine_mg': 0.0}
+
+
+class CohortFormatError(ValueError):
+    """Raised for a cohort file that cannot be read as the expected format"""
+
+
+def cohort_format(path):
+    """Format of a cohort file from its extension"""
+    for extension, name in COHORT_FORMATS.items():
+        if str(path).lower().endswith(extension):
+            return name
+    raise CohortFormatError(f'Cannot tell the format of {path}; expected one of '
+                            f'{", ".join(COHORT_FORMATS)}')
+
+
+class _Lines:
+    """Lines of a binary file, decoded, keeping the byte offset reached"""
+
+    def __init__(self, stream, offset):
+        self.stream = stream
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.stream.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8-sig' if self.offset == len(line) else 'utf-8')
+
+
+def _csv_records(stream, offset):
+    lines = _Lines(stream, 0)
+    header = next(csv.reader([next(lines, '')]), None)
+    if not header:
+        raise CohortFormatError('The CSV file has no header line')
+    header = [name.strip() for name in header]
+    if offset > lines.offset:
+        stream.seek(offset)
+        lines.offset = offset
+    reader = csv.reader(lines)
+    start = lines.offset
+    for row in reader:
+        if row:
+            yield start, dict(zip(header, row))
+        start = lines.offset
+
+
+def _ndjson_records(stream, offset):
+    stream.seek(offset)
+    lines = _Lines(stream, offset)
+    start = offset
+    for line in lines:
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise CohortFormatError(f'Invalid JSON at byte {start}: {error}')
+            if not isinstance(record, dict):
+                raise CohortFormatError(f'Record at byte {start} is not an object')
+            yield start, record
+        start = lines.offset
+
+
+def read_chunks(stream, format, chunk_size, offset=0):
+    """
+    Records of a cohort file opened in binary mode, chunk_size at a time.
+    Yields (records, offsets, end): the records as dicts, the byte offset
+    each starts at and the offset right after the chunk, where reading can
+    resume. For CSV an offset of 0 (or within the header) starts after the
+    header line.
+    """
+    records = _csv_records(stream, offset) if format == 'csv' else _ndjson_records(stream, offset)
+    chunk = []
+    offsets = []
+    for start, record in records:
+        chunk.append(record)
+        offsets.append(start)
+        if len(chunk) == chunk_size:
+            yield chunk, offsets, stream.tell()
+            chunk, offsets = [], []
+    if chunk:
+        yield chunk, offsets, stream.tell()
+
+
+def _numbers(values):
+    """Float array of raw values; blanks and anything unparseable become NaN"""
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        numbers = np.empty(len(values))
+        for index, value in enumerate(values):
+            try:
+                numbers[index] = float(value)
+            except (TypeError, ValueError):
+                numbers[index] = np.nan
+        return numbers
+
+
+def _entries(value):
+    """A medical_conditions/medications cell as a list"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [entry.strip() for entry in value.split(';') if entry.strip()]
+    return list(value)
+
+
+def chunk_columns(records):
+    """
+    Column arrays of a chunk of records, plus a per-row error message (None
+    for usable rows) naming the first missing or non-numeric urine field.
+    """
+    n = len(records)
+    urine = {}
+    errors = [None] * n
+    for field in URINE_FIELDS:
+        values = _numbers([record.get(field, OPTIONAL_URINE_FIELDS.get(field)) for record in records])
+        missing = np.isnan(values)
+        if field in OPTIONAL_URINE_FIELDS:
+            values[missing] = OPTIONAL_URINE_FIELDS[field]
+        else:
+            for index in np.flatnonzero(missing).tolist():
+                errors[index] = errors[index] or f'Missing or invalid {field}'
+        urine[field] = values
+
+    serum = None
+    if any(field in record for record in records for field in SERUM_FIELDS):
+        # NaN fails every serum threshold comparison, as a missing panel would
+        serum = {field: _numbers([record.get(field) for record in records]) for field in SERUM_FIELDS}
+
+    return {
+        'urine': urine,
+        'serum': serum,
+        'stone_types': np.array([record.get('stone_type') or DEFAULT_STONE_TYPE for record in records],
+                                dtype=object),
+        'medical_conditions': [_entries(record.get('medical_conditions')) for record in records],
+        'medications': [_entries(record.get('medications')) for record in records],
+        'ages': _numbers([record.get('age') for record in records]),
+        'genders': np.array([record.get('gender') or None for record in records], dtype=object),
+    }, errors
+
+
+def score_columns(columns, rule_set=None, workers=1, executor=None):
+    """
+    Finding codes and plans of chunk_columns() output: (codes, plan_ids,
+    plan_table) as returned by the batch services, computed by workers
+    processes (see parallel.interpret_cohort).
+    """
+    urine = {field: np.nan_to_num(values) for field, values in columns['urine'].items()}
+    return interpret_cohort(
+        urine, columns['medical_conditions'], columns['medications'], columns['stone_types'],
+        columns['serum'], columns['ages'], columns['genders'], rule_set, workers, executor)
+
+
+def score_chunk(records, offsets, rule_set=None, workers=1, executor=None):
+    """
+    NDJSON output lines (bytes) of a chunk: the input offset and id of each
+    record with its finding names and management plan, or an error for rows
+    that cannot be interpreted.
+    """
+    rule_set = rule_set or active_rule_set()
+    columns, errors = chunk_columns(records)
+    codes, plan_ids, plan_table = score_columns(columns, rule_set, workers, executor)
+    names = {}
+    output = io.StringIO()
+    for record, offset, error, code, plan_id in zip(
+            records, offsets, errors, codes.tolist(), plan_ids.tolist()):
+        row = {'offset': offset, 'id': record.get('id')}
+        if error:
+            row['error'] = error
+        else:
+            if code not in names:
+                names[code] = Finding.names(code)
+            row['findings'] = names[code]
+            row['plan'] = plan_table[plan_id]
+            row['rule_version'] = rule_set.stamp
+        output.write(json.dumps(row))
+        output.write('\n')
+    return output.getvalue().encode()
@@ -0,0 +1,197 @@
+"""
+Columnar loading of stored rows into NumPy arrays, without model instances.
+
+Analytics over every UrineAnalysis only need the values, one array per
+field. load_columns runs a single query and reads its rows in chunks (from a
+server-side cursor where the database has one), straight into arrays
+allocated up front from a count. Decimal fields are cast to floating point
+in SQL, so no Decimal is ever built, and database converters only run for
+the columns that need them (dates, JSON). Peak memory is the final arrays
+plus one chunk of rows.
+
+load_urine_columns adds the PatientProfile fields and the latest SerumLabs
+of each panel's patient. Instead of joining in SQL, it loads those tables
+once per patient and joins them to the panels in NumPy on patient id.
+"""
+from datetime import timezone as dt_timezone
+from operator import itemgetter
+
+from django.db import connections, models
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from django.db.models.sql.constants import MULTI
+import numpy as np
+
+from .models import PatientProfile, SerumLabs, UrineAnalysis
+from .services import URINE_FIELDS
+
+
+LOAD_CHUNK_SIZE = 20000
+
+FLOAT_FIELDS = (models.DecimalField, models.FloatField)
+INTEGER_FIELDS = (models.IntegerField, models.AutoField, models.ForeignKey)
+
+NAT = np.datetime64('NaT')
+
+
+def column_dtype(field):
+    """NumPy dtype of a model field's column: nullable integers load as float (NaN)"""
+    if isinstance(field, FLOAT_FIELDS):
+        return np.dtype(np.float64)
+    if isinstance(field, INTEGER_FIELDS):
+        return np.dtype(np.float64 if field.null else np.int64)
+    if isinstance(field, models.BooleanField):
+        return np.dtype(object if field.null else bool)
+    if isinstance(field, models.DateTimeField):
+        return np.dtype('datetime64[us]')
+    if isinstance(field, models.DateField):
+        return np.dtype('datetime64[D]')
+    return np.dtype(object)
+
+
+def _datetime(value):
+    if value is None:
+        return NAT
+    if value.tzinfo is not None:
+        value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _fill(array, start, values, dtype, converters, expression, connection):
+    """Writes one chunk of a column's raw values into array[start:]"""
+    if converters:
+        for converter in converters:
+            values = [converter(value, expression, connection) for value in values]
+    if dtype.kind == 'M':
+        values = [_datetime(value) for value in values]
+    if dtype.kind in 'iu':
+        array[start:start + len(values)] = np.fromiter(values, dtype=dtype, count=len(values))
+    elif dtype.kind == 'O':
+        array[start:start + len(values)] = values
+    else:
+        # None loads as NaN (NaT for dates)
+        array[start:start + len(values)] = np.array(values, dtype=dtype)
+
+
+def load_columns(queryset, fields, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    {field: array} of the queryset's rows, in queryset order. fields are
+    field names (or attnames such as 'patient_profile_id') of its model,
+    or lookups through relations such as 'patient_profile__age'.
+    """
+    model = queryset.model
+    aliases = {}
+    dtypes = {}
+    for index, name in enumerate(fields):
+        *path, last = name.split('__')
+        related = model
+        for step in path:
+            related = related._meta.get_field(step).related_model
+        field = related._meta.get_field(last)
+        dtypes[name] = column_dtype(field)
+        expression = F(name)
+        if isinstance(field, FLOAT_FIELDS):
+            expression = Cast(name, FloatField())
+        aliases[name] = (f'column{index}', expression)
+
+    total = queryset.count()
+    columns = {name: np.empty(total, dtype=dtypes[name]) for name in fields}
+    query = queryset.annotate(**dict(aliases.values())).values_list(
+        *(alias for alias, _ in aliases.values())).query
+    compiler = query.get_compiler(queryset.db)
+    connection = connections[queryset.db]
+
+    filled = 0
+    position = converters = None
+    for rows in compiler.execute_sql(MULTI, chunked_fetch=True, chunk_size=chunk_size):
+        if position is None:
+            position = {alias: index for index, (_, _, alias) in enumerate(compiler.select)}
+            # Casts to float need no conversion; only dates, JSON and the like do
+            converters = {
+                index: (functions, expression)
+                for index, (functions, expression) in compiler.get_converters(
+                    [expression for expression, _, _ in compiler.select]).items()
+                if not isinstance(expression, Cast)
+            }
+        if filled + len(rows) > total:
+            # Rows inserted since the count
+            total = max(2 * total, filled + len(rows))
+            columns = {name: np.resize(array, total) for name, array in columns.items()}
+        for name, (alias, _) in aliases.items():
+            index = position[alias]
+            functions, expression = converters.get(index, ((), None))
+            _fill(columns[name], filled, list(map(itemgetter(index), rows)), dtypes[name],
+                  functions, expression, connection)
+        filled += len(rows)
+    return {name: array[:filled] for name, array in columns.items()}
+
+
+def _join(keys, table_keys, columns, optional=False):
+    """
+    columns of the table rows whose key (table_keys, sorted) matches each of
+    keys; rows without a match get NaN, NaT or None. Optional columns always
+    take a dtype that can hold the missing value, so it does not depend on
+    the data.
+    """
+    positions = np.searchsorted(table_keys, keys)
+    found = np.zeros(len(keys), dtype=bool)
+    if len(table_keys):
+        positions[positions == len(table_keys)] = 0
+        found = table_keys[positions] == keys
+    joined = {}
+    missing = ~found
+    for name, values in columns.items():
+        dtype = values.dtype
+        if not (optional or missing.any()):
+            joined[name] = values[positions]
+            continue
+        if dtype.kind in 'iub':
+            dtype = np.dtype(np.float64 if dtype.kind in 'iu' else object)
+        array = np.empty(len(keys), dtype=dtype)
+        array[found] = values[positions[found]]
+        array[missing] = {'f': np.nan, 'M': NAT}.get(dtype.kind)
+        joined[name] = array
+    return joined
+
+
+def load_urine_columns(queryset=None, fields=('id', 'patient_profile_id') + URINE_FIELDS,
+                       patient_fields=(), serum_fields=(), chunk_size=LOAD_CHUNK_SIZE):
+    """
+    {field: array} of UrineAnalysis rows (all by default) in id order, with
+    the patient_fields of each panel's PatientProfile and the serum_fields of
+    the patient's latest SerumLabs (NaN for patients without serum labs),
+    e.g. load_urine_columns(patient_fields=('age', 'gender'),
+    serum_fields=SERUM_FIELDS). Joined fields whose name is already taken
+    are keyed 'patient_profile__<name>' or 'serum_labs__<name>'.
+    """
+    queryset = (UrineAnalysis.objects.all() if queryset is None else queryset).order_by('id')
+    fields = tuple(fields)
+    joins = [(prefix, model, tuple(extra)) for prefix, model, extra in (
+        ('patient_profile', PatientProfile, patient_fields), ('serum_labs', SerumLabs, serum_fields))
+        if extra]
+    load = fields if not joins or 'patient_profile_id' in fields else fields + ('patient_profile_id',)
+    columns = load_columns(queryset, load, chunk_size)
+    if not joins:
+        return columns
+
+    patient_ids = columns['patient_profile_id'] if 'patient_profile_id' in fields \
+        else columns.pop('patient_profile_id')
+    patients = queryset.values('patient_profile_id')
+    for prefix, model, extra in joins:
+        if model is PatientProfile:
+            table = load_columns(PatientProfile.objects.filter(id__in=patients).order_by('id'),
+                                 ('id',) + extra, chunk_size)
+            keys = table.pop('id')
+        else:
+            table = load_columns(
+                SerumLabs.objects.filter(patient_profile_id__in=patients)
+                .order_by('patient_profile_id', 'created_at', 'id'),
+                ('patient_profile_id',) + extra, chunk_size)
+            keys = table.pop('patient_profile_id')
+            # The last (latest) labs of every patient
+            latest = np.flatnonzero(np.append(keys[1:] != keys[:-1], True)) if len(keys) else keys
+            keys = keys[latest]
+            table = {name: values[latest] for name, values in table.items()}
+        for name, values in _join(patient_ids, keys, table, optional=model is SerumLabs).items():
+            columns[f'{prefix}__{name}' if name in columns else name] = values
+    return columns
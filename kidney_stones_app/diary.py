@@ -0,0 +1,126 @@
+"""
+Food diary oxalate totals.
+
+Every diary entry adds its oxalate to one daily and one weekly
+OxalateIntakeRollup row of the patient as it is saved, and takes it back out
+when it is edited or deleted (see signals.py). Dashboards read the rollup
+rows, one per day or week with entries, however long the diary is.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import FoodDiaryEntry, OxalateIntakeRollup
+
+
+# Daily intake usually advised for calcium oxalate stone formers with hyperoxaluria
+DAILY_OXALATE_TARGET_MG = 50
+
+CENTS = Decimal('0.01')
+
+
+def portion_oxalate(oxalate_mg, portions):
+    """Oxalate in mg of a number of servings, rounded as stored"""
+    return (Decimal(oxalate_mg) * Decimal(portions)).quantize(CENTS)
+
+
+def week_start(day):
+    """Monday of the week of day"""
+    return day - timedelta(days=day.weekday())
+
+
+def entry_day(eaten_at):
+    return timezone.localtime(eaten_at).date() if timezone.is_aware(eaten_at) else eaten_at.date()
+
+
+def apply_to_rollups(patient_id, eaten_at, oxalate_mg, entries):
+    """
+    Adds oxalate_mg and entries (negative to take an entry out) to the daily
+    and weekly totals of the day of eaten_at, with single-row updates so
+    concurrent entries do not overwrite each other.
+    """
+    day = entry_day(eaten_at)
+    with transaction.atomic():
+        for period, start in (('day', day), ('week', week_start(day))):
+            rollups = OxalateIntakeRollup.objects.filter(
+                patient_profile_id=patient_id, period=period, start=start)
+            changes = {'oxalate_mg': F('oxalate_mg') + oxalate_mg, 'entries': F('entries') + entries}
+            if entries < 0:
+                # Nothing to take out if the rollup is already gone (e.g. deleting the patient)
+                rollups.update(**changes)
+                rollups.filter(entries__lte=0).delete()
+            elif not rollups.update(**changes):
+                try:
+                    with transaction.atomic():
+                        OxalateIntakeRollup.objects.create(
+                            patient_profile_id=patient_id, period=period, start=start,
+                            oxalate_mg=oxalate_mg, entries=entries)
+                except IntegrityError:
+                    # Created by a concurrent entry in the meantime
+                    rollups.update(**changes)
+
+
+def intake_totals(patient_profile, days=14, weeks=8, today=None):
+    """
+    Daily totals of the last days days and weekly totals of the last weeks
+    weeks, oldest first and including days without entries, from the rollups.
+    """
+    today = today or timezone.localdate()
+    first_day = today - timedelta(days=days - 1)
+    first_week = week_start(today) - timedelta(weeks=weeks - 1)
+    stored = {
+        (period, start): (oxalate_mg, entries)
+        for period, start, oxalate_mg, entries in OxalateIntakeRollup.objects.filter(
+            patient_profile=patient_profile, start__gte=min(first_day, first_week), start__lte=today,
+        ).values_list('period', 'start', 'oxalate_mg', 'entries')
+    }
+
+    def series(period, starts, target):
+        rows = []
+        for start in starts:
+            oxalate_mg, entries = stored.get((period, start), (Decimal(0), 0))
+            rows.append({'start': start, 'oxalate_mg': oxalate_mg, 'entries': entries,
+                         'over_target': oxalate_mg > target})
+        return rows
+
+    return {
+        'target_mg': DAILY_OXALATE_TARGET_MG,
+        'daily': series('day', (first_day + timedelta(days=offset) for offset in range(days)),
+                        DAILY_OXALATE_TARGET_MG),
+        'weekly': series('week', (first_week + timedelta(weeks=offset) for offset in range(weeks)),
+                         7 * DAILY_OXALATE_TARGET_MG),
+    }
+
+
+def rebuild_rollups(patient_ids=None):
+    """
+    Recomputes the rollups from the diary entries (all patients by default),
+    e.g. after entries were changed with queryset.update(); returns the
+    number of rollup rows written.
+    """
+    entries = FoodDiaryEntry.objects.all()
+    rollups = OxalateIntakeRollup.objects.all()
+    if patient_ids is not None:
+        entries = entries.filter(patient_profile_id__in=patient_ids)
+        rollups = rollups.filter(patient_profile_id__in=patient_ids)
+
+    totals = {}
+    for patient_id, day, oxalate_mg, count in (
+            entries.annotate(day=TruncDate('eaten_at')).order_by()
+            .values_list('patient_profile_id', 'day').annotate(Sum('oxalate_mg'), Count('id'))):
+        for period, start in (('day', day), ('week', week_start(day))):
+            total = totals.setdefault((patient_id, period, start), [Decimal(0), 0])
+            total[0] += oxalate_mg
+            total[1] += count
+
+    with transaction.atomic():
+        rollups.delete()
+        OxalateIntakeRollup.objects.bulk_create(
+            OxalateIntakeRollup(patient_profile_id=patient_id, period=period, start=start,
+                                oxalate_mg=oxalate_mg, entries=count)
+            for (patient_id, period, start), (oxalate_mg, count) in totals.items())
+    return len(totals)
@@ -0,0 +1,108 @@
+"""
+Food guidance for elevated urine oxalate, from the oxalate database.
+
+The foods are ranked once per category when the oxalate data is loaded (or
+on first use) and kept in process: high-oxalate foods by decreasing oxalate,
+low-oxalate swaps by increasing oxalate. A plan then only slices the ranked
+lists, so the chronic management page issues no food query per request.
+Other processes pick up reloaded data when their copy expires after
+SERVICES_CACHE['TTL'] seconds.
+"""
+import heapq
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .models import OxalateContent
+from .services import Finding
+
+
+# Foods listed per category and overall
+DIET_GUIDANCE_FOODS = 5
+
+AVOID_LEVELS = ('High', 'Very High')
+SWAP_LEVELS = ('Low',)
+
+
+class RankedFood(NamedTuple):
+    food: str
+    type: str
+    oxalate_mg: float
+    serving_size: str
+    oxalate_level: str
+
+
+class OxalateRankings:
+    """Ranked food lists per OxalateContent.type"""
+
+    def __init__(self, foods):
+        by_type = {}
+        for food in foods:
+            by_type.setdefault(food.type, []).append(food)
+        # Every food of each category by increasing oxalate, for the meal planner
+        self.ascending = {food_type: tuple(sorted(items, key=lambda food: (food.oxalate_mg, food.food)))
+                          for food_type, items in by_type.items()}
+        self.avoid = {}
+        self.swaps = {}
+        for food_type, items in self.ascending.items():
+            self.avoid[food_type] = tuple(sorted(
+                (food for food in items if food.oxalate_level in AVOID_LEVELS),
+                key=lambda food: (-food.oxalate_mg, food.food)))
+            self.swaps[food_type] = tuple(
+                food for food in items if food.oxalate_level in SWAP_LEVELS)
+        # Categories with foods to avoid, worst first
+        self.types = tuple(sorted(
+            (food_type for food_type, avoid in self.avoid.items() if avoid),
+            key=lambda food_type: (-self.avoid[food_type][0].oxalate_mg, food_type)))
+        self.top_avoid = tuple(heapq.merge(
+            *self.avoid.values(), key=lambda food: (-food.oxalate_mg, food.food)))
+
+    @classmethod
+    def from_database(cls):
+        return cls(RankedFood(food, food_type, float(oxalate_mg), serving_size, level)
+                   for food, food_type, oxalate_mg, serving_size, level in
+                   OxalateContent.objects.values_list(
+                       'food', 'type', 'oxalate_mg', 'serving_size', 'oxalate_level'))
+
+
+_rankings = None
+_expires = 0.0
+_lock = threading.Lock()
+
+
+def refresh_oxalate_rankings():
+    """Re-ranks the foods from the database, e.g. after loading oxalate data"""
+    global _rankings, _expires
+    rankings = OxalateRankings.from_database()
+    with _lock:
+        _rankings = rankings
+        _expires = time.monotonic() + settings.SERVICES_CACHE['TTL']
+    return rankings
+
+
+def oxalate_rankings():
+    """The in-process rankings, built on first use and after they expire"""
+    if _rankings is None or _expires < time.monotonic():
+        return refresh_oxalate_rankings()
+    return _rankings
+
+
+def diet_guidance(findings, limit=DIET_GUIDANCE_FOODS):
+    """
+    Foods to avoid and low-oxalate swaps for the urine findings, or None
+    when urine oxalate is not elevated. Categories are ordered by their
+    highest-oxalate food; those without any high-oxalate food are left out.
+    """
+    if Finding.URINE_OXALATE_HIGH not in findings:
+        return None
+    rankings = oxalate_rankings()
+    return {
+        'avoid': list(rankings.top_avoid[:limit]),
+        'categories': [{
+            'type': food_type,
+            'avoid': list(rankings.avoid[food_type][:limit]),
+            'swaps': list(rankings.swaps[food_type][:limit]),
+        } for food_type in rankings.types],
+    }
@@ -1,6 +1,11 @@
 from django import forms
 from django.forms import ModelForm
-from .models import PatientProfile, UrineAnalysis, SerumLabs
+from django.utils import timezone
+
+from .models import PatientProfile, UrineAnalysis, SerumLabs, FoodDiaryEntry
+from .sweep import MAX_SWEEP_POINTS, SWEEP_RANGES
+from .diet import oxalate_rankings
+from .meal_plan import MAX_BUDGET_MG, MAX_FOODS, MAX_MENUS, MAX_PER_CATEGORY
 
 
 class PatientProfileForm(ModelForm):
@@ -106,6 +111,27 @@ class SerumLabsForm(ModelForm):
         }
 
 
+class FoodDiaryEntryForm(ModelForm):
+    """Form for logging a food in the patient's diary"""
+
+    class Meta:
+        model = FoodDiaryEntry
+        fields = ['food', 'portions', 'eaten_at']
+        widgets = {
+            'eaten_at': forms.DateTimeInput(attrs={'type': 'datetime-local'}, format='%Y-%m-%dT%H:%M'),
+        }
+        labels = {
+            'eaten_at': 'Eaten at',
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['food'].required = True
+        self.fields['food'].queryset = self.fields['food'].queryset.order_by('food')
+        self.fields['eaten_at'].input_formats = ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']
+        self.fields['eaten_at'].initial = timezone.localtime().replace(second=0, microsecond=0)
+
+
 class AcuteManagementForm(forms.Form):
     """Form for acute stone management guidance"""
 
@@ -152,6 +178,54 @@ class ManagementPlanForm(forms.Form):
         initial="Calcium Oxalate",
         label="Select the primary stone type"
     )
+    estimate_uncertainty = forms.BooleanField(
+        required=False,
+        label="Estimate how measurement error affects the findings and plan"
+    )
+
+
+class WhatIfForm(forms.Form):
+    """Form for sweeping one urine parameter across a range"""
+
+    FIELD_CHOICES = [
+        ("volume_L", "Volume (L)"),
+        ("ph", "pH"),
+        ("calcium_mg", "Calcium (mg)"),
+        ("oxalate_mg", "Oxalate (mg)"),
+        ("citrate_mg", "Citrate (mg)"),
+        ("uric_acid_mg", "Uric Acid (mg)"),
+        ("sodium_mEq", "Sodium (mEq)"),
+        ("sulfate_mmol", "Sulfate (mmol)"),
+        ("ammonium_mmol", "Ammonium (mmol)"),
+        ("cystine_mg", "Cystine (mg)"),
+    ]
+
+    field = forms.ChoiceField(
+        choices=FIELD_CHOICES, initial="volume_L", label="Parameter to vary")
+    # Left empty, the range defaults to the parameter's entry in SWEEP_RANGES
+    start = forms.FloatField(required=False, label="From")
+    stop = forms.FloatField(required=False, label="To")
+    points = forms.IntegerField(
+        required=False, min_value=2, max_value=MAX_SWEEP_POINTS, initial=1000,
+        label="Grid points")
+    stone_type = forms.ChoiceField(
+        choices=ManagementPlanForm.STONE_TYPE_CHOICES,
+        required=False,
+        initial="Calcium Oxalate",
+        label="Stone type"
+    )
+
+    def sweep_arguments(self):
+        """cleaned_data as parameter_sweep arguments, with the defaults filled in"""
+        data = self.cleaned_data
+        default_start, default_stop = SWEEP_RANGES[data['field']]
+        return {
+            'field': data['field'],
+            'start': default_start if data['start'] is None else data['start'],
+            'stop': default_stop if data['stop'] is None else data['stop'],
+            'points': data['points'] or 1000,
+            'stone_type': data['stone_type'] or "Calcium Oxalate",
+        }
 
 
 class OxalateSearchForm(forms.Form):
@@ -166,3 +240,46 @@ class OxalateSearchForm(forms.Form):
         }),
         label="Search for a food item or category:"
     )
+
+
+class MealPlanForm(forms.Form):
+    """Form for planning menus within a daily oxalate budget"""
+
+    budget_mg = forms.FloatField(
+        min_value=0, max_value=MAX_BUDGET_MG, initial=50, label="Daily oxalate budget (mg)")
+    categories = forms.MultipleChoiceField(
+        required=False,
+        widget=forms.CheckboxSelectMultiple,
+        label="Food categories (all if none selected)"
+    )
+    exclude = forms.CharField(
+        max_length=500,
+        required=False,
+        widget=forms.TextInput(attrs={'placeholder': 'e.g. Banana, Cabbage'}),
+        label="Foods to leave out (comma-separated)"
+    )
+    max_foods = forms.IntegerField(
+        required=False, min_value=1, max_value=MAX_FOODS, initial=8, label="Foods per menu")
+    per_category = forms.IntegerField(
+        required=False, min_value=1, max_value=MAX_PER_CATEGORY, initial=2,
+        label="Foods per category")
+    menus = forms.IntegerField(
+        required=False, min_value=1, max_value=MAX_MENUS, initial=3, label="Menus")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Categories come from the in-process food rankings, not a query
+        self.fields['categories'].choices = [
+            (food_type, food_type) for food_type in sorted(oxalate_rankings().ascending)]
+
+    def plan_arguments(self):
+        """cleaned_data as plan_meals arguments, with the defaults filled in"""
+        data = self.cleaned_data
+        return {
+            'budget_mg': data['budget_mg'],
+            'categories': data['categories'] or None,
+            'exclude': [food.strip() for food in data['exclude'].split(',') if food.strip()],
+            'max_foods': data['max_foods'] or 8,
+            'per_category': data['per_category'] or 2,
+            'menus': data['menus'] or 3,
+        }
@@ -0,0 +1,518 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+import inspect
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from kidney_stones_app.batch import (
+    URINE_FIELDS, SERUM_FIELDS, interpret_24hr_urine_batch,
+    generate_management_plan_batch, expand_plans, finding_keys,
+)
+from kidney_stones_app.supersaturation import relative_supersaturation, supersaturation_for_panel
+from kidney_stones_app.uncertainty import measurement_uncertainty, cohort_uncertainty
+from kidney_stones_app.similarity import SimilarityIndex, similarity_features
+from kidney_stones_app.diet import OxalateRankings, RankedFood
+from kidney_stones_app.meal_plan import plan_meals
+from kidney_stones_app.parallel import interpret_cohort
+from kidney_stones_app.columnar import load_urine_columns
+from kidney_stones_app.models import PatientProfile, UrineAnalysis, SerumLabs
+from kidney_stones_app.stone_type import STONE_TYPE_CLASSES, feature_matrix, train_stone_type_model
+from kidney_stones_engine import rules, tracing
+from kidney_stones_engine.rules import RuleSet
+from kidney_stones_app.services import (
+    UrineProfile, SerumPanel, PatientContext, UrineFindings, evaluate_24hr_urine,
+    render_findings, generate_management_plan,
+)
+
+
+STONE_TYPES = ["Calcium Oxalate", "Calcium Phosphate", "Uric Acid",
+               "Struvite", "Cystine", "Drug-induced", "Unknown"]
+CONDITIONS = ["Renal Tubular Acidosis", "Malabsorption (IBD, Bariatric Surgery, etc.)",
+              "chronic_diarrhea", "Gout"]
+MEDICATIONS = ["Topiramate", "Acetazolamide", "Hydrochlorothiazide"]
+
+
+def random_cohort(rows, seed=0):
+    """Random panels drawn from the ranges offered by UrineAnalysisForm and SerumLabsForm"""
+    rng = np.random.default_rng(seed)
+    urine = {
+        'volume_L': rng.integers(5, 26, rows) / 10,
+        'ph': rng.integers(45, 81, rows) / 10,
+        'calcium_mg': rng.integers(0, 1001, rows),
+        'oxalate_mg': rng.integers(0, 101, rows),
+        'phosphorus_mg': rng.integers(0, 1001, rows),
+        'uric_acid_mg': rng.integers(0, 1001, rows),
+        'sodium_mEq': rng.integers(0, 301, rows),
+        'potassium_mEq': rng.integers(0, 301, rows),
+        'magnesium_mg': rng.integers(0, 101, rows),
+        'sulfate_mmol': rng.integers(0, 101, rows),
+        'ammonium_mmol': rng.integers(0, 101, rows),
+        'citrate_mg': rng.integers(0, 1001, rows),
+        'cystine_mg': rng.integers(0, 101, rows),
+    }
+    serum = {
+        'calcium_mg_dL': rng.integers(80, 120, rows) / 10,
+        'intact_pth_pg_mL': rng.integers(0, 301, rows),
+        'bicarbonate_mEq_L': rng.integers(15, 30, rows),
+        'potassium_mEq_L': rng.integers(25, 55, rows) / 10,
+        'creatinine_mg_dL': rng.integers(5, 30, rows) / 10,
+    }
+    conditions = [
+        [c for c in CONDITIONS if rng.random() < 0.15] for _ in range(rows)]
+    medications = [
+        [m for m in MEDICATIONS if rng.random() < 0.1] for _ in range(rows)]
+    stone_types = rng.choice(np.array(STONE_TYPES, dtype=object), rows)
+    return urine, serum, conditions, medications, stone_types
+
+
+# A table with overlapping sex and age bands, denser than any real one
+BENCHMARK_REFERENCE_RANGES = [
+    {'sex': 'Male', 'thresholds': {'uric_acid_mg_max': 800, 'calcium_mg_max': 200}},
+    {'sex': 'Female', 'thresholds': {'citrate_mg_min': 550}},
+] + [
+    {'age_min': start, 'age_max': start + 10,
+     'thresholds': {'volume_L_min': 2.0 + start / 100, 'oxalate_mg_max': 40 + start // 10}}
+    for start in range(0, 100, 10)
+] + [
+    {'sex': 'Female', 'age_min': 50, 'thresholds': {'calcium_mg_max': 180}},
+]
+
+
+def cohort_records(urine, serum, conditions, medications):
+    """Engine records for every row of a random_cohort"""
+    urine_rows = list(map(UrineProfile._make,
+                          zip(*(urine[field].tolist() for field in URINE_FIELDS))))
+    serum_rows = list(map(SerumPanel._make,
+                          zip(*(serum[field].tolist() for field in SERUM_FIELDS))))
+    patients = [PatientContext(frozenset(conditions[i]), frozenset(medications[i]))
+                for i in range(len(urine_rows))]
+    return urine_rows, serum_rows, patients
+
+
+def without_tracing_hooks(function):
+    """
+    Recompiles an engine function with its tracing hook lines removed, as a
+    baseline for the cost of the disabled hooks.
+    """
+    lines = []
+    skip_next = False
+    for line in inspect.getsource(function).splitlines(keepends=True):
+        stripped = line.strip()
+        if skip_next:
+            skip_next = False
+        elif stripped == 'if tracer is not None:':
+            skip_next = True
+        elif stripped != 'tracer = _tracer':
+            lines.append(line)
+    namespace = dict(vars(rules))
+    exec(compile(''.join(lines), inspect.getsourcefile(function), 'exec'), namespace)
+    return namespace[function.__name__]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the clinical services layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=['batch', 'supersaturation', 'tracing', 'reference_ranges',
+                                     'uncertainty', 'stone_type', 'similarity', 'meal_plan',
+                                     'parallel', 'loader'],
+                            help='Benchmark suite to run')
+        parser.add_argument('--rows', type=int, default=None,
+                            help='Number of synthetic panels (default depends on the suite)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Repeats per variant, best time reported')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes for the cohort suites (default: all cores)')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Replace a leftover test database of the loader suite without asking')
+
+    def handle(self, *args, **options):
+        getattr(self, f"bench_{options['suite']}")(options)
+
+    def report(self, label, rows, seconds):
+        self.stdout.write(
+            f'{label:<28} {rows:>9} rows {seconds * 1000:>10.1f} ms {rows / seconds:>14,.0f} rows/s')
+
+    def bench_batch(self, options):
+        """Scalar loop versus vectorized batch for interpretation and plan generation"""
+        rows = options['rows'] or 50000
+        urine, serum, conditions, medications, stone_types = random_cohort(
+            rows, options['seed'])
+
+        start = time.perf_counter()
+        codes = interpret_24hr_urine_batch(urine, conditions)
+        plan_ids, plan_table = generate_management_plan_batch(
+            stone_types, codes, conditions, medications, serum)
+        self.report('batch', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        plans = expand_plans(plan_ids, plan_table)
+        self.report('batch + expand_plans', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        urine_rows, serum_rows, patients = cohort_records(urine, serum, conditions, medications)
+        self.report('records from columns', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(rows):
+            evaluate_24hr_urine(urine_rows[i], patients[i]).interpretation().keys()
+        self.report('scalar findings only', rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        interpretations = []
+        scalar_plans = []
+        for i in range(rows):
+            findings = evaluate_24hr_urine(urine_rows[i], patients[i])
+            interpretations.append(render_findings(findings))
+            scalar_plans.append(generate_management_plan(
+                stone_types[i], findings, patients[i], serum_rows[i]))
+        self.report('scalar loop', rows, time.perf_counter() - start)
+
+        mismatches = 0
+        for i in range(rows):
+            expected_keys = [k for k in interpretations[i] if k != 'supersaturation_targets']
+            rendered = render_findings(UrineFindings(int(codes[i]), urine_rows[i]))
+            if (expected_keys != finding_keys(int(codes[i])) or rendered != interpretations[i]
+                    or scalar_plans[i] != plans[i]):
+                mismatches += 1
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(
+                f'{mismatches} rows differ from the scalar services'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Batch output matches the scalar services on all {rows} rows'))
+
+    def bench_supersaturation(self, options):
+        """Vectorized ion-activity solver over a cohort versus one panel at a time"""
+        rows = options['rows'] or 100000
+        urine = random_cohort(rows, options['seed'])[0]
+
+        for tol in (1e-6, 1e-9, 1e-12):
+            start = time.perf_counter()
+            result = relative_supersaturation(urine, tol=tol)
+            self.report(f'vectorized tol={tol:g}', rows, time.perf_counter() - start)
+            self.stdout.write(
+                f"{'':<28} {result['iterations']} iterations, "
+                f"{result['converged'].mean():.2%} converged")
+
+        single_rows = min(rows, 1000)
+        panels = [{field: urine[field][i].item() for field in urine} for i in range(single_rows)]
+        start = time.perf_counter()
+        for panel in panels:
+            supersaturation_for_panel(panel)
+        self.report('single panel calls', single_rows, time.perf_counter() - start)
+
+    def bench_tracing(self, options):
+        """Scalar rules with tracing disabled, with the hooks compiled out, and enabled"""
+        rows = options['rows'] or 20000
+        urine, serum, conditions, medications, stone_types = random_cohort(
+            rows, options['seed'])
+        urine_rows, serum_rows, patients = cohort_records(urine, serum, conditions, medications)
+        stone_types = stone_types.tolist()
+
+        def run(evaluate, plan_from_conditions):
+            start = time.perf_counter()
+            for i in range(rows):
+                findings = evaluate(urine_rows[i], patients[i])
+                plan_from_conditions(
+                    stone_types[i], rules.plan_conditions(findings, patients[i], serum_rows[i]))
+            return time.perf_counter() - start
+
+        unhooked = (without_tracing_hooks(rules.evaluate_24hr_urine),
+                    without_tracing_hooks(rules.plan_from_conditions))
+        hooked = (rules.evaluate_24hr_urine, rules.plan_from_conditions)
+
+        # Interleaved repeats, best of each, so machine noise hits both alike
+        tracing.disable()
+        best_unhooked = best_disabled = float('inf')
+        for _ in range(options['repeat']):
+            best_unhooked = min(best_unhooked, run(*unhooked))
+            best_disabled = min(best_disabled, run(*hooked))
+        self.report('hooks compiled out', rows, best_unhooked)
+        self.report('tracing disabled', rows, best_disabled)
+
+        tracer = tracing.enable()
+        try:
+            self.report('tracing enabled', rows, run(*hooked))
+        finally:
+            tracing.disable()
+
+        overhead = best_disabled / best_unhooked - 1
+        self.stdout.write(
+            f'Disabled tracing overhead: {overhead:+.2%} '
+            f'({(best_disabled - best_unhooked) / rows * 1e9:+.0f} ns per panel)')
+        snapshot = tracer.snapshot()
+        self.stdout.write(
+            f"Traced {snapshot['urine']['calls']} urine and {snapshot['plan']['calls']} plan calls")
+
+    def bench_reference_ranges(self, options):
+        """Per-request and batch cost of age/sex reference-range lookups"""
+        rows = options['rows'] or 20000
+        urine, serum, conditions, medications, stone_types = random_cohort(
+            rows, options['seed'])
+        urine_rows, serum_rows, patients = cohort_records(urine, serum, conditions, medications)
+        stone_types = stone_types.tolist()
+        rng = np.random.default_rng(options['seed'])
+        ages = rng.integers(18, 95, rows)
+        genders = rng.choice(np.array(['Male', 'Female', 'Other'], dtype=object), rows)
+        patients = [patient._replace(age=int(age), gender=gender)
+                    for patient, age, gender in zip(patients, ages, genders)]
+
+        flat = RuleSet('flat')
+        ranged = RuleSet('ranged', reference_ranges=BENCHMARK_REFERENCE_RANGES)
+        self.stdout.write(f'{len(ranged.variants)} compiled variants from '
+                          f'{len(BENCHMARK_REFERENCE_RANGES)} reference ranges')
+
+        def run(rule_set):
+            start = time.perf_counter()
+            for i in range(rows):
+                findings = rules.evaluate_24hr_urine(urine_rows[i], patients[i], rule_set)
+                rules.generate_management_plan(stone_types[i], findings, patients[i], serum_rows[i])
+            return time.perf_counter() - start
+
+        best_flat = best_ranged = float('inf')
+        for _ in range(options['repeat']):
+            best_flat = min(best_flat, run(flat))
+            best_ranged = min(best_ranged, run(ranged))
+        self.report('scalar, no ranges', rows, best_flat)
+        self.report('scalar, reference ranges', rows, best_ranged)
+        self.stdout.write(
+            f'Added per-request latency: {(best_ranged - best_flat) / rows * 1e9:+.0f} ns '
+            f'({best_ranged / best_flat - 1:+.2%})')
+
+        start = time.perf_counter()
+        for patient in patients:
+            ranged.for_patient(patient.age, patient.gender)
+        self.report('for_patient lookups', rows, time.perf_counter() - start)
+
+        for label, rule_set in (('batch, no ranges', flat), ('batch, reference ranges', ranged)):
+            start = time.perf_counter()
+            interpret_24hr_urine_batch(urine, conditions, rule_set, ages, genders)
+            self.report(label, rows, time.perf_counter() - start)
+
+    def bench_uncertainty(self, options):
+        """Monte Carlo uncertainty per patient, and over a cohort serially and in a process pool"""
+        rows = options['rows'] or 200
+        urine, serum, conditions, medications, stone_types = random_cohort(
+            rows, options['seed'])
+        urine_rows, serum_rows, patients = cohort_records(urine, serum, conditions, medications)
+        cohort = list(zip(urine_rows, patients, serum_rows, stone_types.tolist()))
+
+        best = float('inf')
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            measurement_uncertainty(*cohort[0], seed=options['seed'])
+            best = min(best, time.perf_counter() - start)
+        self.stdout.write(f'One patient, {settings.UNCERTAINTY["SAMPLES"]} samples: '
+                          f'{best * 1000:.1f} ms')
+
+        start = time.perf_counter()
+        serial = cohort_uncertainty(cohort, seed=options['seed'], workers=1)
+        self.report('cohort, 1 worker', rows, time.perf_counter() - start)
+
+        workers = options['workers'] or os.cpu_count()
+        start = time.perf_counter()
+        pooled = cohort_uncertainty(cohort, seed=options['seed'], workers=workers)
+        self.report(f'cohort, {workers} workers', rows, time.perf_counter() - start)
+        if pooled != serial:
+            self.stdout.write(self.style.ERROR('Pooled results differ from the serial run'))
+
+    def bench_parallel(self, options):
+        """Cohort interpretation and plans on 1 to --workers cores, through shared memory"""
+        rows = options['rows'] or 1000000
+        urine, serum, conditions, medications, stone_types = random_cohort(
+            rows, options['seed'])
+        rng = np.random.default_rng(options['seed'])
+        ages = rng.integers(18, 90, rows).astype(float)
+        genders = rng.choice(np.array(['Male', 'Female'], dtype=object), rows)
+
+        baseline = None
+        for workers in range(1, (options['workers'] or os.cpu_count()) + 1):
+            best = float('inf')
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                result = interpret_cohort(urine, conditions, medications, stone_types, serum,
+                                          ages, genders, workers=workers)
+                best = min(best, time.perf_counter() - start)
+            if baseline is None:
+                baseline = best, result[0], expand_plans(*result[1:])
+            self.report(f'{workers} workers ({baseline[0] / best:.2f}x)', rows, best)
+            if (not np.array_equal(result[0], baseline[1])
+                    or expand_plans(*result[1:]) != baseline[2]):
+                self.stdout.write(self.style.ERROR(f'{workers} workers differ from 1 worker'))
+
+    def bench_loader(self, options):
+        """
+        Columnar loading of every panel with patient and serum fields, against
+        model instances, on synthetic rows inserted into a throwaway test
+        database (created like manage.py test does, never the configured one)
+        """
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        try:
+            self.load_synthetic_panels(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def load_synthetic_panels(self, options):
+        rows = options['rows'] or 200000
+        urine, serum, conditions, medications, _ = random_cohort(rows, options['seed'])
+        rng = np.random.default_rng(options['seed'])
+        patient_fields = ('age', 'gender', 'bmi', 'medical_conditions', 'medications')
+
+        start = time.perf_counter()
+        patients = PatientProfile.objects.bulk_create(
+            PatientProfile(age=int(age), gender=gender, num_prior_stones=1, bmi=25,
+                           fluid_intake_L=2, medical_conditions=conditions[i],
+                           medications=medications[i])
+            for i, (age, gender) in enumerate(zip(
+                rng.integers(18, 90, rows // 4 + 1),
+                rng.choice(['Male', 'Female'], rows // 4 + 1))))
+        patient_ids = [patient.id for patient in patients]
+        SerumLabs.objects.bulk_create(
+            (SerumLabs(patient_profile_id=patient_ids[i],
+                       **{field: serum[field][i].item() for field in SERUM_FIELDS})
+             for i in range(0, len(patient_ids), 2)), batch_size=5000)
+        owners = rng.integers(0, len(patient_ids), rows).tolist()
+        values = [urine[field].tolist() for field in URINE_FIELDS]
+        UrineAnalysis.objects.bulk_create(
+            (UrineAnalysis(patient_profile_id=patient_ids[owners[i]],
+                           **{field: column[i] for field, column in zip(URINE_FIELDS, values)})
+             for i in range(rows)), batch_size=5000)
+        self.stdout.write(f'Inserted {rows} panels in {time.perf_counter() - start:.1f} s')
+
+        start = time.perf_counter()
+        columns = load_urine_columns(patient_fields=patient_fields, serum_fields=SERUM_FIELDS)
+        self.report('columnar loader', rows, time.perf_counter() - start)
+        size = sum(array.nbytes for array in columns.values())
+        del columns
+
+        tracemalloc.start()
+        load_urine_columns(patient_fields=patient_fields, serum_fields=SERUM_FIELDS)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write(f'Arrays {size / 2**20:.1f} MiB, peak while loading '
+                          f'{peak / 2**20:.1f} MiB ({peak / size:.1f}x)')
+
+        start = time.perf_counter()
+        hydrated = np.array([[float(getattr(panel, field)) for field in URINE_FIELDS]
+                             for panel in UrineAnalysis.objects.order_by('id').iterator()])
+        self.report('model instances', rows, time.perf_counter() - start)
+        del hydrated
+
+    def bench_stone_type(self, options):
+        """Stone-type model training and batch/single-panel inference"""
+        rows = options['rows'] or 200000
+        urine, serum, _, _, _ = random_cohort(rows, options['seed'])
+        rng = np.random.default_rng(options['seed'])
+        labels = rng.choice(np.array(STONE_TYPE_CLASSES, dtype=object), rows)
+
+        start = time.perf_counter()
+        features = feature_matrix(urine, serum)
+        self.report('feature matrix', rows, time.perf_counter() - start)
+
+        training_rows = min(rows, 20000)
+        start = time.perf_counter()
+        model = train_stone_type_model(features[:training_rows], labels[:training_rows])
+        self.report('training (500 iterations)', training_rows, time.perf_counter() - start)
+
+        best = float('inf')
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            model.predict(features)
+            best = min(best, time.perf_counter() - start)
+        self.report('batch inference', rows, best)
+
+        urine_row = UrineProfile._make(urine[field][0].item() for field in URINE_FIELDS)
+        serum_row = SerumPanel._make(serum[field][0].item() for field in SERUM_FIELDS)
+        single_rows = min(rows, 10000)
+        start = time.perf_counter()
+        for _ in range(single_rows):
+            model.predict_one(urine_row, serum_row)
+        self.report('predict_one', single_rows, time.perf_counter() - start)
+
+    def bench_meal_plan(self, options):
+        """Meal planner over a synthetic oxalate table, per budget and menu size"""
+        rows = options['rows'] or 5000
+        rng = np.random.default_rng(options['seed'])
+        oxalate = np.round(rng.lognormal(2, 1.5, rows), 2)
+        types = rng.integers(0, max(rows // 80, 1), rows)
+        start = time.perf_counter()
+        rankings = OxalateRankings(
+            RankedFood(f'Food {index}', f'Category {food_type}', value, '1 cup (raw)', 'Low')
+            for index, (food_type, value) in enumerate(zip(types.tolist(), oxalate.tolist())))
+        self.stdout.write(f'ranking {rows} foods in {len(rankings.ascending)} categories '
+                          f'{(time.perf_counter() - start) * 1000:.1f} ms')
+
+        for budget, max_foods, per_category in ((50, 8, 2), (100, 12, 3), (500, 20, 5)):
+            best = float('inf')
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                plan = plan_meals(budget, max_foods=max_foods, per_category=per_category, menus=3,
+                                  rankings=rankings)
+                best = min(best, time.perf_counter() - start)
+            totals = ', '.join(f"{menu['oxalate_mg']:g} mg" for menu in plan['menus'])
+            self.stdout.write(
+                f'{budget:>4} mg, {max_foods:>2} foods, {per_category} per category: '
+                f'3 menus in {best * 1000:.1f} ms ({totals})')
+
+    def bench_similarity(self, options):
+        """KD-tree build and kNN queries against a brute-force scan"""
+        rows = options['rows'] or 1000000
+        urine, serum, _, _, _ = random_cohort(rows, options['seed'])
+        rng = np.random.default_rng(options['seed'])
+        patients = {
+            'age': rng.integers(18, 90, rows), 'num_prior_stones': rng.integers(0, 6, rows),
+            'bmi': rng.uniform(18, 40, rows),
+            'gender': rng.choice(np.array(['Male', 'Female'], dtype=object), rows),
+        }
+        start = time.perf_counter()
+        uniform = similarity_features({**urine, **serum, **patients})
+        self.report('feature vectors', rows, time.perf_counter() - start)
+
+        # Real panels are correlated: model them as noisy copies of a few
+        # thousand phenotypes, next to the independent-uniform worst case
+        clustered = uniform[rng.integers(0, 2000, rows)] + rng.normal(0, 0.25, uniform.shape)
+        for label, points in (('clustered', clustered), ('uniform', uniform)):
+            self.bench_knn(label, points, rng)
+
+    def bench_knn(self, label, points, rng, k=20, queries=50):
+        rows = len(points)
+        start = time.perf_counter()
+        # Room for the pending panels below without a rebuild
+        index = SimilarityIndex.from_points(np.arange(rows), points, min_rebuild=1000)
+        self.report(f'{label}: KD-tree build', rows, time.perf_counter() - start)
+
+        vectors = points[rng.integers(0, rows, queries)] + rng.normal(0, 0.1, (queries, points.shape[1]))
+        start = time.perf_counter()
+        results = [index.query(vector, k) for vector in vectors]
+        self.stdout.write(f'{label}: kNN query (k={k}) '
+                          f'{(time.perf_counter() - start) / queries * 1000:.2f} ms')
+
+        for offset in range(1000):
+            index.add(rows + offset, points[offset])
+        start = time.perf_counter()
+        for vector in vectors:
+            index.query(vector, k)
+        self.stdout.write(f'{label}: kNN query with 1000 pending panels '
+                          f'{(time.perf_counter() - start) / queries * 1000:.2f} ms')
+
+        start = time.perf_counter()
+        mismatches = 0
+        for vector, result in zip(vectors[:10], results):
+            difference = points - vector
+            distances = np.einsum('ij,ij->i', difference, difference)
+            expected = np.sort(np.argpartition(distances, k)[:k])
+            mismatches += not np.array_equal(expected, np.sort([id_ for id_, _ in result]))
+        self.stdout.write(f'{label}: brute-force scan '
+                          f'{(time.perf_counter() - start) / 10 * 1000:.2f} ms per query')
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{mismatches} queries differ from the scan'))
+        else:
+            self.stdout.write(self.style.SUCCESS('KD-tree results match the brute-force scan'))
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+from kidney_stones_app.similarity import build_index
+
+
+class Command(BaseCommand):
+    help = 'Build the similar-patient index from every stored urine analysis and save it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='Snapshot file (default: settings.SIMILARITY_INDEX["PATH"])')
+
+    def handle(self, *args, **options):
+        config = settings.SIMILARITY_INDEX
+        output = options['output'] or config['PATH']
+        if not output:
+            raise CommandError('Pass --output or set SIMILARITY_INDEX_PATH')
+        started = time.perf_counter()
+        index = build_index(output, leaf_size=config['LEAF_SIZE'],
+                            rebuild_ratio=config['REBUILD_RATIO'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {len(index)} panels in {time.perf_counter() - started:.1f} s, '
+            f'saved to {output}'))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from kidney_stones_app.models import OxalateContent
+from kidney_stones_app.diet import refresh_oxalate_rankings
 import json
 
 
@@ -45,6 +46,10 @@ class Command(BaseCommand):
             # Bulk create for efficiency
             OxalateContent.objects.bulk_create(oxalate_objects)
 
+            # Rank the foods for diet guidance now rather than on first use
+            rankings = refresh_oxalate_rankings()
+            self.stdout.write(f'Ranked foods in {len(rankings.types)} categories with high-oxalate items')
+
             self.stdout.write(
                 self.style.SUCCESS(
                     f'Successfully loaded {len(food_data_list)} oxalate content records')
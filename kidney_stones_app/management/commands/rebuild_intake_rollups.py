@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+import time
+
+from kidney_stones_app.diary import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily and weekly oxalate intake rollups from the food diary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, action='append', dest='patients',
+                            help='Only this patient id (repeatable; default: every patient)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = rebuild_rollups(options['patients'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {rows} rollup rows in {time.perf_counter() - started:.1f} s'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+import time
+
+from kidney_stones_app.quantiles import rebuild_sketches
+
+
+class Command(BaseCommand):
+    help = 'Recompute the population percentile sketches from every stored urine analysis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Panels read per query (default: 50000)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = rebuild_sketches(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Sketched {count} panels in {time.perf_counter() - started:.1f} s'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+import time
+
+from kidney_stones_app.trends import rebuild_trends
+
+
+class Command(BaseCommand):
+    help = 'Recompute the visit-to-visit urine trends of every patient (e.g. after a rule change)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, action='append', dest='patients',
+                            help='Only this patient id (repeatable; default: every patient)')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Patients per transaction (default: 2000)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = rebuild_trends(options['patients'], batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {rows} trend rows in {elapsed:.1f} s, {rows / max(elapsed, 1e-9):,.0f} panels/s'))
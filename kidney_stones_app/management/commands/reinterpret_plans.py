@@ -0,0 +1,106 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F
+import os
+import time
+
+from kidney_stones_app.cache import cached_interpretation, cached_management_plan
+from kidney_stones_app.models import ManagementPlan
+from kidney_stones_app.services import (
+    URINE_FIELDS, SERUM_FIELDS, UrineProfile, SerumPanel, PatientContext, active_rule_set,
+)
+
+
+# Everything a plan is computed from, fetched with the plan in one query.
+# The related field names do not clash, so each record type can be built
+# straight from the row with from_values()
+PLAN_INPUTS = {
+    **{field: F(f'urine_analysis__{field}') for field in URINE_FIELDS},
+    **{field: F(f'serum_labs__{field}') for field in SERUM_FIELDS},
+    **{field: F(f'patient_profile__{field}')
+       for field in ('medical_conditions', 'medications', 'age', 'gender')},
+}
+
+
+class Command(BaseCommand):
+    help = ('Re-interpret management plans stored under another rule version, '
+            'in keyset-paginated batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Only plans with a larger id (to resume by hand)')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File holding the last processed id; read on start, '
+                                 'rewritten after every batch')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Stop after this many plans')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count stale plans per stored rule version')
+
+    def handle(self, *args, **options):
+        stamp = active_rule_set().stamp
+        stale = ManagementPlan.objects.exclude(rule_version=stamp)
+
+        if options['dry_run']:
+            for row in stale.order_by().values('rule_version').annotate(plans=Count('id')):
+                self.stdout.write(f"{row['rule_version'] or '(none)':<48} {row['plans']:>10}")
+            self.stdout.write(f'Current rule version: {stamp}')
+            return
+
+        last_id = max(options['after_id'], self.read_checkpoint(options['checkpoint']))
+        total = stale.filter(id__gt=last_id).count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        self.stdout.write(f'{total} stale plans after id {last_id}, re-interpreting with {stamp}')
+
+        done = 0
+        started = time.perf_counter()
+        while done < total:
+            size = min(options['batch_size'], total - done)
+            rows = list(stale.filter(id__gt=last_id).order_by('id')
+                        .values('id', 'stone_type', **PLAN_INPUTS)[:size])
+            if not rows:
+                break
+            updates = [self.reinterpret(row) for row in rows]
+            with transaction.atomic():
+                ManagementPlan.objects.bulk_update(
+                    updates, ['urine_interpretation', 'recommendations', 'rule_version'])
+            last_id = rows[-1]['id']
+            self.write_checkpoint(options['checkpoint'], last_id)
+
+            done += len(rows)
+            seconds = time.perf_counter() - started
+            self.stdout.write(f'{done}/{total} plans ({done / total:.1%}), '
+                              f'{done / seconds:,.0f} plans/s, last id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Re-interpreted {done} plans'))
+
+    def reinterpret(self, row):
+        """A ManagementPlan carrying only the id and the recomputed fields"""
+        patient = PatientContext.from_values(row)
+        serum = SerumPanel.from_values(row) if row['calcium_mg_dL'] is not None else None
+        findings, interpretation = cached_interpretation(UrineProfile.from_values(row), patient)
+        return ManagementPlan(
+            id=row['id'],
+            urine_interpretation=interpretation.as_dict(),
+            recommendations=cached_management_plan(row['stone_type'], findings, patient, serum),
+            rule_version=findings.rule_set.stamp,
+        )
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as checkpoint:
+            try:
+                return int(checkpoint.read().strip() or 0)
+            except ValueError:
+                raise CommandError(f'Checkpoint {path} does not hold a plan id')
+
+    def write_checkpoint(self, path, last_id):
+        if not path:
+            return
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as checkpoint:
+            checkpoint.write(f'{last_id}\n')
+        os.replace(temporary, path)
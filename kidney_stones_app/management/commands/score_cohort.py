@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import os
+import time
+
+from kidney_stones_app.cohort import (
+    COHORT_FORMATS, CohortFormatError, cohort_format, read_chunks, score_chunk,
+)
+from kidney_stones_app.services import active_rule_set
+
+
+class Command(BaseCommand):
+    help = ('Interpret every 24-hour urine panel of a CSV or NDJSON cohort export and '
+            'stream the findings and management plans to an NDJSON file, chunk by chunk')
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Cohort file (.csv, .ndjson or .jsonl)')
+        parser.add_argument('output', help='NDJSON file receiving one line per input row')
+        parser.add_argument('--format', choices=sorted(set(COHORT_FORMATS.values())), default=None,
+                            help='Input format (default: from the file extension)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Rows read and scored at a time')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='Input byte offset to start from (to resume by hand); '
+                                 'output is appended')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes scoring each chunk (0: all cores)')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File holding the input and output offsets reached; read on '
+                                 'start, rewritten after every chunk')
+
+    def handle(self, *args, **options):
+        path = options['input']
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        workers = options['workers'] or os.cpu_count()
+        try:
+            format = options['format'] or cohort_format(path)
+        except CohortFormatError as error:
+            raise CommandError(str(error))
+
+        offset, output_offset = self.read_checkpoint(options['checkpoint'])
+        if options['offset'] > offset:
+            offset, output_offset = options['offset'], None
+        resuming = offset > 0
+        size = os.path.getsize(path)
+        rule_set = active_rule_set()
+        self.stdout.write(f'Scoring {path} ({format}, {size:,} bytes) from byte {offset} '
+                          f'with {rule_set.stamp} on {workers} worker(s)')
+
+        done = 0
+        started = time.perf_counter()
+        # One pool for the whole run, shared by every chunk
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext()
+        with pool as executor, open(path, 'rb') as stream, \
+                open(options['output'], 'ab' if resuming else 'wb') as output:
+            if output_offset is not None:
+                # Drop whatever a run interrupted after its last checkpoint wrote
+                output.truncate(output_offset)
+            try:
+                for records, offsets, end in read_chunks(stream, format, options['chunk_size'], offset):
+                    output.write(score_chunk(records, offsets, rule_set, workers, executor))
+                    output.flush()
+                    os.fsync(output.fileno())
+                    self.write_checkpoint(options['checkpoint'], end, output.tell())
+
+                    done += len(records)
+                    seconds = time.perf_counter() - started
+                    self.stdout.write(f'{done} rows, {done / seconds:,.0f} rows/s, '
+                                      f'byte {end}/{size} ({end / max(size, 1):.1%})')
+            except CohortFormatError as error:
+                raise CommandError(f'{path}: {error}')
+
+        self.stdout.write(self.style.SUCCESS(f'Scored {done} rows into {options["output"]}'))
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return 0, None
+        with open(path) as checkpoint:
+            try:
+                offset, output_offset = map(int, checkpoint.read().split())
+            except ValueError:
+                raise CommandError(f'Checkpoint {path} does not hold an input and output offset')
+        return offset, output_offset
+
+    def write_checkpoint(self, path, offset, output_offset):
+        if not path:
+            return
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as checkpoint:
+            checkpoint.write(f'{offset} {output_offset}\n')
+        os.replace(temporary, path)
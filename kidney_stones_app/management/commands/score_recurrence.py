@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import time
+
+from kidney_stones_app.models import PatientProfile
+from kidney_stones_app.recurrence import (
+    ROKS_FIELDS, ROKS_SCORE_FIELDS, ROKS_VERSION, roks_recurrence_batch)
+
+
+class Command(BaseCommand):
+    help = ('Score the ROKS-style recurrence risk of every patient profile in '
+            'keyset-paginated batches: after a model change, or after profiles were '
+            'changed with QuerySet.update() or bulk_update(), which skip the save signal')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--stale-only', action='store_true',
+                            help=f'Only profiles not yet scored with {ROKS_VERSION}')
+        parser.add_argument('--top', type=int, default=0,
+                            help='Afterwards list this many patients with the highest 5-year risk')
+
+    def handle(self, *args, **options):
+        profiles = PatientProfile.objects.all()
+        if options['stale_only']:
+            profiles = profiles.exclude(recurrence_version=ROKS_VERSION)
+        total = profiles.count()
+        self.stdout.write(f'Scoring {total} patient profiles with {ROKS_VERSION}')
+
+        done = 0
+        last_id = 0
+        started = time.perf_counter()
+        while True:
+            rows = list(profiles.filter(id__gt=last_id).order_by('id')
+                        .values_list('id', *ROKS_FIELDS)[:options['batch_size']])
+            if not rows:
+                break
+            ids, *values = zip(*rows)
+            risks = roks_recurrence_batch(dict(zip(ROKS_FIELDS, values)))
+            updates = [
+                PatientProfile(id=patient_id, recurrence_risk_5y=risk_5y,
+                               recurrence_risk_10y=risk_10y, recurrence_version=ROKS_VERSION)
+                for patient_id, risk_5y, risk_10y in zip(ids, risks[5].tolist(), risks[10].tolist())
+            ]
+            with transaction.atomic():
+                PatientProfile.objects.bulk_update(updates, ROKS_SCORE_FIELDS)
+            last_id = ids[-1]
+
+            done += len(rows)
+            seconds = time.perf_counter() - started
+            self.stdout.write(f'{done}/{total} profiles, {done / seconds:,.0f} profiles/s')
+
+        self.stdout.write(self.style.SUCCESS(f'Scored {done} patient profiles'))
+
+        if options['top']:
+            ranked = (PatientProfile.objects.filter(recurrence_risk_5y__isnull=False)
+                      .order_by('-recurrence_risk_5y', 'id')
+                      .values_list('id', 'age', 'gender', 'recurrence_risk_5y', 'recurrence_risk_10y')
+                      [:options['top']])
+            for patient_id, age, gender, risk_5y, risk_10y in ranked:
+                self.stdout.write(f'{patient_id:>8} {age:>4} {gender:<7} '
+                                  f'{risk_5y:>7.1%} 5y {risk_10y:>7.1%} 10y')
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+import time
+
+import numpy as np
+
+from kidney_stones_app.models import ManagementPlan
+from kidney_stones_app.services import URINE_FIELDS, SERUM_FIELDS
+from kidney_stones_app.stone_type import (
+    STONE_TYPE_CLASSES, feature_matrix, train_stone_type_model,
+)
+
+
+class Command(BaseCommand):
+    help = ('Train the stone-type model from stored management plans and export it '
+            'as NumPy arrays')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='Model file (default: settings.STONE_TYPE_MODEL["PATH"])')
+        parser.add_argument('--holdout', type=float, default=0.2,
+                            help='Share of plans kept out of training to report accuracy')
+        parser.add_argument('--iterations', type=int, default=500)
+        parser.add_argument('--l2', type=float, default=1e-3)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        output = options['output'] or settings.STONE_TYPE_MODEL['PATH']
+        if not output:
+            raise CommandError('Pass --output or set STONE_TYPE_MODEL_PATH')
+
+        rows = list(
+            ManagementPlan.objects.filter(stone_type__in=STONE_TYPE_CLASSES)
+            .values_list('stone_type',
+                         *(F(f'urine_analysis__{field}') for field in URINE_FIELDS),
+                         *(F(f'serum_labs__{field}') for field in SERUM_FIELDS)))
+        if not rows:
+            raise CommandError('No management plans with a known stone type to train on')
+        labels, *values = zip(*rows)
+        urine = dict(zip(URINE_FIELDS, values[:len(URINE_FIELDS)]))
+        serum = dict(zip(SERUM_FIELDS, values[len(URINE_FIELDS):]))
+        features = feature_matrix(urine, serum)
+        labels = np.array(labels, dtype=object)
+
+        rng = np.random.default_rng(options['seed'])
+        order = rng.permutation(len(labels))
+        held_out = order[:int(len(labels) * options['holdout'])]
+        training = order[len(held_out):]
+        self.stdout.write(f'{len(training)} training and {len(held_out)} held-out plans')
+
+        started = time.perf_counter()
+        model = train_stone_type_model(
+            features[training], labels[training], l2=options['l2'],
+            iterations=options['iterations'], version=f'{len(training)}-plans')
+        self.stdout.write(f'Trained in {time.perf_counter() - started:.2f} s')
+        for name, index in (('training', training), ('held-out', held_out)):
+            if len(index):
+                accuracy = (model.predict(features[index])[0] == labels[index]).mean()
+                self.stdout.write(f'{name} accuracy: {accuracy:.1%}')
+
+        if len(held_out):
+            # The exported model is refitted on every plan
+            model = train_stone_type_model(
+                features, labels, l2=options['l2'], iterations=options['iterations'],
+                version=f'{len(labels)}-plans')
+        model.save(output)
+        self.stdout.write(self.style.SUCCESS(f'Saved stone type model to {output}'))
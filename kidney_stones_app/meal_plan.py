@@ -0,0 +1,138 @@
+"""
+Daily oxalate budget meal planner.
+
+A menu picks at most one serving of a food, a few foods per category and a
+limited number of foods overall, keeps the total oxalate within the budget
+and maximizes variety: the k-th food of a category is worth
+VARIETY_WEIGHTS[k - 1], less than the one before, so menus spread over
+categories.
+
+Foods of a category are taken cheapest first, so the k-th food of every
+category forms a "level" of equally valued candidates. Swapping a chosen food
+for a cheaper one of the same level, or the k-th food of a category for its
+missing (k-1)-th, never makes a menu worse, so the best menu takes the
+cheapest few foods of each level. The search is then a group knapsack over
+at most MAX_PER_CATEGORY levels, solved by dynamic programming over (foods,
+integer oxalate units) whatever the number of foods and categories. Further
+menus are solved again without the foods already used.
+"""
+import numpy as np
+
+from .diet import oxalate_rankings
+
+
+# Oxalate is counted in tenths of a mg; each food is rounded up, so menus
+# never exceed the budget
+OXALATE_SCALE = 10
+
+MAX_BUDGET_MG = 500
+MAX_PER_CATEGORY = 5
+MAX_FOODS = 20
+MAX_MENUS = 10
+
+# Variety score of the 1st, 2nd, ... food of a category (integers, so ties are exact)
+VARIETY_WEIGHTS = (60, 30, 20, 15, 12)
+
+
+# Variety of unreachable (foods, cost) cells; stays negative after any additions
+UNREACHABLE = -(1 << 40)
+
+
+def _menu(levels, capacity, max_foods):
+    """
+    Best menu from the levels [(costs, foods)], each sorted by increasing
+    integer oxalate cost, with at most max_foods foods. Returns the chosen
+    foods; among equally varied menus the lowest-oxalate one.
+    """
+    levels = [(costs[:max_foods], foods[:max_foods]) for costs, foods in levels]
+    # No menu costs more than its max_foods most expensive candidates
+    capacity = min(capacity, sum(sorted(cost for costs, _ in levels for cost in costs)[-max_foods:]))
+
+    # value[n, c]: best variety of n foods costing exactly c units
+    value = np.full((max_foods + 1, capacity + 1), UNREACHABLE, dtype=np.int64)
+    value[0, 0] = 0
+    choices = []
+    for weight, (costs, foods) in zip(VARIETY_WEIGHTS, levels):
+        best = value.copy()
+        choice = np.zeros(value.shape, dtype=np.int8)
+        cost = 0
+        for taken in range(1, len(foods) + 1):
+            cost += costs[taken - 1]
+            if cost > capacity:
+                break
+            candidate = value[:max_foods + 1 - taken, :capacity + 1 - cost] + weight * taken
+            target = best[taken:, cost:]
+            better = candidate > target
+            np.copyto(target, candidate, where=better)
+            choice[taken:, cost:][better] = taken
+        value = best
+        choices.append(choice)
+
+    # Most varied menu, then the lowest oxalate total, then the fewest foods
+    counts, totals = np.nonzero(value == value.max())
+    first = np.lexsort((counts, totals))[0]
+    count, total = int(counts[first]), int(totals[first])
+    menu = []
+    for (costs, foods), choice in zip(reversed(levels), reversed(choices)):
+        taken = int(choice[count, total])
+        menu.extend(foods[:taken])
+        count -= taken
+        total -= sum(costs[:taken])
+    menu.sort(key=lambda food: (food.type, food.oxalate_mg, food.food))
+    return menu
+
+
+def plan_meals(budget_mg, categories=None, exclude=(), per_category=2, max_foods=8, menus=3,
+               rankings=None):
+    """
+    Up to menus food combinations of at most max_foods foods within
+    budget_mg of oxalate, each using foods not used by the previous ones.
+    categories restricts the food types (all by default) and exclude lists
+    food names to leave out.
+    """
+    rankings = rankings or oxalate_rankings()
+    capacity = int(budget_mg * OXALATE_SCALE + 1e-9)
+    per_category = min(per_category, MAX_PER_CATEGORY)
+    types = [food_type for food_type in (categories or sorted(rankings.ascending))
+             if food_type in rankings.ascending]
+    unavailable = set(exclude)
+
+    result = []
+    for _ in range(menus):
+        # levels[k]: the (k+1)-th cheapest available food of every category
+        levels = [[] for _ in range(per_category)]
+        for food_type in types:
+            position = 0
+            for food in rankings.ascending[food_type]:
+                if food.food in unavailable:
+                    continue
+                cost = int(np.ceil(food.oxalate_mg * OXALATE_SCALE - 1e-9))
+                # Foods are ascending, so nothing further fits either
+                if cost > capacity:
+                    break
+                levels[position].append((cost, food.food, food))
+                position += 1
+                if position == per_category:
+                    break
+        levels = [level for level in levels if level]
+        if not levels:
+            break
+        for level in levels:
+            level.sort()
+        menu = _menu([([cost for cost, _, _ in level], [food for _, _, food in level])
+                      for level in levels], capacity, max_foods)
+        if not menu:
+            break
+        unavailable.update(food.food for food in menu)
+        result.append({
+            'foods': menu,
+            'oxalate_mg': round(sum(food.oxalate_mg for food in menu), 2),
+            'categories': len({food.type for food in menu}),
+        })
+
+    return {
+        'budget_mg': budget_mg,
+        'per_category': per_category,
+        'max_foods': max_foods,
+        'menus': result,
+    }
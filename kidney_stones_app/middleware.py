@@ -0,0 +1,16 @@
+from kidney_stones_engine import rulepack
+
+
+class RulePackMiddleware:
+    """
+    Picks up edits to the RULE_PACK file before each request. Every worker
+    process checks on its own, so no restart or signal is needed; a request
+    already being handled keeps the rule set it started with.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rulepack.poll()
+        return self.get_response(request)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='managementplan',
+            name='rule_version',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='RuleSet.stamp of the rules that produced this plan (empty if unknown)', max_length=128),
+        ),
+    ]
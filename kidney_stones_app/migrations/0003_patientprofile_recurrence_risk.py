@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0002_managementplan_rule_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientprofile',
+            name='recurrence_risk_10y',
+            field=models.FloatField(blank=True, help_text='Estimated probability of a symptomatic recurrence within 10 years', null=True),
+        ),
+        migrations.AddField(
+            model_name='patientprofile',
+            name='recurrence_risk_5y',
+            field=models.FloatField(blank=True, db_index=True, help_text='Estimated probability of a symptomatic recurrence within 5 years', null=True),
+        ),
+        migrations.AddField(
+            model_name='patientprofile',
+            name='recurrence_version',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='ROKS_VERSION of the stored recurrence risk (empty if not scored)', max_length=32),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0003_patientprofile_recurrence_risk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuantileSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(help_text='UrineAnalysis field name', max_length=50, unique=True)),
+                ('count', models.BigIntegerField(default=0, help_text='Number of values in the sketch')),
+                ('minimum', models.FloatField(blank=True, null=True)),
+                ('maximum', models.FloatField(blank=True, null=True)),
+                ('means', models.JSONField(default=list, help_text='Centroid means, ascending')),
+                ('weights', models.JSONField(default=list, help_text='Centroid weights')),
+                ('buffer', models.JSONField(default=list, help_text='Values not merged into centroids yet')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['field'],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:20
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0004_quantilesketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodDiaryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('food_name', models.CharField(help_text='Food item name', max_length=200)),
+                ('portions', models.DecimalField(decimal_places=2, default=1, help_text='Number of servings', max_digits=5, validators=[django.core.validators.MinValueValidator(0.01), django.core.validators.MaxValueValidator(100)])),
+                ('oxalate_mg', models.DecimalField(decimal_places=2, help_text='Oxalate of the portion in mg', max_digits=8)),
+                ('eaten_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('food', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='diary_entries', to='kidney_stones_app.oxalatecontent')),
+                ('patient_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='food_diary', to='kidney_stones_app.patientprofile')),
+            ],
+            options={
+                'verbose_name_plural': 'Food diary entries',
+                'ordering': ['-eaten_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OxalateIntakeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Day'), ('week', 'Week')], max_length=4)),
+                ('start', models.DateField(help_text='Day, or Monday of the week')),
+                ('oxalate_mg', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('entries', models.IntegerField(default=0)),
+                ('patient_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='intake_rollups', to='kidney_stones_app.patientprofile')),
+            ],
+            options={
+                'ordering': ['patient_profile', 'period', '-start'],
+                'constraints': [models.UniqueConstraint(fields=('patient_profile', 'period', 'start'), name='unique_intake_rollup')],
+            },
+        ),
+    ]
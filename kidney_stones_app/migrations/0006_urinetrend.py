@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0005_food_diary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UrineTrend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visit', models.PositiveIntegerField(help_text="1 for the patient's first urine analysis")),
+                ('collected_at', models.DateTimeField(help_text='created_at of the urine analysis')),
+                ('days_since_previous', models.FloatField(blank=True, null=True)),
+                ('values', models.JSONField(default=dict, help_text='Urine values of this panel')),
+                ('deltas', models.JSONField(default=dict, help_text='Change of each value since the previous panel')),
+                ('slopes', models.JSONField(default=dict, help_text='Least-squares change per year of each value over all panels so far')),
+                ('sums', models.JSONField(default=dict)),
+                ('findings', models.BigIntegerField(default=0, help_text='Finding bits of this panel')),
+                ('findings_new', models.BigIntegerField(default=0, help_text='Findings absent from the previous panel')),
+                ('findings_resolved', models.BigIntegerField(default=0, help_text='Findings of the previous panel that are gone')),
+                ('rule_version', models.CharField(blank=True, default='', max_length=128)),
+                ('patient_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='urine_trends', to='kidney_stones_app.patientprofile')),
+                ('previous', models.ForeignKey(blank=True, help_text="The patient's previous urine analysis (empty for the first)", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='kidney_stones_app.urineanalysis')),
+                ('urine_analysis', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trend', to='kidney_stones_app.urineanalysis')),
+            ],
+            options={
+                'ordering': ['patient_profile', 'visit'],
+                'indexes': [models.Index(fields=['patient_profile', 'visit'], name='kidney_ston_patient_d64d47_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0006_urinetrend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serumlabs',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='urineanalysis',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kidney_stones_app', '0007_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingQuantileValues',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('panel_id', models.BigIntegerField(help_text='UrineAnalysis the values come from')),
+                ('values', models.JSONField(help_text='Urine field name -> value')),
+            ],
+        ),
+    ]
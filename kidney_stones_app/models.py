@@ -48,6 +48,17 @@ class PatientProfile(models.Model):
         help_text="Daily fluid intake in liters"
     )
 
+    # ROKS-style recurrence risk, see kidney_stones_app.recurrence
+    recurrence_risk_5y = models.FloatField(
+        null=True, blank=True, db_index=True,
+        help_text="Estimated probability of a symptomatic recurrence within 5 years")
+    recurrence_risk_10y = models.FloatField(
+        null=True, blank=True,
+        help_text="Estimated probability of a symptomatic recurrence within 10 years")
+    recurrence_version = models.CharField(
+        max_length=32, blank=True, default='', db_index=True,
+        help_text="ROKS_VERSION of the stored recurrence risk (empty if not scored)")
+
     class Meta:
         ordering = ['-created_at']
 
@@ -60,6 +71,7 @@ class UrineAnalysis(models.Model):
     patient_profile = models.ForeignKey(
         PatientProfile, on_delete=models.CASCADE, related_name='urine_analyses')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     # Volume and pH
     volume_L = models.DecimalField(
@@ -137,6 +149,7 @@ class SerumLabs(models.Model):
     patient_profile = models.ForeignKey(
         PatientProfile, on_delete=models.CASCADE, related_name='serum_labs')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     calcium_mg_dL = models.DecimalField(
         max_digits=4, decimal_places=1,
@@ -224,9 +237,124 @@ class ManagementPlan(models.Model):
         default=dict, help_text="Urine analysis interpretation")
     recommendations = models.JSONField(
         default=list, help_text="Management recommendations")
+    rule_version = models.CharField(
+        max_length=128, blank=True, default='', db_index=True,
+        help_text="RuleSet.stamp of the rules that produced this plan (empty if unknown)")
 
     class Meta:
         ordering = ['-created_at']
 
     def __str__(self):
         return f"Management Plan {self.id} - {self.stone_type} for {self.patient_profile}"
+
+
+class QuantileSketch(models.Model):
+    """Quantile sketch (t-digest) of one UrineAnalysis field over all stored panels"""
+    field = models.CharField(max_length=50, unique=True, help_text="UrineAnalysis field name")
+    count = models.BigIntegerField(default=0, help_text="Number of values in the sketch")
+    minimum = models.FloatField(null=True, blank=True)
+    maximum = models.FloatField(null=True, blank=True)
+    means = models.JSONField(default=list, help_text="Centroid means, ascending")
+    weights = models.JSONField(default=list, help_text="Centroid weights")
+    buffer = models.JSONField(default=list, help_text="Values not merged into centroids yet")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['field']
+
+    def __str__(self):
+        return f"Quantile Sketch {self.field} ({self.count} values)"
+
+
+class PendingQuantileValues(models.Model):
+    """Values of a saved panel not folded into the QuantileSketch rows yet"""
+    panel_id = models.BigIntegerField(help_text="UrineAnalysis the values come from")
+    values = models.JSONField(help_text="Urine field name -> value")
+
+    def __str__(self):
+        return f"Pending Quantile Values of panel {self.panel_id}"
+
+
+class FoodDiaryEntry(models.Model):
+    """Food eaten by a patient, with the oxalate of the portion at the time it was logged"""
+    patient_profile = models.ForeignKey(
+        PatientProfile, on_delete=models.CASCADE, related_name='food_diary')
+    # Oxalate data is reloaded by replacing every row, so the entry keeps its own copy
+    food = models.ForeignKey(
+        OxalateContent, on_delete=models.SET_NULL, null=True, blank=True, related_name='diary_entries')
+    food_name = models.CharField(max_length=200, help_text="Food item name")
+    portions = models.DecimalField(
+        max_digits=5, decimal_places=2, default=1,
+        validators=[MinValueValidator(0.01), MaxValueValidator(100)],
+        help_text="Number of servings")
+    oxalate_mg = models.DecimalField(
+        max_digits=8, decimal_places=2, help_text="Oxalate of the portion in mg")
+    eaten_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-eaten_at']
+        verbose_name_plural = "Food diary entries"
+
+    def __str__(self):
+        return f"{self.food_name} x{self.portions} - {self.patient_profile}"
+
+
+class OxalateIntakeRollup(models.Model):
+    """Daily or weekly oxalate total of a patient, kept current as diary entries change"""
+    PERIOD_CHOICES = [
+        ('day', 'Day'),
+        ('week', 'Week'),
+    ]
+    patient_profile = models.ForeignKey(
+        PatientProfile, on_delete=models.CASCADE, related_name='intake_rollups')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateField(help_text="Day, or Monday of the week")
+    oxalate_mg = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    entries = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['patient_profile', 'period', '-start']
+        constraints = [
+            models.UniqueConstraint(fields=['patient_profile', 'period', 'start'],
+                                    name='unique_intake_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_period_display()} of {self.start}: {self.oxalate_mg} mg - {self.patient_profile}"
+
+
+class UrineTrend(models.Model):
+    """Change of one urine analysis since the patient's previous one, stored as the panel is saved"""
+    urine_analysis = models.OneToOneField(
+        UrineAnalysis, on_delete=models.CASCADE, related_name='trend')
+    patient_profile = models.ForeignKey(
+        PatientProfile, on_delete=models.CASCADE, related_name='urine_trends')
+    previous = models.ForeignKey(
+        UrineAnalysis, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        help_text="The patient's previous urine analysis (empty for the first)")
+    visit = models.PositiveIntegerField(help_text="1 for the patient's first urine analysis")
+    collected_at = models.DateTimeField(help_text="created_at of the urine analysis")
+    days_since_previous = models.FloatField(null=True, blank=True)
+
+    values = models.JSONField(default=dict, help_text="Urine values of this panel")
+    deltas = models.JSONField(default=dict, help_text="Change of each value since the previous panel")
+    slopes = models.JSONField(
+        default=dict, help_text="Least-squares change per year of each value over all panels so far")
+    # Running sums of the slope regression, so the next panel only needs this row
+    sums = models.JSONField(default=dict)
+
+    findings = models.BigIntegerField(default=0, help_text="Finding bits of this panel")
+    findings_new = models.BigIntegerField(default=0, help_text="Findings absent from the previous panel")
+    findings_resolved = models.BigIntegerField(
+        default=0, help_text="Findings of the previous panel that are gone")
+    rule_version = models.CharField(max_length=128, blank=True, default='')
+
+    class Meta:
+        ordering = ['patient_profile', 'visit']
+        indexes = [
+            models.Index(fields=['patient_profile', 'visit']),
+        ]
+
+    def __str__(self):
+        return f"Urine Trend visit {self.visit} - {self.patient_profile}"
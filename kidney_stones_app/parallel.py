@@ -0,0 +1,178 @@
+"""
+Multi-core interpretation of column-oriented cohorts.
+
+The batch services of batch.py score a cohort on one core. interpret_cohort
+splits the rows into contiguous slices scored by a process pool. The columns
+are copied once into a single shared memory block, and every worker maps
+that block and scores its slice in place, so no row is pickled. The object
+columns (stone types, genders, condition and medication lists) travel as
+integer codes into small tables of their distinct values. Workers write the
+finding codes and plan ids of their slice straight into a shared output
+block and return only their slice's table of distinct plans. The slices
+therefore come back in input order, and the parent merges the plan tables.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+import numpy as np
+
+from .batch import interpret_24hr_urine_batch, generate_management_plan_batch
+from .services import URINE_FIELDS, SERUM_FIELDS, active_rule_set
+
+
+# Slices per worker, so a slow worker does not hold up the others
+SLICES_PER_WORKER = 4
+
+# Smallest slice worth a task; smaller cohorts use fewer workers
+MIN_SLICE_ROWS = 5000
+
+# Alignment of every array in a shared block
+ALIGNMENT = 64
+
+
+def _layout(arrays):
+    """Offsets of arrays {name: (dtype, rows)} packed into one block, and the block size"""
+    layout = {}
+    size = 0
+    for name, (dtype, rows) in arrays.items():
+        size = -(-size // ALIGNMENT) * ALIGNMENT
+        layout[name] = (np.dtype(dtype).str, rows, size)
+        size += np.dtype(dtype).itemsize * rows
+    return layout, max(size, 1)
+
+
+def _views(block, layout):
+    """Arrays of a layout over a shared memory block"""
+    return {name: np.ndarray(rows, dtype=dtype, buffer=block.buf, offset=offset)
+            for name, (dtype, rows, offset) in layout.items()}
+
+
+def _encode(values, n):
+    """Integer code of each value and the table of distinct values"""
+    table = dict.fromkeys(values)
+    index = {value: code for code, value in enumerate(table)}
+    return np.fromiter(map(index.__getitem__, values), dtype=np.int32, count=n), list(table)
+
+
+def _rows(rows, n):
+    """Condition or medication lists as hashable tuples"""
+    if rows is None:
+        return [()] * n
+    try:
+        return list(map(tuple, rows))
+    except TypeError:
+        return [tuple(row) if row else () for row in rows]
+
+
+def _decode(codes, table):
+    return [table[code] for code in codes.tolist()]
+
+
+def _score_slice(inputs, outputs, start, stop, tables, has_serum, rule_set):
+    """Scores rows start:stop of the shared columns into the shared outputs"""
+    columns = _views(inputs, tables['layout'])
+    urine = {field: columns[field][start:stop] for field in URINE_FIELDS}
+    serum = ({field: columns[field][start:stop] for field in SERUM_FIELDS}
+             if has_serum else None)
+    ages = columns['age'][start:stop]
+    stone_types = np.array(tables['stone_type'], dtype=object)[columns['stone_type'][start:stop]]
+    genders = np.array(tables['gender'], dtype=object)[columns['gender'][start:stop]]
+    conditions = _decode(columns['medical_conditions'][start:stop], tables['medical_conditions'])
+    medications = _decode(columns['medications'][start:stop], tables['medications'])
+
+    codes = interpret_24hr_urine_batch(urine, conditions, rule_set, ages, genders)
+    plan_ids, plan_table = generate_management_plan_batch(
+        stone_types, codes, conditions, medications, serum, rule_set, ages, genders)
+    results = _views(outputs, tables['output_layout'])
+    results['codes'][start:stop] = codes
+    results['plan_ids'][start:stop] = plan_ids
+    return plan_table
+
+
+def _score_task(input_name, output_name, start, stop, tables, has_serum, rule_set):
+    """Pool task: maps the shared blocks and scores one slice"""
+    inputs = SharedMemory(name=input_name)
+    outputs = SharedMemory(name=output_name)
+    try:
+        return _score_slice(inputs, outputs, start, stop, tables, has_serum, rule_set)
+    finally:
+        inputs.close()
+        outputs.close()
+
+
+def interpret_cohort(urine_columns, medical_conditions=None, medications=None, stone_types='Unknown',
+                     serum_columns=None, ages=None, genders=None, rule_set=None, workers=None,
+                     executor=None):
+    """
+    interpret_24hr_urine_batch and generate_management_plan_batch over a
+    cohort, in a pool of workers processes (default: all cores). Takes the
+    arguments of the batch functions and returns (codes, plan_ids,
+    plan_table) as they do, in input order and whatever the number of
+    workers. executor reuses a running ProcessPoolExecutor across calls.
+    """
+    rule_set = rule_set or active_rule_set()
+    volume = np.asarray(urine_columns['volume_L'], dtype=float)
+    n = len(volume)
+    workers = workers or os.cpu_count()
+    slices = min(workers * SLICES_PER_WORKER, -(-n // MIN_SLICE_ROWS))
+    if workers == 1 or slices <= 1:
+        codes = interpret_24hr_urine_batch(urine_columns, medical_conditions, rule_set, ages, genders)
+        plan_ids, plan_table = generate_management_plan_batch(
+            stone_types, codes, medical_conditions, medications, serum_columns, rule_set, ages, genders)
+        return codes, plan_ids, plan_table
+
+    columns = {field: urine_columns[field] if field in urine_columns or field != 'cystine_mg'
+               else np.zeros(n) for field in URINE_FIELDS}
+    has_serum = serum_columns is not None
+    if has_serum:
+        columns.update({field: serum_columns.get(field, np.full(n, np.nan)) for field in SERUM_FIELDS})
+    columns['age'] = np.full(n, np.nan) if ages is None else ages
+    tables = {}
+    for name, values in (
+            ('stone_type', np.broadcast_to(np.asarray(stone_types, dtype=object), (n,))),
+            ('gender', np.broadcast_to(np.asarray(genders, dtype=object), (n,))),
+            ('medical_conditions', _rows(medical_conditions, n)),
+            ('medications', _rows(medications, n))):
+        columns[name], tables[name] = _encode(values, n)
+
+    layout, size = _layout({name: (np.int32 if name in tables else np.float64, n)
+                            for name in columns})
+    output_layout, output_size = _layout({'codes': (np.uint32, n), 'plan_ids': (np.intp, n)})
+    tables['layout'] = layout
+    tables['output_layout'] = output_layout
+    inputs = SharedMemory(create=True, size=size)
+    outputs = SharedMemory(create=True, size=output_size)
+    try:
+        for name, array in _views(inputs, layout).items():
+            array[:] = columns[name]
+        # The block can only be closed once no view of it is left
+        del array
+        bounds = np.linspace(0, n, slices + 1).astype(int).tolist()
+        pool = executor or ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [pool.submit(_score_task, inputs.name, outputs.name, start, stop,
+                                   tables, has_serum, rule_set)
+                       for start, stop in zip(bounds, bounds[1:])]
+            slice_tables = [future.result() for future in futures]
+        finally:
+            if executor is None:
+                pool.shutdown()
+
+        # Merge the per-slice plan tables into one, renumbering the plan ids
+        results = _views(outputs, output_layout)
+        codes = results['codes'].copy()
+        plan_ids = results['plan_ids'].copy()
+        del results
+        merged = {}
+        for (start, stop), slice_table in zip(zip(bounds, bounds[1:]), slice_tables):
+            renumber = np.array([merged.setdefault(tuple(plan), len(merged)) for plan in slice_table],
+                                dtype=np.intp)
+            plan_ids[start:stop] = renumber[plan_ids[start:stop]]
+        plan_table = [list(plan) for plan in merged]
+    finally:
+        inputs.close()
+        inputs.unlink()
+        outputs.close()
+        outputs.unlink()
+    return codes, plan_ids, plan_table
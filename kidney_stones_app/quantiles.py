@@ -0,0 +1,225 @@
+"""
+Population percentiles of urine values from incrementally maintained
+quantile sketches, one per UrineAnalysis field.
+
+Each sketch is a merging t-digest: a few dozen weighted centroids, dense at
+both tails where percentiles matter most, plus a small buffer of raw values
+that is merged in once it fills up. Sketches live in the QuantileSketch table,
+so a percentile lookup reads one row per field and interpolates, without
+scanning UrineAnalysis.
+
+Saving a panel only inserts its values into PendingQuantileValues, without
+locking anything. Every FOLD_EVERY panels, fold_pending merges the pending
+values into the sketches after the save commits; that is the only writer
+that locks the sketch rows, so panel saves are never serialized. Lookups
+therefore lag behind the last few panels saved.
+
+Sketches only grow: edited or deleted panels stay counted with their old
+values until rebuild_sketches recomputes every sketch from the stored panels.
+"""
+from django.db import transaction
+from django.utils import timezone
+import numpy as np
+
+from .models import PendingQuantileValues, QuantileSketch, UrineAnalysis
+from .services import URINE_FIELDS
+
+
+# Centroid budget: about COMPRESSION / 2 centroids per sketch
+COMPRESSION = 100
+BUFFER_SIZE = 64
+
+# Pending panels are folded into the sketches on every FOLD_EVERYth save
+FOLD_EVERY = 100
+
+
+class TDigest:
+    """Merging t-digest over float values with the arcsine (k1) scale function"""
+
+    def __init__(self, means=(), weights=(), buffer=(), minimum=None, maximum=None,
+                 compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.asarray(means, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.buffer = list(buffer)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @property
+    def count(self):
+        return int(self.weights.sum()) + len(self.buffer)
+
+    def add(self, value):
+        value = float(value)
+        self.buffer.append(value)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.compress()
+
+    def extend(self, values):
+        """Adds many values at once"""
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        self.minimum = min(values.min(), np.inf if self.minimum is None else self.minimum)
+        self.maximum = max(values.max(), -np.inf if self.maximum is None else self.maximum)
+        self.buffer.extend(values.tolist())
+        self.compress()
+
+    def compress(self):
+        """Merges the buffer: neighbouring values share a centroid while they span under one k unit"""
+        if not self.buffer:
+            return
+        means = np.concatenate((self.means, self.buffer))
+        weights = np.concatenate((self.weights, np.ones(len(self.buffer))))
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        middle = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * middle - 1)
+        bins = np.floor(k).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        self.buffer = []
+
+    def cdf(self, value):
+        """Share of the values below value, counting ties as half (mid-rank)"""
+        self.compress()
+        if self.minimum is None:
+            return None
+        if value < self.minimum:
+            return 0.0
+        if value > self.maximum:
+            return 1.0
+        if self.minimum == self.maximum:
+            return 0.5
+        total = self.weights.sum()
+        centers = (np.cumsum(self.weights) - self.weights / 2) / total
+        positions = np.r_[self.minimum, self.means, self.maximum]
+        shares = np.r_[0.0, centers, 1.0]
+        # Values equal to a centroid mean take that centroid's mid-rank
+        return float(np.interp(value, positions, shares))
+
+    def quantile(self, share):
+        """Value below which share of the values fall"""
+        self.compress()
+        if self.minimum is None:
+            return None
+        total = self.weights.sum()
+        centers = (np.cumsum(self.weights) - self.weights / 2) / total
+        return float(np.interp(share, np.r_[0.0, centers, 1.0],
+                               np.r_[self.minimum, self.means, self.maximum]))
+
+    @classmethod
+    def from_sketch(cls, sketch):
+        return cls(sketch.means, sketch.weights, sketch.buffer, sketch.minimum, sketch.maximum)
+
+    def to_sketch(self, sketch):
+        """Writes the digest into a QuantileSketch instance (not saved)"""
+        sketch.means = self.means.tolist()
+        sketch.weights = self.weights.tolist()
+        sketch.buffer = list(self.buffer)
+        sketch.minimum = self.minimum
+        sketch.maximum = self.maximum
+        sketch.count = self.count
+        return sketch
+
+
+SKETCH_UPDATE_FIELDS = ['means', 'weights', 'buffer', 'minimum', 'maximum', 'count', 'updated_at']
+
+
+def record_panel(panel_id, values):
+    """
+    Queues the values ({field: value}) of a newly saved panel for the
+    sketches; every FOLD_EVERY panels, folds the queue once the save commits.
+    """
+    pending = PendingQuantileValues.objects.create(
+        panel_id=panel_id, values={field: float(values[field]) for field in URINE_FIELDS})
+    if pending.id % FOLD_EVERY == 0:
+        transaction.on_commit(fold_pending)
+
+
+def _locked_sketches():
+    """The field sketches, created if missing, locked in field order"""
+    locked = QuantileSketch.objects.select_for_update().filter(field__in=URINE_FIELDS).order_by('field')
+    sketches = {sketch.field: sketch for sketch in locked}
+    if len(sketches) < len(URINE_FIELDS):
+        QuantileSketch.objects.bulk_create(
+            [QuantileSketch(field=field) for field in URINE_FIELDS if field not in sketches],
+            ignore_conflicts=True)
+        sketches = {sketch.field: sketch for sketch in locked.all()}
+    return sketches
+
+
+def fold_pending():
+    """Merges the pending panel values into the sketches; returns the number of panels"""
+    with transaction.atomic():
+        sketches = _locked_sketches()
+        # Concurrent folds wait for the sketch locks, then only see what is left
+        pending = list(PendingQuantileValues.objects.order_by('id').values_list('id', 'values'))
+        if not pending:
+            return 0
+        ids, rows = zip(*pending)
+        for field, sketch in sketches.items():
+            digest = TDigest.from_sketch(sketch)
+            digest.extend([row[field] for row in rows])
+            digest.to_sketch(sketch)
+            sketch.updated_at = timezone.now()
+        QuantileSketch.objects.bulk_update(sketches.values(), SKETCH_UPDATE_FIELDS)
+        PendingQuantileValues.objects.filter(id__in=ids).delete()
+    return len(ids)
+
+
+def rebuild_sketches(batch_size=50000):
+    """
+    Recomputes every field sketch from the stored panels; returns the panel
+    count. Pending values of the panels read are dropped, later ones kept.
+    """
+    digests = {field: TDigest() for field in URINE_FIELDS}
+    last_id = 0
+    count = 0
+    while True:
+        rows = list(UrineAnalysis.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', *URINE_FIELDS)[:batch_size])
+        if not rows:
+            break
+        ids, *columns = zip(*rows)
+        for field, column in zip(URINE_FIELDS, columns):
+            digests[field].extend(np.asarray(column, dtype=float))
+        last_id = ids[-1]
+        count += len(rows)
+    with transaction.atomic():
+        sketches = _locked_sketches()
+        for field, digest in digests.items():
+            digest.to_sketch(sketches[field])
+            sketches[field].updated_at = timezone.now()
+        QuantileSketch.objects.bulk_update(sketches.values(), SKETCH_UPDATE_FIELDS)
+        PendingQuantileValues.objects.filter(panel_id__lte=last_id).delete()
+    return count
+
+
+def population_percentiles(urine_profile):
+    """
+    {field: percentile (0-100) or None} of every value of a panel among the
+    stored panels, from the field sketches (one query).
+    """
+    sketches = {sketch.field: sketch for sketch in QuantileSketch.objects.filter(field__in=URINE_FIELDS)}
+    percentiles = {}
+    for field, value in urine_profile._asdict().items():
+        sketch = sketches.get(field)
+        share = TDigest.from_sketch(sketch).cdf(value) if sketch is not None else None
+        percentiles[field] = None if share is None else 100 * share
+    return percentiles
+
+
+def percentile_report(urine_profile):
+    """Rows of label, value and percentile for the results page, in field order"""
+    percentiles = population_percentiles(urine_profile)
+    return [{
+        'field': field,
+        'label': UrineAnalysis._meta.get_field(field).help_text,
+        'value': value,
+        'percentile': percentiles[field],
+    } for field, value in urine_profile._asdict().items()]
@@ -0,0 +1,115 @@
+"""
+Local, vectorized recurrence risk score after the ROKS (Recurrence Of Kidney
+Stone) nomogram, computed from the PatientProfile fields.
+
+The score is a Cox-type model: a linear predictor of log hazard ratios for
+age, sex, stone history, family history, BMI and stone-related conditions,
+turned into the probability of a symptomatic recurrence at 5 and 10 years
+with a baseline survival curve. Hazard ratios and baseline survival
+approximate those reported for the ROKS cohort and only cover the inputs
+PatientProfile stores (no imaging or stone composition), so the result is
+meant for ranking and triage, not as a substitute for the full nomogram.
+"""
+import numpy as np
+
+
+# Bump when the coefficients change, so stored scores can be refreshed
+ROKS_VERSION = "roks-1"
+
+# PatientProfile fields the score reads
+ROKS_FIELDS = ('age', 'gender', 'num_prior_stones', 'first_stone_age', 'family_history',
+               'bmi', 'medical_conditions')
+
+# PatientProfile fields the score is stored in
+ROKS_SCORE_FIELDS = ('recurrence_risk_5y', 'recurrence_risk_10y', 'recurrence_version')
+
+# log hazard ratios of the linear predictor
+ROKS_COEFFICIENTS = {
+    'age_per_decade': np.log(1 / 1.22),        # younger patients recur more
+    'male': np.log(1.37),
+    'prior_stones': np.log(1.58),              # per doubling of 1 + prior episodes
+    'first_stone_before_30': np.log(1.25),
+    'family_history': np.log(1.38),
+    'bmi_per_5': np.log(1.10),
+}
+
+# Conditions increasing recurrence, with their log hazard ratios
+ROKS_CONDITIONS = {
+    "Primary Hyperparathyroidism": np.log(1.40),
+    "Renal Tubular Acidosis": np.log(1.60),
+    "Malabsorption (IBD, Bariatric Surgery, etc.)": np.log(1.40),
+    "chronic_diarrhea": np.log(1.25),
+    "Gout": np.log(1.30),
+    "Medullary Sponge Kidney": np.log(1.50),
+}
+
+# Reference patient of the baseline curve: age 45, female, first episode at
+# 45, no family history, BMI 25, none of the conditions
+ROKS_REFERENCE = {'age': 45.0, 'bmi': 25.0}
+
+# Recurrence-free probability of the reference patient
+ROKS_BASELINE_SURVIVAL = {5: 0.80, 10: 0.68}
+
+
+def roks_linear_predictor(columns):
+    """
+    Linear predictor for every row. columns maps age, gender, num_prior_stones,
+    first_stone_age (NaN or None when unknown), family_history, bmi and
+    medical_conditions (a list per row) to sequences.
+    """
+    age = np.asarray(columns['age'], dtype=float)
+    n = len(age)
+    male = np.asarray(columns['gender'], dtype=object) == 'Male'
+    prior = np.asarray(columns['num_prior_stones'], dtype=float)
+    first_stone_age = np.asarray(
+        [np.nan if value is None else value for value in columns['first_stone_age']],
+        dtype=float)
+    family_history = np.asarray(columns['family_history'], dtype=bool)
+    bmi = np.asarray(columns['bmi'], dtype=float)
+
+    coefficients = ROKS_COEFFICIENTS
+    predictor = (
+        coefficients['age_per_decade'] * (age - ROKS_REFERENCE['age']) / 10
+        + coefficients['male'] * male
+        + coefficients['prior_stones'] * np.log2(1 + prior)
+        + coefficients['first_stone_before_30'] * (first_stone_age < 30)
+        + coefficients['family_history'] * family_history
+        + coefficients['bmi_per_5'] * (bmi - ROKS_REFERENCE['bmi']) / 5
+    )
+
+    # Each distinct condition list is only scored once
+    distinct = {}
+    ids = np.fromiter(
+        (distinct.setdefault(tuple(row) if row else (), len(distinct))
+         for row in columns['medical_conditions']),
+        dtype=np.intp, count=n)
+    condition_terms = np.array(
+        [sum(ROKS_CONDITIONS.get(condition, 0.0) for condition in set(row)) for row in distinct],
+        dtype=float)
+    return predictor + condition_terms[ids]
+
+
+def roks_recurrence_batch(columns):
+    """Probability of a symptomatic recurrence by year, {5: array, 10: array}"""
+    hazard_ratio = np.exp(roks_linear_predictor(columns))
+    return {years: 1 - survival ** hazard_ratio
+            for years, survival in ROKS_BASELINE_SURVIVAL.items()}
+
+
+def roks_recurrence(patient_profile):
+    """{5: p, 10: p} for one PatientProfile instance or values() row"""
+    if isinstance(patient_profile, dict):
+        row = patient_profile
+    else:
+        row = {field: getattr(patient_profile, field) for field in ROKS_FIELDS}
+    risks = roks_recurrence_batch({field: [row[field]] for field in ROKS_FIELDS})
+    return {years: float(risk[0]) for years, risk in risks.items()}
+
+
+def score_profile(patient_profile):
+    """Sets the recurrence fields of a PatientProfile instance (not saved)"""
+    risks = roks_recurrence(patient_profile)
+    patient_profile.recurrence_risk_5y = risks[5]
+    patient_profile.recurrence_risk_10y = risks[10]
+    patient_profile.recurrence_version = ROKS_VERSION
+    return patient_profile
@@ -0,0 +1,111 @@
+"""
+Keeps derived data current: the recurrence risk as patient profiles are
+saved, the similar-patient index as panels, patients and serum labs change, the quantile sketches and the urine trends as panels
+are saved, the oxalate intake rollups as diary entries change.
+"""
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import diary, quantiles, recurrence, similarity, trends
+from .models import PatientProfile, UrineAnalysis, SerumLabs, FoodDiaryEntry
+from .services import URINE_FIELDS
+
+
+@receiver(post_save, sender=UrineAnalysis, dispatch_uid='similarity_urine_saved')
+def urine_analysis_saved(sender, instance, **kwargs):
+    similarity.update_panel(instance.id)
+
+
+@receiver(post_save, sender=UrineAnalysis, dispatch_uid='quantiles_urine_saved')
+def urine_analysis_sketched(sender, instance, created, raw=False, **kwargs):
+    # Sketches only grow: edits and deletes are picked up by rebuild_quantile_sketches
+    if created and not raw:
+        quantiles.record_panel(instance.id, {field: getattr(instance, field) for field in URINE_FIELDS})
+
+
+@receiver(post_save, sender=UrineAnalysis, dispatch_uid='trends_urine_saved')
+def urine_analysis_trended(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        trends.record_panel(instance)
+    else:
+        # An edited panel changes its own trend and the later visits'
+        trends.update_panel(instance)
+
+
+@receiver(post_delete, sender=UrineAnalysis, dispatch_uid='trends_urine_deleted')
+def urine_analysis_untrended(sender, instance, **kwargs):
+    # Later visits now follow another panel
+    trends.remove_panel(instance)
+
+
+@receiver(post_delete, sender=UrineAnalysis, dispatch_uid='similarity_urine_deleted')
+def urine_analysis_deleted(sender, instance, **kwargs):
+    index = similarity.loaded_index()
+    if index is not None:
+        index.remove(instance.id)
+
+
+@receiver(post_save, sender=SerumLabs, dispatch_uid='similarity_serum_saved')
+def serum_labs_saved(sender, instance, **kwargs):
+    # Panels carry the patient's latest serum labs
+    similarity.update_patient(instance.patient_profile_id)
+
+
+@receiver(post_delete, sender=SerumLabs, dispatch_uid='similarity_serum_deleted')
+def serum_labs_deleted(sender, instance, **kwargs):
+    # Other processes only see the change through the patient's updated_at
+    PatientProfile.objects.filter(id=instance.patient_profile_id).update(updated_at=timezone.now())
+    similarity.update_patient(instance.patient_profile_id)
+
+
+@receiver(pre_save, sender=PatientProfile, dispatch_uid='recurrence_patient_saving')
+def patient_profile_scoring(sender, instance, raw=False, update_fields=None, **kwargs):
+    # QuerySet.update() and bulk_update() skip this: score_recurrence catches them up
+    if raw or (update_fields is not None and not update_fields & set(recurrence.ROKS_FIELDS)):
+        return
+    recurrence.score_profile(instance)
+
+
+@receiver(post_save, sender=PatientProfile, dispatch_uid='recurrence_patient_saved')
+def patient_profile_scored(sender, instance, raw=False, update_fields=None, **kwargs):
+    # save(update_fields=[...]) only writes the score if it was listed too
+    if raw or update_fields is None or not update_fields & set(recurrence.ROKS_FIELDS):
+        return
+    if not update_fields >= set(recurrence.ROKS_SCORE_FIELDS):
+        PatientProfile.objects.filter(id=instance.id).update(
+            **{field: getattr(instance, field) for field in recurrence.ROKS_SCORE_FIELDS})
+
+
+@receiver(post_save, sender=PatientProfile, dispatch_uid='similarity_patient_saved')
+def patient_profile_saved(sender, instance, created, raw=False, **kwargs):
+    # Panels carry the patient's age, sex, prior stones and BMI
+    if not (created or raw):
+        similarity.update_patient(instance.id)
+
+
+@receiver(pre_save, sender=FoodDiaryEntry, dispatch_uid='diary_entry_changing')
+def diary_entry_changing(sender, instance, raw=False, **kwargs):
+    # An edited entry is taken out of the totals it was counted in
+    instance._counted_as = None
+    if instance.pk and not raw:
+        instance._counted_as = FoodDiaryEntry.objects.filter(pk=instance.pk).values_list(
+            'patient_profile_id', 'eaten_at', 'oxalate_mg').first()
+
+
+@receiver(post_save, sender=FoodDiaryEntry, dispatch_uid='diary_entry_saved')
+def diary_entry_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_counted_as', None)
+    if previous is not None:
+        patient_id, eaten_at, oxalate_mg = previous
+        diary.apply_to_rollups(patient_id, eaten_at, -oxalate_mg, -1)
+    diary.apply_to_rollups(instance.patient_profile_id, instance.eaten_at, instance.oxalate_mg, 1)
+
+
+@receiver(post_delete, sender=FoodDiaryEntry, dispatch_uid='diary_entry_deleted')
+def diary_entry_deleted(sender, instance, **kwargs):
+    diary.apply_to_rollups(instance.patient_profile_id, instance.eaten_at, -instance.oxalate_mg, -1)
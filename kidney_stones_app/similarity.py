@@ -0,0 +1,539 @@
+"""
+Similar-patient lookup: a nearest-neighbour index over one normalized feature
+vector per UrineAnalysis (urine panel, the patient's latest serum labs and a
+few PatientProfile fields).
+
+The index is a KD-tree stored in flat NumPy arrays, with leaves searched as
+array slices. New or changed panels go into a small pending buffer that is
+searched by brute force and merged into the tree once it grows past a share
+of the tree size.
+
+Every process keeps its own index. Its own saves reach it through signals;
+changes made by other processes are read back from the database: every
+SYNC_INTERVAL seconds the index re-reads the panels whose row, patient or
+serum labs were updated since its watermark. Panels deleted elsewhere are
+dropped from the results on lookup. Snapshots (.npz) are only written by
+`manage.py build_similarity_index`, from the database, and carry the
+watermark a loading process catches up from.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+import numpy as np
+
+from .models import UrineAnalysis, SerumLabs, ManagementPlan
+from .services import URINE_FIELDS, SERUM_FIELDS
+
+
+# (field, center, scale) of every feature: fixed, so vectors stay comparable
+# as the index grows and never need re-normalizing
+SIMILARITY_FEATURES = (
+    ('volume_L', 1.7, 0.6),
+    ('ph', 6.0, 0.6),
+    ('calcium_mg', 200, 100),
+    ('oxalate_mg', 40, 15),
+    ('phosphorus_mg', 900, 300),
+    ('uric_acid_mg', 600, 200),
+    ('sodium_mEq', 160, 60),
+    ('potassium_mEq', 60, 25),
+    ('magnesium_mg', 100, 40),
+    ('sulfate_mmol', 35, 15),
+    ('ammonium_mmol', 35, 15),
+    ('citrate_mg', 550, 250),
+    ('cystine_mg', 20, 50),
+    ('calcium_mg_dL', 9.5, 0.6),
+    ('intact_pth_pg_mL', 50, 30),
+    ('bicarbonate_mEq_L', 25, 3),
+    ('potassium_mEq_L', 4.2, 0.5),
+    ('creatinine_mg_dL', 1.0, 0.3),
+    ('age', 50, 15),
+    ('male', 0.5, 0.5),
+    ('num_prior_stones', 1, 2),
+    ('bmi', 28, 5),
+)
+
+_CENTER = np.array([center for _, center, _ in SIMILARITY_FEATURES], dtype=float)
+_SCALE = np.array([scale for _, _, scale in SIMILARITY_FEATURES], dtype=float)
+
+
+def similarity_features(columns):
+    """
+    Normalized feature matrix, one row per panel. columns maps the urine and
+    serum fields, age, gender, num_prior_stones and bmi to sequences; missing
+    serum values (None/NaN) sit at the feature center.
+    """
+    n = len(columns['volume_L'])
+    matrix = np.empty((n, len(SIMILARITY_FEATURES)))
+    for index, (field, _, _) in enumerate(SIMILARITY_FEATURES):
+        if field == 'male':
+            matrix[:, index] = np.asarray(columns['gender'], dtype=object) == 'Male'
+        else:
+            matrix[:, index] = np.asarray(columns[field], dtype=float)
+    matrix -= _CENTER
+    matrix /= _SCALE
+    np.nan_to_num(matrix, copy=False, nan=0.0)
+    return matrix
+
+
+class KDTree:
+    """
+    Static KD-tree over the rows of points, split at the median of the widest
+    dimension. Nodes are stored in flat arrays; points are reordered so every
+    node covers the slice [start, end) and positions maps a slice position
+    back to the original row.
+    """
+
+    def __init__(self, points, leaf_size=32):
+        points = np.ascontiguousarray(points, dtype=float)
+        n = len(points)
+        positions = np.arange(n)
+        starts, ends, lefts, rights, lows, highs = [], [], [], [], [], []
+
+        def new_node(start, end):
+            block = points[positions[start:end]]
+            starts.append(start)
+            ends.append(end)
+            lefts.append(-1)
+            rights.append(-1)
+            lows.append(block.min(axis=0) if end > start else np.zeros(points.shape[1]))
+            highs.append(block.max(axis=0) if end > start else np.zeros(points.shape[1]))
+            return len(starts) - 1
+
+        stack = [new_node(0, n)]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= leaf_size:
+                continue
+            dim = int(np.argmax(highs[node] - lows[node]))
+            middle = (start + end) // 2
+            segment = positions[start:end]
+            positions[start:end] = segment[
+                np.argpartition(points[segment, dim], middle - start)]
+            lefts[node] = new_node(start, middle)
+            rights[node] = new_node(middle, end)
+            stack.extend((lefts[node], rights[node]))
+
+        self.points = points[positions]
+        self.positions = positions
+        self.starts = np.array(starts, dtype=np.intp)
+        self.ends = np.array(ends, dtype=np.intp)
+        self.lefts = np.array(lefts, dtype=np.intp)
+        self.rights = np.array(rights, dtype=np.intp)
+        self.lows = np.array(lows).reshape(len(starts), points.shape[1])
+        self.highs = np.array(highs).reshape(len(starts), points.shape[1])
+        self._leaves()
+
+    def __len__(self):
+        return len(self.points)
+
+    def _leaves(self):
+        """Leaf boxes in point order, grouped under the nodes ~sqrt(leaves) deep"""
+        leaves = np.flatnonzero(self.lefts < 0)
+        leaves = leaves[np.argsort(self.starts[leaves])]
+        self._leaf_starts = self.starts[leaves]
+        self._leaf_sizes = self.ends[leaves] - self._leaf_starts
+        self._leaf_lows = np.ascontiguousarray(self.lows[leaves])
+        self._leaf_highs = np.ascontiguousarray(self.highs[leaves])
+
+        groups = [0]
+        while len(groups) ** 2 < len(leaves):
+            groups = [child for node in groups
+                      for child in ((self.lefts[node], self.rights[node])
+                                    if self.lefts[node] >= 0 else (node,))]
+        groups = np.array(groups, dtype=np.intp)
+        self._group_lows = np.ascontiguousarray(self.lows[groups])
+        self._group_highs = np.ascontiguousarray(self.highs[groups])
+        self._group_leaves = np.stack((
+            np.searchsorted(self._leaf_starts, self.starts[groups]),
+            np.searchsorted(self._leaf_starts, self.ends[groups])), axis=1)
+
+    @staticmethod
+    def _bounds(vector, lows, highs):
+        """Squared distance from vector to each box, a lower bound for the points in it"""
+        gaps = np.maximum(lows - vector, vector - highs)
+        np.maximum(gaps, 0, out=gaps)
+        return np.einsum('ij,ij->i', gaps, gaps)
+
+    def query(self, vector, k, alive=None):
+        """
+        (squared distances, slice positions) of the k nearest points, nearest
+        first. alive optionally masks out points by slice position.
+
+        The distance to a node's bounding box bounds the distances of its
+        points from below. Groups of leaves, then the leaves within a group,
+        are visited in order of that bound until it exceeds the kth best
+        distance found so far; leaves are scanned in growing chunks.
+        """
+        vector = np.asarray(vector, dtype=float)
+        best_distances = np.full(k, np.inf)
+        best_positions = np.full(k, -1, dtype=np.intp)
+        group_bounds = self._bounds(vector, self._group_lows, self._group_highs)
+        for group in np.argsort(group_bounds, kind='stable').tolist():
+            if group_bounds[group] >= best_distances[-1]:
+                break
+            first, last = self._group_leaves[group]
+            bounds = self._bounds(vector, self._leaf_lows[first:last], self._leaf_highs[first:last])
+            order = np.argsort(bounds, kind='stable')
+            done = 0
+            chunk = 4
+            while done < len(order):
+                leaves = order[done:done + chunk]
+                done += len(leaves)
+                chunk *= 2
+                leaves = leaves[bounds[leaves] < best_distances[-1]]
+                if not len(leaves):
+                    break
+                best_distances, best_positions = self._scan(
+                    vector, first + leaves, best_distances, best_positions, alive)
+        return best_distances, best_positions
+
+    def _scan(self, vector, leaves, best_distances, best_positions, alive):
+        """Merges the points of leaves into the sorted k best"""
+        k = len(best_distances)
+        sizes = self._leaf_sizes[leaves]
+        offsets = np.repeat(self._leaf_starts[leaves] - np.cumsum(sizes) + sizes, sizes)
+        positions = offsets + np.arange(offsets.size)
+        difference = self.points[positions] - vector
+        distances = np.einsum('ij,ij->i', difference, difference)
+        if alive is not None:
+            distances[~alive[positions]] = np.inf
+        distances = np.concatenate((best_distances, distances))
+        positions = np.concatenate((best_positions, positions))
+        keep = np.argpartition(distances, k - 1)[:k]
+        keep = keep[np.argsort(distances[keep], kind='stable')]
+        return distances[keep], positions[keep]
+
+    def arrays(self):
+        return {'points': self.points, 'positions': self.positions, 'starts': self.starts,
+                'ends': self.ends, 'lefts': self.lefts, 'rights': self.rights,
+                'lows': self.lows, 'highs': self.highs}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        tree = cls.__new__(cls)
+        for name in ('points', 'positions', 'starts', 'ends', 'lefts', 'rights',
+                     'lows', 'highs'):
+            setattr(tree, name, arrays[name])
+        tree._leaves()
+        return tree
+
+
+class SimilarityIndex:
+    """
+    KD-tree plus pending buffer keyed by UrineAnalysis id. add() replaces an
+    existing id; the buffer is merged into a rebuilt tree once it holds more
+    than rebuild_ratio of the tree (and at least min_rebuild) points.
+    """
+
+    def __init__(self, leaf_size=32, rebuild_ratio=0.05, min_rebuild=1024):
+        self.leaf_size = leaf_size
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild = min_rebuild
+        # Database changes up to this time are in the index (None: none are)
+        self.synced_at = None
+        self._lock = threading.RLock()
+        self._set_tree(None, np.empty(0, dtype=np.int64))
+        self._pending = {}
+
+    def _set_tree(self, tree, ids):
+        """ids are UrineAnalysis ids in slice order of tree"""
+        self._tree = tree
+        self._tree_ids = ids
+        self._alive = np.ones(len(ids), dtype=bool)
+        self._id_order = np.argsort(ids)
+
+    def __len__(self):
+        return int(self._alive.sum()) + len(self._pending)
+
+    def _tree_position(self, urine_id):
+        index = np.searchsorted(self._tree_ids, urine_id, sorter=self._id_order)
+        if index < len(self._tree_ids):
+            position = self._id_order[index]
+            if self._tree_ids[position] == urine_id:
+                return position
+        return None
+
+    def add(self, urine_id, vector):
+        with self._lock:
+            self._remove(urine_id)
+            self._pending[urine_id] = np.asarray(vector, dtype=float)
+            if len(self._pending) > max(self.min_rebuild, self.rebuild_ratio * len(self._tree_ids)):
+                self.rebuild()
+
+    def remove(self, urine_id):
+        with self._lock:
+            self._remove(urine_id)
+
+    def _remove(self, urine_id):
+        if self._pending.pop(urine_id, None) is None:
+            position = self._tree_position(urine_id)
+            if position is not None:
+                self._alive[position] = False
+
+    @classmethod
+    def from_points(cls, ids, points, **options):
+        """An index whose tree holds points, one row per UrineAnalysis id"""
+        index = cls(**options)
+        if len(ids):
+            tree = KDTree(points, index.leaf_size)
+            index._set_tree(tree, np.asarray(ids, dtype=np.int64)[tree.positions])
+        return index
+
+    def rebuild(self):
+        """Merges the pending buffer into a new tree and drops removed points"""
+        with self._lock:
+            ids = [self._tree_ids[self._alive]]
+            points = [self._tree.points[self._alive]] if self._tree is not None else []
+            if self._pending:
+                ids.append(np.fromiter(self._pending, dtype=np.int64, count=len(self._pending)))
+                points.append(np.array(list(self._pending.values())))
+            ids = np.concatenate(ids)
+            if len(ids):
+                tree = KDTree(np.concatenate(points), self.leaf_size)
+                self._set_tree(tree, ids[tree.positions])
+            else:
+                self._set_tree(None, ids)
+            self._pending = {}
+
+    def query(self, vector, k=20):
+        """[(UrineAnalysis id, distance), ...] of the k nearest panels, nearest first"""
+        with self._lock:
+            k_tree = min(k, len(self._tree_ids))
+            distances, ids = np.empty(0), np.empty(0, dtype=np.int64)
+            if self._tree is not None and k_tree:
+                distances, positions = self._tree.query(vector, k_tree, self._alive)
+                distances, ids = distances, self._tree_ids[positions]
+            if self._pending:
+                pending_ids = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+                difference = np.array(list(self._pending.values())) - vector
+                distances = np.concatenate(
+                    (distances, np.einsum('ij,ij->i', difference, difference)))
+                ids = np.concatenate((ids, pending_ids))
+        order = np.argsort(distances, kind='stable')[:k]
+        return [(int(urine_id), float(np.sqrt(distance)))
+                for urine_id, distance in zip(ids[order], distances[order])
+                if np.isfinite(distance)]
+
+    def save(self, path):
+        with self._lock:
+            tree = self._tree.arrays() if self._tree is not None else {}
+            pending_ids = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+            pending_points = np.array(list(self._pending.values())).reshape(
+                len(pending_ids), len(SIMILARITY_FEATURES))
+            # A temporary file of its own, so concurrent saves never share one
+            descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npz')
+            try:
+                with os.fdopen(descriptor, 'wb') as snapshot:
+                    np.savez(snapshot, ids=self._tree_ids, alive=self._alive,
+                             pending_ids=pending_ids, pending_points=pending_points,
+                             synced_at=np.float64(self.synced_at.timestamp() if self.synced_at
+                                                  else np.nan),
+                             leaf_size=self.leaf_size, **tree)
+                os.replace(temporary, path)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+    @classmethod
+    def load(cls, path, **options):
+        index = cls(**options)
+        with np.load(path, allow_pickle=False) as arrays:
+            tree = KDTree.from_arrays(arrays) if 'points' in arrays else None
+            index._set_tree(tree, arrays['ids'])
+            index._alive = arrays['alive'].copy()
+            # Snapshots without a watermark are caught up from every panel
+            synced_at = float(arrays['synced_at']) if 'synced_at' in arrays else np.nan
+            if not np.isnan(synced_at):
+                index.synced_at = datetime.fromtimestamp(synced_at, dt_timezone.utc)
+            index.leaf_size = int(arrays['leaf_size'])
+            index._pending = dict(zip(arrays['pending_ids'].tolist(), arrays['pending_points']))
+        return index
+
+
+# Panel features read straight from UrineAnalysis rows: the patient's fields
+# by join, the latest serum labs of the patient by subquery
+_LATEST_SERUM = SerumLabs.objects.filter(
+    patient_profile=OuterRef('patient_profile')).order_by('-created_at', '-id')
+
+PANEL_FEATURE_INPUTS = {
+    **{field: F(f'patient_profile__{field}')
+       for field in ('age', 'gender', 'num_prior_stones', 'bmi')},
+    **{field: Subquery(_LATEST_SERUM.values(field)[:1]) for field in SERUM_FIELDS},
+}
+
+
+def panel_features(queryset, batch_size=20000):
+    """Yields (ids, feature matrix) for a UrineAnalysis queryset, in id order and batches"""
+    last_id = 0
+    fields = ('id',) + URINE_FIELDS
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')
+                    .values_list(*fields, *PANEL_FEATURE_INPUTS.values())[:batch_size])
+        if not rows:
+            return
+        ids, *values = zip(*rows)
+        columns = dict(zip(URINE_FIELDS + tuple(PANEL_FEATURE_INPUTS), values))
+        yield np.array(ids, dtype=np.int64), similarity_features(columns)
+        if len(rows) < batch_size:
+            return
+        last_id = ids[-1]
+
+
+def build_index(path=None, **options):
+    """A SimilarityIndex over every stored panel, saved as a snapshot to path if given"""
+    synced_at = timezone.now()
+    ids, points = [np.empty(0, dtype=np.int64)], [np.empty((0, len(SIMILARITY_FEATURES)))]
+    for batch_ids, batch_points in panel_features(UrineAnalysis.objects.all()):
+        ids.append(batch_ids)
+        points.append(batch_points)
+    index = SimilarityIndex.from_points(np.concatenate(ids), np.concatenate(points), **options)
+    index.synced_at = synced_at
+    if path:
+        index.save(path)
+    return index
+
+
+# Rows committed late can carry an updated_at slightly before the watermark
+# (a transaction's timestamps are taken before it commits, and clocks of
+# different hosts drift), so every catch-up re-reads this much before it
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def changed_panels(since):
+    """Panels whose row, patient or serum labs were updated at or after since"""
+    return UrineAnalysis.objects.filter(
+        Q(updated_at__gte=since) | Q(patient_profile__updated_at__gte=since)
+        | Q(patient_profile_id__in=SerumLabs.objects.filter(updated_at__gte=since)
+            .values('patient_profile_id')))
+
+
+def catch_up(index):
+    """Re-reads the panels changed since the index's watermark; returns their number"""
+    synced_at = timezone.now()
+    panels = (UrineAnalysis.objects.all() if index.synced_at is None
+              else changed_panels(index.synced_at - SYNC_OVERLAP))
+    count = 0
+    for ids, points in panel_features(panels):
+        for urine_id, vector in zip(ids.tolist(), points):
+            index.add(urine_id, vector)
+        count += len(ids)
+    index.synced_at = synced_at
+    return count
+
+
+_index = None
+_index_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_last_sync = 0.0
+
+
+def get_index():
+    """
+    The process-wide index: loaded from SIMILARITY_INDEX['PATH'] and caught
+    up with the database, or built from it. Once loaded, it catches up with
+    changes made by other processes every SYNC_INTERVAL seconds.
+    """
+    global _index, _last_sync
+    config = settings.SIMILARITY_INDEX
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                path = config['PATH']
+                options = {'leaf_size': config['LEAF_SIZE'], 'rebuild_ratio': config['REBUILD_RATIO']}
+                if path and os.path.exists(path):
+                    index = SimilarityIndex.load(path, rebuild_ratio=config['REBUILD_RATIO'])
+                    catch_up(index)
+                else:
+                    index = build_index(**options)
+                _last_sync = time.monotonic()
+                _index = index
+    index = _index
+    # One thread catches up while the others keep using the index as it is
+    if time.monotonic() - _last_sync >= config['SYNC_INTERVAL'] and _sync_lock.acquire(blocking=False):
+        try:
+            catch_up(index)
+            _last_sync = time.monotonic()
+        finally:
+            _sync_lock.release()
+    return index
+
+
+def loaded_index():
+    """The index if this process has loaded it, else None"""
+    return _index
+
+
+def reset_index():
+    global _index
+    _index = None
+
+
+def update_panel(urine_id):
+    """Re-reads one panel's features into the loaded index (no-op when not loaded)"""
+    index = _index
+    if index is None:
+        return
+    for ids, points in panel_features(UrineAnalysis.objects.filter(id=urine_id)):
+        index.add(int(ids[0]), points[0])
+        return
+    index.remove(urine_id)
+
+
+def update_patient(patient_id):
+    """Re-reads the features of every panel of a patient into the loaded index"""
+    index = _index
+    if index is None:
+        return
+    for ids, points in panel_features(UrineAnalysis.objects.filter(patient_profile_id=patient_id)):
+        for urine_id, vector in zip(ids.tolist(), points):
+            index.add(urine_id, vector)
+
+
+def similar_panels(urine_analysis, k=20):
+    """
+    [(UrineAnalysis id, distance), ...] of the panels nearest to
+    urine_analysis, one per patient other than its own, nearest first.
+    """
+    index = get_index()
+    # Read only: saved panels reach the index through the post_save signal
+    [(_, points)] = panel_features(UrineAnalysis.objects.filter(id=urine_analysis.id))
+    # Over-fetch so that several panels of one patient still leave k patients
+    candidates = index.query(points[0], k * 3 + 1)
+    patients = dict(UrineAnalysis.objects.filter(
+        id__in=[urine_id for urine_id, _ in candidates]).values_list('id', 'patient_profile_id'))
+    seen = {urine_analysis.patient_profile_id}
+    nearest = []
+    for urine_id, distance in candidates:
+        patient_id = patients.get(urine_id)
+        # None for panels another process deleted since the last catch-up
+        if patient_id is None or patient_id in seen:
+            continue
+        seen.add(patient_id)
+        nearest.append((urine_id, distance))
+        if len(nearest) == k:
+            break
+    return nearest
+
+
+def similar_patients(urine_analysis, k=20):
+    """
+    The k most similar other patients, as dicts with the matched panel, the
+    distance and the latest plan made from that panel (None if there is none).
+    """
+    nearest = similar_panels(urine_analysis, k)
+    ids = [urine_id for urine_id, _ in nearest]
+    panels = UrineAnalysis.objects.select_related('patient_profile').in_bulk(ids)
+    plans = {}
+    for plan in ManagementPlan.objects.filter(urine_analysis_id__in=ids).order_by('-created_at'):
+        plans.setdefault(plan.urine_analysis_id, plan)
+    return [{'urine_analysis': panels[urine_id], 'patient_profile': panels[urine_id].patient_profile,
+             'distance': distance, 'plan': plans.get(urine_id)}
+            for urine_id, distance in nearest if urine_id in panels]
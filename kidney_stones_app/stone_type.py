@@ -0,0 +1,163 @@
+"""
+Stone-type prediction from the urine and serum profile.
+
+A multinomial logistic regression is trained offline from stored management
+plans (manage.py train_stone_type) and exported as plain NumPy arrays in an
+.npz file: feature means and scales, a coefficient matrix and intercepts.
+Inference is one matrix product and a softmax, so it needs nothing beyond
+NumPy and is cheap enough to pre-fill the stone type on every page load.
+"""
+import os
+import threading
+
+import numpy as np
+
+from .services import URINE_FIELDS, SERUM_FIELDS
+
+
+# Stone types the model can predict; "Unknown" plans carry no label
+STONE_TYPE_CLASSES = ("Calcium Oxalate", "Calcium Phosphate", "Uric Acid", "Struvite",
+                      "Cystine", "Drug-induced")
+
+# Urine fields, serum fields (0 when absent) and a has-serum indicator
+STONE_TYPE_FEATURES = URINE_FIELDS + SERUM_FIELDS + ('has_serum',)
+
+MODEL_FORMAT = 1
+
+
+def feature_matrix(urine_columns, serum_columns=None):
+    """
+    Float matrix with one row per panel and the STONE_TYPE_FEATURES columns.
+    serum_columns may be None, and NaN serum values count as absent labs.
+    """
+    n = len(urine_columns['volume_L'])
+    matrix = np.empty((n, len(STONE_TYPE_FEATURES)))
+    for index, field in enumerate(URINE_FIELDS):
+        matrix[:, index] = np.asarray(urine_columns[field], dtype=float)
+    serum = matrix[:, len(URINE_FIELDS):-1]
+    if serum_columns is None:
+        serum[:] = np.nan
+    else:
+        for index, field in enumerate(SERUM_FIELDS):
+            serum[:, index] = np.asarray(serum_columns[field], dtype=float)
+    missing = np.isnan(serum).all(axis=1)
+    matrix[:, -1] = ~missing
+    np.nan_to_num(serum, copy=False, nan=0.0)
+    return matrix
+
+
+class StoneTypeModel:
+    """Standardization plus softmax regression, as exported arrays"""
+
+    def __init__(self, classes, mean, scale, coefficients, intercepts, version=""):
+        self.classes = tuple(classes)
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.intercepts = np.asarray(intercepts, dtype=float)
+        self.version = version
+        # Standardization folded into the weights: (x - mean) / scale @ W.T + b
+        self._weights = (self.coefficients / self.scale).T
+        self._bias = self.intercepts - self.mean / self.scale @ self.coefficients.T
+
+    def predict_proba(self, features):
+        """Class probabilities, one row per feature row"""
+        logits = np.asarray(features, dtype=float) @ self._weights
+        logits += self._bias
+        logits -= logits.max(axis=1, keepdims=True)
+        np.exp(logits, out=logits)
+        logits /= logits.sum(axis=1, keepdims=True)
+        return logits
+
+    def predict(self, features):
+        """(stone types, probability of each) for every feature row"""
+        probabilities = self.predict_proba(features)
+        best = probabilities.argmax(axis=1)
+        return np.asarray(self.classes, dtype=object)[best], probabilities[np.arange(len(best)), best]
+
+    def predict_one(self, urine_profile, serum_panel=None):
+        """(stone type, probability) for one UrineProfile and optional SerumPanel"""
+        features = np.empty((1, len(STONE_TYPE_FEATURES)))
+        features[0, :len(URINE_FIELDS)] = urine_profile
+        if serum_panel is None:
+            features[0, len(URINE_FIELDS):] = 0.0
+        else:
+            features[0, len(URINE_FIELDS):-1] = serum_panel
+            features[0, -1] = 1.0
+        stone_types, probabilities = self.predict(features)
+        return stone_types[0], float(probabilities[0])
+
+    def save(self, path):
+        with open(path, 'wb') as model_file:
+            np.savez(model_file, format=MODEL_FORMAT, classes=np.array(self.classes),
+                     features=np.array(STONE_TYPE_FEATURES), mean=self.mean, scale=self.scale,
+                     coefficients=self.coefficients, intercepts=self.intercepts,
+                     version=np.array(self.version))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            if int(arrays['format']) != MODEL_FORMAT:
+                raise ValueError(f"{path}: unsupported stone type model format {arrays['format']}")
+            if tuple(arrays['features'].tolist()) != STONE_TYPE_FEATURES:
+                raise ValueError(f"{path}: model was trained on other features")
+            return cls(arrays['classes'].tolist(), arrays['mean'], arrays['scale'],
+                       arrays['coefficients'], arrays['intercepts'], str(arrays['version']))
+
+
+def train_stone_type_model(features, labels, classes=STONE_TYPE_CLASSES, l2=1e-3,
+                           iterations=500, learning_rate=0.5, version=""):
+    """
+    Fits the softmax regression by full-batch gradient descent on
+    standardized features. labels are stone type names; classes without
+    any example keep a very negative intercept and are never predicted.
+    """
+    features = np.asarray(features, dtype=float)
+    class_index = {stone_type: index for index, stone_type in enumerate(classes)}
+    targets = np.zeros((len(features), len(classes)))
+    targets[np.arange(len(features)), [class_index[label] for label in labels]] = 1
+
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1
+    standardized = (features - mean) / scale
+
+    counts = targets.sum(axis=0)
+    coefficients = np.zeros((len(classes), features.shape[1]))
+    intercepts = np.where(counts > 0, np.log(np.maximum(counts, 1) / len(features)), -30.0)
+    present = counts > 0
+    for _ in range(iterations):
+        logits = standardized @ coefficients.T + intercepts
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        error = (probabilities - targets) / len(features)
+        coefficients -= learning_rate * (error.T @ standardized + l2 * coefficients)
+        intercepts[present] -= learning_rate * error.sum(axis=0)[present]
+        coefficients[~present] = 0
+
+    return StoneTypeModel(classes, mean, scale, coefficients, intercepts, version)
+
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def load_stone_type_model(path):
+    """
+    The model stored at path, loaded once and reloaded when the file changes;
+    None without a path or file.
+    """
+    if not path:
+        return None
+    try:
+        signature = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _loaded.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with _lock:
+        model = StoneTypeModel.load(path)
+        _loaded[path] = (signature, model)
+    return model
@@ -0,0 +1,212 @@
+"""
+Relative supersaturation (RSS) of calcium oxalate, calcium phosphate (brushite)
+and uric acid from a 24-hour urine panel.
+
+Free-ion activities are found with a simplified EQUIL-style speciation: Davies
+activity coefficients, acid-base equilibria of the measured anions and the main
+calcium/magnesium complexes, solved by fixed-point iteration on the ionic
+strength and the free-ion mass balances. Every operation is vectorized, so a
+single call handles one panel or a whole cohort.
+Constants are thermodynamic values at 37 °C taken from the stone literature;
+results are estimates meant for trend and target comparisons.
+"""
+import numpy as np
+
+
+# Molar masses (g/mol) used to convert daily excretion into molar concentrations
+MOLAR_MASS = {
+    'calcium_mg': 40.08,
+    'oxalate_mg': 88.02,
+    'phosphorus_mg': 30.97,
+    'uric_acid_mg': 168.11,
+    'magnesium_mg': 24.31,
+    'citrate_mg': 189.10,
+}
+
+DAVIES_A = 0.5201  # 37 °C
+
+# Acid dissociation constants
+KA_OXALATE = (10 ** -1.25, 10 ** -4.27)
+KA_CITRATE = (10 ** -3.13, 10 ** -4.76, 10 ** -6.40)
+KA_PHOSPHATE = (10 ** -2.15, 10 ** -7.20, 10 ** -12.35)
+KA_SULFATE = 10 ** -1.99
+KA_URIC_ACID = 10 ** -5.35
+
+# Complex formation constants
+K_CA_OXALATE = 10 ** 3.19
+K_MG_OXALATE = 10 ** 3.43
+K_CA_CITRATE = 10 ** 4.68
+K_MG_CITRATE = 10 ** 4.38
+K_CA_HPO4 = 10 ** 2.74
+K_CA_H2PO4 = 10 ** 1.41
+K_CA_PO4 = 10 ** 6.46
+K_MG_HPO4 = 10 ** 2.87
+K_MG_H2PO4 = 10 ** 1.51
+K_MG_PO4 = 10 ** 4.80
+K_CA_SULFATE = 10 ** 2.31
+K_MG_SULFATE = 10 ** 2.25
+
+# Solubility products of the solid phases
+KSP_CALCIUM_OXALATE = 2.24e-9   # calcium oxalate monohydrate
+KSP_BRUSHITE = 2.49e-7          # calcium hydrogen phosphate dihydrate
+URIC_ACID_SOLUBILITY = 3.8e-4   # undissociated uric acid, mol/L
+
+# Risk targets quoted in the interpretation (Box 5 of the manuscript)
+SUPERSATURATION_TARGETS = {
+    'calcium_oxalate': 4.0,
+    'calcium_phosphate': 1.0,
+    'uric_acid': 1.0,
+}
+
+SUPERSATURATION_LABELS = {
+    'calcium_oxalate': 'Calcium oxalate',
+    'calcium_phosphate': 'Calcium phosphate',
+    'uric_acid': 'Uric acid',
+}
+
+
+def _activity_coefficients(ionic_strength):
+    """Davies equation for charges 1, 2 and 3"""
+    root = np.sqrt(ionic_strength)
+    log_gamma1 = -DAVIES_A * (root / (1 + root) - 0.3 * ionic_strength)
+    return 10 ** log_gamma1, 10 ** (4 * log_gamma1), 10 ** (9 * log_gamma1)
+
+
+def relative_supersaturation(columns, tol=1e-9, max_iter=200):
+    """
+    Relative supersaturation for every panel in columns, a mapping of
+    UrineAnalysis field names to arrays (or scalars).
+    Iterates until the ionic strength and free calcium of every panel change
+    by less than tol (relative). Returns a dict of arrays: calcium_oxalate,
+    calcium_phosphate, uric_acid, ionic_strength, a converged mask and the
+    number of iterations used.
+    """
+    volume = np.atleast_1d(np.asarray(columns['volume_L'], dtype=float))
+    # A panel without volume (e.g. all zeros) carries no solute: RSS 0, not NaN
+    volume = np.where(volume > 0, volume, np.inf)
+    h = 10 ** -np.atleast_1d(np.asarray(columns['ph'], dtype=float))  # activity of H+
+
+    def molar(field):
+        return np.atleast_1d(np.asarray(columns[field], dtype=float)) / MOLAR_MASS[field] / 1000 / volume
+
+    def mmol(field):
+        return np.atleast_1d(np.asarray(columns[field], dtype=float)) / 1000 / volume
+
+    calcium_total = molar('calcium_mg')
+    magnesium_total = molar('magnesium_mg')
+    oxalate_total = molar('oxalate_mg')
+    citrate_total = molar('citrate_mg')
+    phosphate_total = molar('phosphorus_mg')
+    urate_total = molar('uric_acid_mg')
+    sulfate_total = mmol('sulfate_mmol')
+    monovalent_cations = mmol('sodium_mEq') + mmol('potassium_mEq') + mmol('ammonium_mmol')
+
+    ka1_ox, ka2_ox = KA_OXALATE
+    ka1_cit, ka2_cit, ka3_cit = KA_CITRATE
+    ka1_p, ka2_p, ka3_p = KA_PHOSPHATE
+    # Ratios of each protonated species to its fully dissociated anion
+    # (before activity corrections), fixed by the pH of the panel
+    h_hox = h / ka2_ox
+    h2_h2ox = h_hox * h / ka1_ox
+    h_hcit = h / ka3_cit
+    h2_h2cit = h_hcit * h / ka2_cit
+    h3_h3cit = h2_h2cit * h / ka1_cit
+    h_hpo4 = h / ka3_p
+    h2_h2po4 = h_hpo4 * h / ka2_p
+    h3_h3po4 = h2_h2po4 * h / ka1_p
+    h_hso4 = h / KA_SULFATE
+    h_hur = h / KA_URIC_ACID
+
+    # Start from fully dissociated, uncomplexed ions
+    ionic_strength = 0.5 * (monovalent_cations + 4 * (calcium_total + magnesium_total
+                            + oxalate_total + sulfate_total) + 9 * (citrate_total + phosphate_total)
+                            + urate_total)
+    a_ca = calcium_total
+    a_mg = magnesium_total
+    converged = np.zeros(volume.shape, dtype=bool)
+
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        g1, g2, g3 = _activity_coefficients(ionic_strength)
+
+        # Free ligand activities given the current free metal activities
+        a_ox = oxalate_total / (1 / g2 + h_hox / g1 + h2_h2ox
+                                + K_CA_OXALATE * a_ca + K_MG_OXALATE * a_mg)
+        a_cit = citrate_total / (1 / g3 + h_hcit / g2 + h2_h2cit / g1 + h3_h3cit
+                                 + (K_CA_CITRATE * a_ca + K_MG_CITRATE * a_mg) / g1)
+        a_po4 = phosphate_total / (
+            1 / g3 + h_hpo4 / g2 + h2_h2po4 / g1 + h3_h3po4
+            + a_ca * (K_CA_HPO4 * h_hpo4 + K_CA_H2PO4 * h2_h2po4 / g1 + K_CA_PO4 / g1)
+            + a_mg * (K_MG_HPO4 * h_hpo4 + K_MG_H2PO4 * h2_h2po4 / g1 + K_MG_PO4 / g1))
+        a_so4 = sulfate_total / (1 / g2 + h_hso4 / g1
+                                 + K_CA_SULFATE * a_ca + K_MG_SULFATE * a_mg)
+        a_hpo4 = a_po4 * h_hpo4
+        a_h2po4 = a_po4 * h2_h2po4
+
+        # Free metal activities given the ligands. Starting from the totals,
+        # more free metal means less free ligand, so the updates decrease
+        # monotonically towards the solution without damping
+        ca_bound = (K_CA_OXALATE * a_ox + K_CA_CITRATE * a_cit / g1 + K_CA_HPO4 * a_hpo4
+                    + K_CA_H2PO4 * a_h2po4 / g1 + K_CA_PO4 * a_po4 / g1 + K_CA_SULFATE * a_so4)
+        mg_bound = (K_MG_OXALATE * a_ox + K_MG_CITRATE * a_cit / g1 + K_MG_HPO4 * a_hpo4
+                    + K_MG_H2PO4 * a_h2po4 / g1 + K_MG_PO4 * a_po4 / g1 + K_MG_SULFATE * a_so4)
+        new_a_ca = calcium_total / (1 / g2 + ca_bound)
+        a_mg = magnesium_total / (1 / g2 + mg_bound)
+
+        # Ionic strength of the free ions and charged complexes, with chloride
+        # taken as the anion that closes the charge balance
+        a_ur = urate_total / (1 / g1 + h_hur)
+        monovalent_complex_cations = (K_CA_H2PO4 * a_ca + K_MG_H2PO4 * a_mg) * a_h2po4 / g1
+        monovalent_complex_anions = ((K_CA_CITRATE * a_ca + K_MG_CITRATE * a_mg) * a_cit
+                                     + (K_CA_PO4 * a_ca + K_MG_PO4 * a_mg) * a_po4) / g1
+        monovalent_anions = ((a_ox * h_hox + a_cit * h2_h2cit + a_h2po4 + a_so4 * h_hso4 + a_ur) / g1
+                             + monovalent_complex_anions)
+        divalent_cations = (a_ca + a_mg) / g2
+        divalent_anions = (a_ox + a_so4 + a_hpo4 + a_cit * h_hcit) / g2
+        trivalent_anions = (a_cit + a_po4) / g3
+        chloride = np.maximum(
+            monovalent_cations + monovalent_complex_cations + 2 * divalent_cations
+            - monovalent_anions - 2 * divalent_anions - 3 * trivalent_anions, 0)
+        new_ionic_strength = 0.5 * (
+            monovalent_cations + monovalent_complex_cations + monovalent_anions + chloride
+            + 4 * (divalent_cations + divalent_anions) + 9 * trivalent_anions)
+
+        converged = ((np.abs(new_ionic_strength - ionic_strength) <= tol * ionic_strength)
+                     & (np.abs(new_a_ca - a_ca) <= tol * np.maximum(a_ca, 1e-30)))
+        ionic_strength = new_ionic_strength
+        a_ca = new_a_ca
+        if converged.all():
+            break
+
+    return {
+        'calcium_oxalate': a_ca * a_ox / KSP_CALCIUM_OXALATE,
+        'calcium_phosphate': a_ca * a_hpo4 / KSP_BRUSHITE,
+        'uric_acid': a_ur * h_hur / URIC_ACID_SOLUBILITY,
+        'ionic_strength': ionic_strength,
+        'converged': converged,
+        'iterations': iterations,
+    }
+
+
+def supersaturation_for_panel(urine_profile, tol=1e-9):
+    """Relative supersaturation of one UrineProfile (or panel dict), as plain floats"""
+    if hasattr(urine_profile, '_asdict'):
+        urine_profile = urine_profile._asdict()
+    result = relative_supersaturation(urine_profile, tol=tol)
+    return {
+        salt: float(result[salt][0]) for salt in SUPERSATURATION_TARGETS
+    }
+
+
+def supersaturation_report(urine_profile):
+    """Rows for the results page: label, RSS, target and whether it is exceeded"""
+    values = supersaturation_for_panel(urine_profile)
+    report = []
+    for salt, target in SUPERSATURATION_TARGETS.items():
+        report.append({
+            'label': SUPERSATURATION_LABELS[salt],
+            'value': round(values[salt], 2),
+            'target': target,
+            'above_target': values[salt] >= target,
+        })
+    return report
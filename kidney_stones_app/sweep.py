@@ -0,0 +1,110 @@
+"""
+What-if sweeps: one urine field is moved across a range while the rest of the
+panel, the patient and the serum labs stay fixed. The whole grid goes through
+the batch functions in a single vectorized call and only the points where the
+findings or the plan change are reported.
+"""
+import numpy as np
+
+from .batch import interpret_24hr_urine_batch, generate_management_plan_batch
+from .services import (
+    UrineProfile, SerumPanel, PatientContext, Finding, active_rule_set,
+)
+
+
+# Fields that can be swept, with the default range offered by the what-if page
+SWEEP_RANGES = {
+    'volume_L': (0.5, 4.0),
+    'ph': (4.5, 8.0),
+    'calcium_mg': (0, 500),
+    'oxalate_mg': (0, 150),
+    'citrate_mg': (0, 1200),
+    'uric_acid_mg': (0, 1500),
+    'sodium_mEq': (0, 300),
+    'sulfate_mmol': (0, 80),
+    'ammonium_mmol': (0, 100),
+    'cystine_mg': (0, 800),
+}
+
+MAX_SWEEP_POINTS = 5000
+
+
+def finding_label(name):
+    """Display label of a Finding name, e.g. URINE_OXALATE_VERY_HIGH -> Oxalate very high"""
+    label = name.removeprefix('URINE_').replace('_', ' ').capitalize()
+    return label.replace('Ph ', 'pH ')
+
+
+def sweep_grid(field, start, stop, points):
+    """
+    points evenly spaced values from start to stop. Integer fields are
+    rounded and deduplicated, so the grid may come out shorter.
+    """
+    grid = np.linspace(start, stop, points)
+    if UrineProfile.__annotations__[field] is int:
+        grid = np.unique(np.rint(grid))
+        if start > stop:
+            grid = grid[::-1]
+    return grid
+
+
+def parameter_sweep(field, start, stop, points, urine_profile, patient_profile=None,
+                    serum_labs=None, stone_type="Calcium Oxalate"):
+    """
+    Evaluates the urine rules and the management plan with field taking
+    points values from start to stop.
+    Returns the state at the first grid value and one transition per grid
+    value where the finding code or the plan differs from the previous one,
+    with the findings and plan items that appeared or disappeared there.
+    """
+    if field not in SWEEP_RANGES:
+        raise ValueError(f"Cannot sweep '{field}'")
+    if not 2 <= points <= MAX_SWEEP_POINTS:
+        raise ValueError(f"points must be between 2 and {MAX_SWEEP_POINTS}")
+
+    urine = UrineProfile.coerce(urine_profile)
+    patient = PatientContext.coerce(patient_profile)
+    serum = SerumPanel.coerce(serum_labs)
+    # Age and sex are fixed, so the reference range is resolved once
+    rule_set = active_rule_set().for_patient(patient.age, patient.gender)
+
+    grid = sweep_grid(field, start, stop, points)
+    n = len(grid)
+    columns = {name: np.full(n, value, dtype=float) for name, value in urine._asdict().items()}
+    columns[field] = grid
+    serum_columns = None if serum is None else {
+        name: np.full(n, value, dtype=float) for name, value in serum._asdict().items()}
+    conditions = [patient.medical_conditions] * n
+
+    codes = interpret_24hr_urine_batch(columns, conditions, rule_set=rule_set)
+    plan_ids, plan_table = generate_management_plan_batch(
+        stone_type, codes, conditions, [patient.medications] * n,
+        serum_columns=serum_columns, rule_set=rule_set)
+
+    changed = np.flatnonzero((codes[1:] != codes[:-1]) | (plan_ids[1:] != plan_ids[:-1])) + 1
+    transitions = []
+    for index in changed:
+        before, after = int(codes[index - 1]), int(codes[index])
+        plan_before, plan_after = plan_table[plan_ids[index - 1]], plan_table[plan_ids[index]]
+        transitions.append({
+            'at': grid[index].item(),
+            'previous': grid[index - 1].item(),
+            'findings': Finding.names(after),
+            'findings_added': Finding.names(after & ~before),
+            'findings_removed': Finding.names(before & ~after),
+            'plan_added': [item for item in plan_after if item not in plan_before],
+            'plan_removed': [item for item in plan_before if item not in plan_after],
+        })
+
+    return {
+        'field': field,
+        'stone_type': stone_type,
+        'points': n,
+        'rule_version': rule_set.stamp,
+        'initial': {
+            'at': grid[0].item(),
+            'findings': Finding.names(int(codes[0])),
+            'plan': list(plan_table[plan_ids[0]]),
+        },
+        'transitions': transitions,
+    }
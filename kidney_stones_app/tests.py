@@ -1,3 +1,1328 @@
-from django.test import TestCase
+from io import StringIO
+from collections import Counter
+import itertools
+import json
+import os
+import pickle
+import tempfile
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
 
-# Create your tests here.
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+import numpy as np
+
+from kidney_stones_engine import equivalence, rulepack, tracing
+from kidney_stones_engine.records import UrineProfile, SerumPanel, PatientContext, RecordArray
+from kidney_stones_engine.rules import (
+    ACUTE_SYMPTOMS, STONE_SIZES, _evaluate_acute_guidance, get_acute_management_guidance,
+    URINE_FIELDS, evaluate_24hr_urine, render_findings, generate_management_plan, RuleSet, DEFAULT_RULE_SET,
+    DEFAULT_THRESHOLDS, Finding, active_rule_set, activate_rule_set, SERUM_FIELDS, UrineFindings,
+    interpret_24hr_urine, plan_conditions, PLAN_STEPS,
+)
+
+from .models import (
+    PatientProfile, UrineAnalysis, SerumLabs, ManagementPlan, OxalateContent, QuantileSketch,
+    FoodDiaryEntry, OxalateIntakeRollup, UrineTrend, PendingQuantileValues,
+)
+from .supersaturation import relative_supersaturation, supersaturation_for_panel
+from .cache import (
+    LRUCache, cached_interpretation, cached_management_plan, interpretation_cache, plan_cache,
+)
+from .sweep import SWEEP_RANGES, parameter_sweep
+from .uncertainty import measurement_uncertainty, cohort_uncertainty
+from . import similarity
+from .similarity import SIMILARITY_FEATURES, KDTree, SimilarityIndex
+from .stone_type import feature_matrix, load_stone_type_model, train_stone_type_model
+from .diet import OxalateRankings, RankedFood, diet_guidance, refresh_oxalate_rankings
+from .meal_plan import VARIETY_WEIGHTS, plan_meals
+from .diary import intake_totals, rebuild_rollups
+from .trends import patient_history, rebuild_trends
+from .quantiles import TDigest, fold_pending, population_percentiles, rebuild_sketches, record_panel
+from .parallel import interpret_cohort
+from .columnar import load_columns, load_urine_columns
+from . import parallel, trends
+from .batch import expand_plans, interpret_24hr_urine_batch, generate_management_plan_batch
+from .management.commands.benchmark import random_cohort, cohort_records, BENCHMARK_REFERENCE_RANGES
+from .recurrence import ROKS_FIELDS, ROKS_VERSION, roks_recurrence, roks_recurrence_batch
+
+
+class AcuteGuidanceTableTests(SimpleTestCase):
+    """The precomputed guidance table must match the branching rules for every input"""
+
+    def test_table_matches_rules_exhaustively(self):
+        for flags in itertools.product((False, True), repeat=len(ACUTE_SYMPTOMS)):
+            symptoms = dict(zip(ACUTE_SYMPTOMS, flags))
+            for stone_size in STONE_SIZES + ("not measured",):
+                with self.subTest(symptoms=symptoms, stone_size=stone_size):
+                    guidance = get_acute_management_guidance(symptoms, stone_size)
+                    expected = _evaluate_acute_guidance(symptoms, stone_size)
+                    self.assertEqual(
+                        {**guidance, 'recommendations': list(guidance['recommendations'])},
+                        expected)
+
+    def test_missing_symptoms_default_to_false(self):
+        self.assertIs(
+            get_acute_management_guidance({}, "Unknown"),
+            get_acute_management_guidance(dict.fromkeys(ACUTE_SYMPTOMS, False), "Unknown"))
+
+    def test_guidance_is_read_only(self):
+        guidance = get_acute_management_guidance({'fevers': True}, "< 5mm")
+        with self.assertRaises(TypeError):
+            guidance['urgency_level'] = 'routine'
+
+
+class LazyInterpretationTests(SimpleTestCase):
+    """findings.interpretation() must match render_findings without rendering up front"""
+
+    urine = UrineProfile(2.0, 5.5, 200, 90, 800, 800, 150, 60, 100, 35, 50, 300, 450)
+
+    def test_matches_render_findings(self):
+        findings = evaluate_24hr_urine(self.urine, {'medical_conditions': []})
+        interpretation = findings.interpretation()
+        self.assertEqual(list(interpretation), list(render_findings(findings)))
+        self.assertEqual(dict(interpretation), render_findings(findings))
+        self.assertEqual(list(interpretation.as_dict().items()),
+                         list(render_findings(findings).items()))
+
+    def test_keys_do_not_render_messages(self):
+        interpretation = evaluate_24hr_urine(self.urine).interpretation()
+        self.assertIn('urine_oxalate', interpretation)
+        self.assertEqual(list(interpretation._rendered), ['supersaturation_targets'])
+        self.assertIn('consider primary hyperoxaluria', interpretation['urine_oxalate'])
+        self.assertIn('urine_oxalate', interpretation._rendered)
+
+    def test_missing_key(self):
+        interpretation = evaluate_24hr_urine(self.urine._replace(oxalate_mg=20)).interpretation()
+        with self.assertRaises(KeyError):
+            interpretation['urine_oxalate']
+
+
+class ServicesCacheTests(SimpleTestCase):
+    """LRU order, TTL expiry, counters and rule-set keys of the services caches"""
+
+    def setUp(self):
+        interpretation_cache.clear()
+        plan_cache.clear()
+        self.addCleanup(interpretation_cache.clear)
+        self.addCleanup(plan_cache.clear)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now the least recently used
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats(), {
+            'size': 2, 'maxsize': 2, 'ttl': None, 'hits': 3, 'misses': 1,
+            'evictions': 1, 'expirations': 0, 'hit_rate': 0.75})
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        with mock.patch('kidney_stones_app.cache.time.monotonic', return_value=1000.0):
+            cache.set('a', 1)
+        with mock.patch('kidney_stones_app.cache.time.monotonic', return_value=1059.0):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('kidney_stones_app.cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses'], stats['expirations']),
+                         (0, 1, 1, 1))
+
+    def test_interpretations_are_keyed_on_the_patient_variant(self):
+        self.addCleanup(activate_rule_set, activate_rule_set(rulepack.load_rule_pack(
+            os.path.join(settings.BASE_DIR, 'rule_packs', 'sex_specific_uric_acid.json'))))
+        urine = LazyInterpretationTests.urine._replace(uric_acid_mg=780)
+        male, _ = cached_interpretation(urine, {'age': 40, 'gender': 'Male'})
+        female, _ = cached_interpretation(urine, {'age': 40, 'gender': 'Female'})
+        self.assertNotIn(Finding.URINE_URIC_ACID_HIGH, male)
+        self.assertIn(Finding.URINE_URIC_ACID_HIGH, female)
+        self.assertEqual(interpretation_cache.stats()['misses'], 2)
+
+        again, _ = cached_interpretation(urine, {'age': 41, 'gender': 'Female'})
+        self.assertIs(again, female)
+        self.assertEqual(interpretation_cache.stats()['hits'], 1)
+        self.assertEqual(cached_management_plan('Uric Acid', female, {}),
+                         generate_management_plan('Uric Acid', female, {}))
+        cached_management_plan('Uric Acid', female, {})
+        self.assertEqual((plan_cache.stats()['misses'], plan_cache.stats()['hits']), (1, 1))
+
+    def test_reloaded_rule_set_is_not_served_stale_entries(self):
+        urine = LazyInterpretationTests.urine._replace(oxalate_mg=35)
+        findings, _ = cached_interpretation(urine)
+        self.assertNotIn(Finding.URINE_OXALATE_HIGH, findings)
+
+        strict = RuleSet('strict', {'oxalate_mg_max': 30})
+        self.addCleanup(activate_rule_set, activate_rule_set(strict))
+        findings, interpretation = cached_interpretation(urine)
+        self.assertIn(Finding.URINE_OXALATE_HIGH, findings)
+        self.assertIs(findings.rule_set, strict)
+        self.assertIn('urine_oxalate', interpretation)
+        self.assertEqual(interpretation_cache.stats()['hits'], 0)
+
+
+class ParameterSweepTests(SimpleTestCase):
+    """Sweep transitions must agree with the scalar rules on both sides of each change"""
+
+    urine = LazyInterpretationTests.urine
+    patient = PatientContext(frozenset(), frozenset(["Topiramate"]), 40, "Male")
+
+    def scalar_state(self, field, value, stone_type):
+        findings = evaluate_24hr_urine(self.urine._replace(**{field: value}), self.patient)
+        return findings.codes, generate_management_plan(stone_type, findings, self.patient)
+
+    def test_transitions_match_scalar_rules(self):
+        for field, (start, stop) in SWEEP_RANGES.items():
+            with self.subTest(field=field):
+                sweep = parameter_sweep(field, start, stop, 3000, self.urine, self.patient,
+                                        stone_type="Calcium Phosphate")
+                for transition in sweep['transitions']:
+                    before = self.scalar_state(field, transition['previous'], sweep['stone_type'])
+                    after = self.scalar_state(field, transition['at'], sweep['stone_type'])
+                    self.assertNotEqual(before, after)
+                    self.assertEqual(Finding.names(after[0]), transition['findings'])
+
+    def test_volume_threshold_is_located(self):
+        sweep = parameter_sweep('volume_L', 0.5, 2.5, 2001, self.urine, self.patient)
+        [transition] = sweep['transitions']
+        self.assertEqual(transition['at'], 2.5)
+        self.assertEqual(transition['findings_removed'], ['URINE_VOLUME_LOW'])
+        self.assertIn('URINE_VOLUME_LOW', sweep['initial']['findings'])
+
+    def test_integer_fields_are_deduplicated(self):
+        sweep = parameter_sweep('citrate_mg', 0, 1000, 5000, self.urine)
+        self.assertEqual(sweep['points'], 1001)
+        self.assertEqual([(t['previous'], t['at']) for t in sweep['transitions']],
+                         [(399.0, 400.0)])
+
+
+class MeasurementUncertaintyTests(SimpleTestCase):
+    """Monte Carlo probabilities of findings and plan items"""
+
+    urine = LazyInterpretationTests.urine
+
+    def test_exact_model_reproduces_the_measured_plan(self):
+        exact = {field: {} for field in UrineProfile._fields}
+        result = measurement_uncertainty(self.urine, samples=500, error_model_overrides=exact)
+        findings = evaluate_24hr_urine(self.urine)
+        self.assertEqual(result['findings'], dict.fromkeys(Finding.names(findings.codes), 1.0))
+        self.assertEqual(result['plan'], [(item, 1.0) for item in result['measured']['plan']])
+        self.assertEqual(result['measured']['plan'],
+                         generate_management_plan("Calcium Oxalate", findings, {}))
+
+    def test_value_at_cutoff_is_uncertain(self):
+        urine = self.urine._replace(calcium_mg=150)
+        result = measurement_uncertainty(urine, samples=10000, seed=1)
+        self.assertNotIn('URINE_CALCIUM_HIGH', result['measured']['findings'])
+        self.assertAlmostEqual(result['findings']['URINE_CALCIUM_HIGH'], 0.5, delta=0.03)
+
+    def test_cohort_results_do_not_depend_on_workers(self):
+        cohort = [(self.urine._replace(citrate_mg=citrate), {}, None, "Calcium Oxalate")
+                  for citrate in (300, 400, 500)]
+        serial = cohort_uncertainty(cohort, samples=1000, seed=7, workers=1)
+        self.assertEqual(cohort_uncertainty(cohort, samples=1000, seed=7, workers=2, chunk=1),
+                         serial)
+        self.assertEqual([result['measured'] for result in serial],
+                         [measurement_uncertainty(*patient, samples=10)['measured']
+                          for patient in cohort])
+
+    def test_workers_use_the_rule_set_passed_in(self):
+        strict = RuleSet('strict-citrate', thresholds={'citrate_mg_min': 600})
+        cohort = [(self.urine._replace(citrate_mg=500), {}, None, "Calcium Oxalate")] * 2
+        pooled = cohort_uncertainty(cohort, samples=200, seed=3, workers=2, chunk=1, rule_set=strict)
+        self.assertEqual(pooled, cohort_uncertainty(cohort, samples=200, seed=3, workers=1,
+                                                    rule_set=strict))
+        for result in pooled:
+            self.assertEqual(result['rule_version'], strict.stamp)
+            self.assertIn('URINE_CITRATE_LOW', result['measured']['findings'])
+
+    def test_unknown_field_in_error_model(self):
+        with self.assertRaises(ValueError):
+            measurement_uncertainty(self.urine, error_model_overrides={'creatinine_mg': {'cv': 1}})
+
+
+class SupersaturationTests(SimpleTestCase):
+    """The ion-pairing solver converges and responds to the panel as chemistry says"""
+
+    urine = UrineProfile(
+        volume_L=1.6, ph=5.9, calcium_mg=220, oxalate_mg=40, phosphorus_mg=900, uric_acid_mg=650,
+        sodium_mEq=160, potassium_mEq=55, magnesium_mg=95, sulfate_mmol=22, ammonium_mmol=35,
+        citrate_mg=450)
+
+    def test_cohort_converges_at_the_default_tolerance(self):
+        urine = random_cohort(2000, seed=11)[0]
+        result = relative_supersaturation(urine)
+        self.assertTrue(result['converged'].all())
+        self.assertTrue(np.isfinite(result['calcium_oxalate']).all())
+
+    def test_scalar_and_vector_paths_agree(self):
+        panels = [self.urine, self.urine._replace(ph=6.8, citrate_mg=200),
+                  self.urine._replace(volume_L=2.5, uric_acid_mg=900)]
+        result = relative_supersaturation(
+            {field: [getattr(panel, field) for panel in panels] for field in URINE_FIELDS})
+        # The vector path iterates until every panel converges, so agreement is to the tolerance
+        for index, panel in enumerate(panels):
+            for salt, value in supersaturation_for_panel(panel).items():
+                np.testing.assert_allclose(value, result[salt][index], rtol=1e-7)
+
+    def test_all_zero_panel_has_no_supersaturation(self):
+        zero = UrineProfile(*[0] * len(URINE_FIELDS))
+        self.assertEqual(supersaturation_for_panel(zero),
+                         {'calcium_oxalate': 0.0, 'calcium_phosphate': 0.0, 'uric_acid': 0.0})
+
+    def test_oxalate_raises_and_citrate_lowers_calcium_oxalate(self):
+        def calcium_oxalate(field, values):
+            return relative_supersaturation({
+                **{name: np.full(len(values), getattr(self.urine, name), dtype=float)
+                   for name in URINE_FIELDS},
+                field: values,
+            })['calcium_oxalate']
+
+        self.assertTrue((np.diff(calcium_oxalate('oxalate_mg', np.arange(10, 101, 10))) > 0).all())
+        self.assertTrue((np.diff(calcium_oxalate('citrate_mg', np.arange(100, 1001, 100))) < 0).all())
+
+
+class StoneTypeModelTests(SimpleTestCase):
+    """Softmax stone-type model: training, export round trip and inference"""
+
+    def synthetic(self, rows=600, seed=0):
+        rng = np.random.default_rng(seed)
+        labels = rng.choice(["Calcium Oxalate", "Uric Acid", "Cystine"], rows)
+        urine = {field: rng.normal(100, 10, rows) for field in URINE_FIELDS}
+        urine['ph'] = np.where(labels == "Uric Acid", 5.2, 6.3) + rng.normal(0, 0.2, rows)
+        urine['cystine_mg'] = np.where(labels == "Cystine", 400, 20) + rng.normal(0, 30, rows)
+        return feature_matrix(urine), labels
+
+    def test_learns_separable_classes_and_round_trips(self):
+        features, labels = self.synthetic()
+        model = train_stone_type_model(features, labels)
+        self.assertGreater((model.predict(features)[0] == labels).mean(), 0.95)
+        # Classes without examples are never predicted
+        self.assertLess(model.predict_proba(features)[:, 3].max(), 1e-6)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.npz')
+            model.save(path)
+            loaded = load_stone_type_model(path)
+        np.testing.assert_allclose(loaded.predict_proba(features), model.predict_proba(features))
+
+    def test_predict_one_matches_batch(self):
+        features, labels = self.synthetic(rows=100)
+        model = train_stone_type_model(features, labels, iterations=50)
+        urine = LazyInterpretationTests.urine
+        serum = SerumPanel(10.0, 40, 24, 4.0, 1.0)
+        matrix = feature_matrix({field: [value] for field, value in urine._asdict().items()},
+                                {field: [value] for field, value in serum._asdict().items()})
+        stone_types, probabilities = model.predict(matrix)
+        self.assertEqual(model.predict_one(urine, serum),
+                         (stone_types[0], float(probabilities[0])))
+        self.assertEqual(feature_matrix(
+            {field: [value] for field, value in urine._asdict().items()})[0, -1], 0)
+
+
+class RuleTracingTests(SimpleTestCase):
+    """Per-rule counters recorded while tracing is enabled"""
+
+    def tearDown(self):
+        tracing.disable()
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(tracing.snapshot())
+
+    def test_counts_evaluated_and_fired_rules(self):
+        tracing.enable()
+        urine = LazyInterpretationTests.urine
+        findings = evaluate_24hr_urine(urine)
+        evaluate_24hr_urine(urine._replace(ph=6.5, oxalate_mg=20))
+        generate_management_plan("Uric Acid", findings, {'medical_conditions': []})
+        snapshot = tracing.snapshot()
+
+        rules = snapshot['urine']['rules']
+        self.assertEqual(snapshot['urine']['calls'], 2)
+        self.assertEqual(rules['URINE_PH_ACIDIC'], {'evaluated': 2, 'fired': 1})
+        self.assertEqual(rules['URINE_PH_VERY_ALKALINE'], {'evaluated': 1, 'fired': 0})
+        self.assertEqual(rules['URINE_OXALATE_VERY_HIGH'], {'evaluated': 1, 'fired': 1})
+
+        plan = snapshot['plan']
+        self.assertEqual(plan['stone_types'], {"Uric Acid": 1})
+        self.assertEqual(plan['conditions']['hyperuricosuria'], {'evaluated': 1, 'fired': 1})
+        fired = [step['text'] for step in plan['steps'] if step['fired']]
+        self.assertEqual(fired, generate_management_plan(
+            "Uric Acid", findings, {'medical_conditions': []}))
+
+
+class RulePackTests(SimpleTestCase):
+    """Rule packs move thresholds and messages together and reload atomically"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pack.json')
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(activate_rule_set, activate_rule_set(DEFAULT_RULE_SET))
+
+    def write(self, data):
+        with open(self.path, 'w') as pack:
+            json.dump(data, pack)
+
+    def test_shipped_default_pack_matches_defaults(self):
+        path = os.path.join(settings.BASE_DIR, 'rule_packs', 'default.json')
+        rule_set = rulepack.load_rule_pack(path)
+        self.assertEqual(dict(rule_set.thresholds), dict(DEFAULT_THRESHOLDS))
+        self.assertEqual(rule_set.reference_ranges, DEFAULT_RULE_SET.reference_ranges)
+
+    def test_sex_specific_limits_are_opt_in(self):
+        urine = LazyInterpretationTests.urine._replace(uric_acid_mg=780)
+        male, female = {'age': 40, 'gender': 'Male'}, {'age': 40, 'gender': 'Female'}
+        self.assertEqual(DEFAULT_RULE_SET.reference_ranges, ())
+        for patient in (male, female, None):
+            self.assertIn(Finding.URINE_URIC_ACID_HIGH, evaluate_24hr_urine(urine, patient))
+
+        rule_set = rulepack.load_rule_pack(
+            os.path.join(settings.BASE_DIR, 'rule_packs', 'sex_specific_uric_acid.json'))
+        self.assertNotIn(Finding.URINE_URIC_ACID_HIGH, evaluate_24hr_urine(urine, male, rule_set))
+        self.assertIn(Finding.URINE_URIC_ACID_HIGH, evaluate_24hr_urine(urine, female, rule_set))
+        self.assertNotIn(Finding.URINE_URIC_ACID_HIGH,
+                         evaluate_24hr_urine(urine._replace(uric_acid_mg=800), male, rule_set))
+        self.assertIn(Finding.URINE_URIC_ACID_HIGH,
+                      evaluate_24hr_urine(urine._replace(uric_acid_mg=801), male, rule_set))
+
+    def test_equivalence_harness_exercises_sex_and_age(self):
+        profiles = equivalence.patient_profiles()
+        self.assertEqual({profile['gender'] for profile in profiles}, {None, 'Male', 'Female', 'Other'})
+        self.assertEqual({profile['age'] for profile in profiles}, {None, 45, 70})
+        # Two panels with uric acid at 751 mg/d
+        start = [urine['uric_acid_mg'] for urine in equivalence.urine_panels()].index(751)
+        checked, mismatches = equivalence.check_slice(start, start + 2)
+        self.assertEqual((checked, mismatches), (2 * len(profiles) * 17 * 7, []))
+        # The harness catches a default that treats men differently
+        activate_rule_set(rulepack.load_rule_pack(
+            os.path.join(settings.BASE_DIR, 'rule_packs', 'sex_specific_uric_acid.json')))
+        _, mismatches = equivalence.check_slice(start, start + 2)
+        self.assertTrue(mismatches)
+        self.assertEqual({mismatch[2 if mismatch[0] == 'interpretation' else 3]['gender']
+                          for mismatch in mismatches}, {'Male'})
+
+    def test_thresholds_change_findings_and_messages(self):
+        rule_set = rulepack.parse_rule_pack(
+            {'version': 'test', 'thresholds': {'oxalate_mg_max': 95}})
+        urine = LazyInterpretationTests.urine
+        self.assertIn('urine_oxalate', render_findings(evaluate_24hr_urine(urine)))
+        interpretation = render_findings(evaluate_24hr_urine(urine, rule_set=rule_set))
+        self.assertNotIn('urine_oxalate', interpretation)
+        self.assertIn('Goal is ~2.5 L/d', interpretation['urine_volume'])
+
+        rule_set = RuleSet('test', {'volume_L_min': 3})
+        interpretation = render_findings(evaluate_24hr_urine(urine, rule_set=rule_set))
+        self.assertIn('Goal is ~3 L/d', interpretation['urine_volume'])
+
+    def test_invalid_packs_are_rejected(self):
+        for data in ({'thresholds': {}}, {'version': 1, 'thresholds': {'oxalate': 45}},
+                     {'version': 1, 'thresholds': {'oxalate_mg_max': '45'}}, []):
+            with self.subTest(data=data), self.assertRaises(rulepack.RulePackError):
+                rulepack.parse_rule_pack(data)
+
+    def test_watcher_swaps_and_keeps_last_good_pack(self):
+        self.write({'version': 'v1', 'thresholds': {}})
+        watcher = rulepack.RulePackWatcher(self.path, interval=0)
+        self.assertEqual(watcher.load().version, 'v1')
+
+        self.write({'version': 'v2', 'thresholds': {'citrate_mg_min': 320}})
+        os.utime(self.path, ns=(0, 10 ** 18))
+        self.assertEqual(watcher.poll().version, 'v2')
+        self.assertEqual(active_rule_set().thresholds['citrate_mg_min'], 320)
+
+        with open(self.path, 'w') as pack:
+            pack.write('{"version": ')
+        os.utime(self.path, ns=(0, 2 * 10 ** 18))
+        with self.assertLogs('kidney_stones_engine.rulepack', 'ERROR'):
+            self.assertEqual(watcher.poll().version, 'v2')
+
+
+class ReferenceRangeTests(SimpleTestCase):
+    """Age/sex reference ranges pick the right compiled variant"""
+
+    rule_set = RuleSet('test', reference_ranges=[
+        {'sex': 'Male', 'thresholds': {'uric_acid_mg_max': 800}},
+        {'age_min': 18, 'age_max': 40, 'thresholds': {'oxalate_mg_max': 45}},
+        {'sex': 'Female', 'age_min': 50, 'thresholds': {'citrate_mg_min': 550}},
+    ])
+
+    def limit(self, name, age, sex):
+        return self.rule_set.for_patient(age, sex).thresholds[name]
+
+    def test_age_bands_are_half_open(self):
+        self.assertEqual([self.limit('oxalate_mg_max', age, None) for age in (17, 18, 39.9, 40)],
+                         [40, 45, 45, 40])
+
+    def test_sex_specific_and_shared_ranges_combine(self):
+        self.assertEqual(self.limit('uric_acid_mg_max', 30, 'Male'), 800)
+        self.assertEqual(self.limit('oxalate_mg_max', 30, 'Male'), 45)
+        self.assertEqual(self.limit('citrate_mg_min', 60, 'Female'), 550)
+        self.assertEqual(self.limit('citrate_mg_min', 60, 'Male'), 400)
+        self.assertEqual(self.limit('uric_acid_mg_max', 30, 'Other'), 750)
+
+    def test_unknown_age_uses_ranges_without_age_band(self):
+        self.assertEqual(self.limit('uric_acid_mg_max', None, 'Male'), 800)
+        self.assertEqual(self.limit('oxalate_mg_max', None, 'Male'), 40)
+
+    def test_findings_and_messages_use_the_patient_variant(self):
+        urine = LazyInterpretationTests.urine._replace(oxalate_mg=44)
+        findings = evaluate_24hr_urine(urine, {'age': 30, 'gender': 'Male'}, self.rule_set)
+        self.assertNotIn('urine_oxalate', render_findings(findings))
+        findings = evaluate_24hr_urine(urine, {'age': 45, 'gender': 'Male'}, self.rule_set)
+        self.assertIn('Values >40 mg/d', render_findings(findings)['urine_oxalate'])
+
+
+class EngineRecordTests(TestCase):
+    """Records built from model instances, values() rows and RecordArray columns agree"""
+
+    def setUp(self):
+        self.patient = PatientProfile.objects.create(
+            age=47, gender='Female', num_prior_stones=2, bmi=Decimal('27.5'), fluid_intake_L=2,
+            medical_conditions=['Gout', 'Renal Tubular Acidosis'], medications=['Thiazide'])
+        self.panel = UrineAnalysis.objects.create(
+            patient_profile=self.patient, volume_L=Decimal('1.3'), ph=Decimal('5.2'),
+            calcium_mg=310, oxalate_mg=52, phosphorus_mg=1150, uric_acid_mg=820, sodium_mEq=210,
+            potassium_mEq=45, magnesium_mg=70, sulfate_mmol=30, ammonium_mmol=45, citrate_mg=250,
+            cystine_mg=12)
+        self.labs = SerumLabs.objects.create(
+            patient_profile=self.patient, calcium_mg_dL=Decimal('10.7'), intact_pth_pg_mL=72,
+            bicarbonate_mEq_L=21, potassium_mEq_L=Decimal('3.4'), creatinine_mg_dL=Decimal('1.05'))
+
+    def test_from_values_equals_from_instance(self):
+        panel = UrineAnalysis.objects.get(pk=self.panel.pk)
+        urine = UrineProfile.from_instance(panel)
+        self.assertEqual(UrineProfile.from_values(UrineAnalysis.objects.values().get(pk=panel.pk)),
+                         urine)
+        self.assertEqual(urine.volume_L, 1.3)
+        self.assertIsInstance(urine.ph, float)
+        self.assertEqual(urine.cystine_mg, 12)
+        self.assertEqual(SerumPanel.from_values(SerumLabs.objects.values().get(pk=self.labs.pk)),
+                         SerumPanel.from_instance(SerumLabs.objects.get(pk=self.labs.pk)))
+        self.assertEqual(PatientContext.from_values(PatientProfile.objects.values().get(pk=self.patient.pk)),
+                         PatientContext.from_instance(PatientProfile.objects.get(pk=self.patient.pk)))
+
+    def test_record_array_columns_match_the_scalar_interpretation(self):
+        urine, *_ = random_cohort(200, seed=11)
+        profiles = [UrineProfile(*(urine[field][i].item() for field in URINE_FIELDS)) for i in range(200)]
+        records = RecordArray(UrineProfile, profiles[:150])
+        for profile in profiles[150:]:
+            records.append(profile)
+        records.append(UrineProfile.from_instance(self.panel))
+        profiles.append(UrineProfile.from_instance(self.panel))
+
+        self.assertEqual(len(records), 201)
+        self.assertEqual(list(records), profiles)
+        self.assertEqual(records[-1], profiles[-1])
+        self.assertEqual(records.nbytes, 201 * 8 * len(URINE_FIELDS))
+        columns = records.columns()
+        self.assertEqual(list(columns), list(URINE_FIELDS))
+        codes = interpret_24hr_urine_batch({field: np.asarray(column) for field, column in columns.items()})
+        for code, profile in zip(codes.tolist(), profiles):
+            self.assertEqual(render_findings(UrineFindings(code, profile, active_rule_set())),
+                             interpret_24hr_urine(profile))
+
+
+class ManagementPlanTests(SimpleTestCase):
+    """Every PLAN_STEPS condition, per stone type, from findings or a legacy interpretation dict"""
+
+    def setUp(self):
+        self.abnormal = (
+            UrineProfile(1.2, 6.5, 320, 60, 900, 850, 180, 40, 80, 35, 50, 250, 10),
+            PatientContext(frozenset({'Malabsorption (IBD, Bariatric Surgery, etc.)', 'chronic_diarrhea',
+                                      'Renal Tubular Acidosis'}), frozenset({'Topiramate'}), 52, 'Male'),
+            SerumPanel(11.2, 85, 19, 3.1, 1.1))
+        self.normal = (
+            UrineProfile(2.6, 6.2, 120, 30, 800, 500, 90, 60, 100, 20, 30, 650, 10),
+            PatientContext(frozenset(), frozenset({'Topiramate'}), 52, 'Male'),
+            SerumPanel(9.4, 40, 25, 4.2, 0.9))
+
+    def test_plan_conditions(self):
+        urine, patient, serum = self.abnormal
+        conditions = plan_conditions(evaluate_24hr_urine(urine, patient), patient, serum)
+        self.assertEqual({step[1] for step in PLAN_STEPS if step[1]}, set(conditions))
+        self.assertTrue(all(conditions.values()), conditions)
+        urine, patient, serum = self.normal
+        self.assertFalse(any(plan_conditions(evaluate_24hr_urine(urine, patient), patient, serum).values()))
+        # Serum conditions need serum labs; RTA alone still means acidosis
+        urine, patient, _ = self.abnormal
+        conditions = plan_conditions(evaluate_24hr_urine(urine, patient), patient)
+        self.assertEqual([name for name, value in conditions.items() if not value],
+                         ['hyperparathyroidism', 'hypokalemia'])
+        self.assertTrue(conditions['acidosis'])
+
+    def test_plan_steps_of_every_stone_type(self):
+        for stone_type in ('Calcium Oxalate', 'Calcium Phosphate', 'Uric Acid', 'Struvite', 'Cystine',
+                           'Drug-induced', 'Unknown'):
+            steps = [step for step in PLAN_STEPS if step[0] in (None, stone_type)]
+            for (urine, patient, serum), expected in (
+                    (self.abnormal, [text for _, _, text in steps]),
+                    (self.normal, [text for _, condition, text in steps if condition is None])):
+                with self.subTest(stone_type=stone_type, abnormal=urine is self.abnormal[0]):
+                    findings = evaluate_24hr_urine(urine, patient)
+                    self.assertEqual(generate_management_plan(stone_type, findings, patient, serum), expected)
+                    self.assertEqual(generate_management_plan(
+                        stone_type, findings.interpretation(), patient, serum), expected)
+                    self.assertEqual(generate_management_plan(
+                        stone_type, render_findings(findings), patient._asdict(), serum._asdict()), expected)
+
+    def test_legacy_interpretation_dict(self):
+        urine, patient, serum = self.abnormal
+        findings = evaluate_24hr_urine(urine, patient)
+        legacy = json.loads(json.dumps(interpret_24hr_urine(urine._asdict(), patient._asdict())))
+        self.assertEqual(UrineFindings.coerce(legacy).codes, findings.codes)
+        self.assertEqual(UrineFindings.coerce({'supersaturation_targets': ''}).codes, 0)
+        with self.assertRaises(TypeError):
+            generate_management_plan('Calcium Oxalate', None, patient, serum)
+
+
+class BatchServiceTests(SimpleTestCase):
+    """The vectorized batch functions give the scalar services' output row by row"""
+
+    def test_random_cohort_matches_the_scalar_services(self):
+        rows = 600
+        urine, serum, conditions, medications, stone_types = random_cohort(rows, seed=7)
+        rng = np.random.default_rng(7)
+        ages = rng.integers(5, 95, rows).astype(float)
+        ages[rng.random(rows) < 0.1] = np.nan
+        genders = rng.choice(np.array(['Male', 'Female', 'Other', None], dtype=object), rows)
+        self.assertTrue(any("Renal Tubular Acidosis" in row for row in conditions))
+        self.assertTrue(any(medications))
+        urine_rows, serum_rows, _ = cohort_records(urine, serum, conditions, medications)
+        patients = [PatientContext(frozenset(conditions[i]), frozenset(medications[i]),
+                                   None if np.isnan(ages[i]) else int(ages[i]), genders[i])
+                    for i in range(rows)]
+
+        for rule_set in (DEFAULT_RULE_SET,
+                         RuleSet('bands', reference_ranges=BENCHMARK_REFERENCE_RANGES)):
+            codes = interpret_24hr_urine_batch(urine, conditions, rule_set, ages, genders)
+            plans = expand_plans(*generate_management_plan_batch(
+                stone_types, codes, conditions, medications, serum, rule_set, ages, genders))
+            for i in range(rows):
+                findings = evaluate_24hr_urine(urine_rows[i], patients[i], rule_set)
+                self.assertEqual(int(codes[i]), findings.codes)
+                variant = rule_set.for_patient(patients[i].age, patients[i].gender)
+                self.assertEqual(render_findings(UrineFindings(int(codes[i]), urine_rows[i], variant)),
+                                 render_findings(findings))
+                self.assertEqual(plans[i], generate_management_plan(
+                    stone_types[i], findings, patients[i], serum_rows[i]))
+
+    def test_missing_serum_labs_fire_no_serum_condition(self):
+        urine, _, conditions, medications, stone_types = random_cohort(300, seed=11)
+        codes = interpret_24hr_urine_batch(urine, conditions)
+        without = expand_plans(*generate_management_plan_batch(
+            stone_types, codes, conditions, medications))
+        partial = {'creatinine_mg_dL': np.ones(300)}
+        self.assertEqual(expand_plans(*generate_management_plan_batch(
+            stone_types, codes, conditions, medications, partial)), without)
+        with mock.patch.object(parallel, 'MIN_SLICE_ROWS', 60):
+            pooled = interpret_cohort(urine, conditions, medications, stone_types, partial, workers=2)
+        self.assertEqual(expand_plans(*pooled[1:]), without)
+
+
+class ParallelCohortTests(SimpleTestCase):
+    """interpret_cohort gives the single-process results in input order"""
+
+    def test_pool_matches_a_single_process(self):
+        urine, serum, conditions, medications, stone_types = random_cohort(500, seed=3)
+        ages = np.arange(500) % 70 + 18.0
+        ages[::7] = np.nan
+        genders = ['Male', 'Female', None, 'Female', 'Male'] * 100
+        rule_set = pickle.loads(pickle.dumps(ReferenceRangeTests.rule_set))
+        self.assertEqual(rule_set.stamp, ReferenceRangeTests.rule_set.stamp)
+
+        arguments = (urine, conditions, medications, stone_types, serum, ages, genders, rule_set)
+        codes, plan_ids, plan_table = interpret_cohort(*arguments, workers=1)
+        with mock.patch.object(parallel, 'MIN_SLICE_ROWS', 60):
+            pooled = interpret_cohort(*arguments, workers=2)
+        np.testing.assert_array_equal(pooled[0], codes)
+        self.assertEqual(expand_plans(*pooled[1:]), expand_plans(plan_ids, plan_table))
+        self.assertEqual(len(pooled[2]), len(plan_table))
+
+
+class ReinterpretPlansCommandTests(TestCase):
+    """reinterpret_plans refreshes stale plans and stamps them"""
+
+    def setUp(self):
+        patient = PatientProfile.objects.create(
+            age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2,
+            medical_conditions=[], medications=[])
+        urine = UrineAnalysis.objects.create(
+            patient_profile=patient, volume_L=1.5, ph=5.5, calcium_mg=200, oxalate_mg=45,
+            phosphorus_mg=800, uric_acid_mg=600, sodium_mEq=150, potassium_mEq=60,
+            magnesium_mg=100, sulfate_mmol=25, ammonium_mmol=40, citrate_mg=300)
+        self.plans = ManagementPlan.objects.bulk_create([
+            ManagementPlan(patient_profile=patient, urine_analysis=urine,
+                           stone_type="Calcium Oxalate", rule_version=version)
+            for version in ('', 'old', DEFAULT_RULE_SET.stamp)
+        ])
+        self.urine_record = UrineProfile.from_instance(urine)
+        self.patient_record = PatientContext.from_instance(patient)
+
+    def test_stale_plans_are_recomputed_in_batches(self):
+        out = StringIO()
+        call_command('reinterpret_plans', '--batch-size', '1', stdout=out)
+        self.assertIn('Re-interpreted 2 plans', out.getvalue())
+
+        findings = evaluate_24hr_urine(self.urine_record, self.patient_record)
+        for plan in ManagementPlan.objects.all():
+            self.assertEqual(plan.rule_version, DEFAULT_RULE_SET.stamp)
+        stale = ManagementPlan.objects.get(pk=self.plans[0].pk)
+        self.assertEqual(stale.urine_interpretation, render_findings(findings))
+        self.assertEqual(stale.recommendations, generate_management_plan(
+            "Calcium Oxalate", findings, self.patient_record))
+
+    def test_checkpoint_resumes_after_last_id(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint')
+            call_command('reinterpret_plans', '--limit', '1', '--checkpoint', checkpoint,
+                         stdout=StringIO())
+            with open(checkpoint) as f:
+                self.assertEqual(int(f.read()), self.plans[0].pk)
+            out = StringIO()
+            call_command('reinterpret_plans', '--checkpoint', checkpoint, stdout=out)
+            self.assertIn(f'1 stale plans after id {self.plans[0].pk}', out.getvalue())
+
+
+class ScoreCohortCommandTests(SimpleTestCase):
+    """score_cohort streams batch findings and resumes from its checkpoint"""
+
+    ROWS = [
+        {'id': 'a', 'volume_L': 1.5, 'ph': 5.5, 'calcium_mg': 300, 'oxalate_mg': 45,
+         'phosphorus_mg': 800, 'uric_acid_mg': 600, 'sodium_mEq': 150, 'potassium_mEq': 60,
+         'magnesium_mg': 100, 'sulfate_mmol': 25, 'ammonium_mmol': 40, 'citrate_mg': 300,
+         'stone_type': 'Calcium Oxalate', 'medications': ['Topiramate']},
+        {'id': 'b', 'volume_L': 2.8, 'ph': 6.2, 'calcium_mg': 150, 'oxalate_mg': 30,
+         'phosphorus_mg': 800, 'uric_acid_mg': 500, 'sodium_mEq': 100, 'potassium_mEq': 60,
+         'magnesium_mg': 100, 'sulfate_mmol': 20, 'ammonium_mmol': 30, 'citrate_mg': 700,
+         'calcium_mg_dL': 10.8, 'intact_pth_pg_mL': 90, 'bicarbonate_mEq_L': 24,
+         'potassium_mEq_L': 4.0, 'creatinine_mg_dL': 1.0,
+         'medical_conditions': ['Renal Tubular Acidosis'], 'age': 60, 'gender': 'Female'},
+        {'id': 'c', 'volume_L': '', 'ph': 6.0},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write_csv(self, rows):
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with open(self.path('cohort.csv'), 'w', newline='') as f:
+            f.write(','.join(columns) + '\n')
+            for row in rows:
+                values = [row.get(column, '') for column in columns]
+                f.write(','.join(';'.join(value) if isinstance(value, list) else str(value)
+                                 for value in values) + '\n')
+        return self.path('cohort.csv')
+
+    def expected(self, row):
+        urine = UrineProfile.from_dict(row)
+        patient = PatientContext(frozenset(row.get('medical_conditions', ())),
+                                 frozenset(row.get('medications', ())),
+                                 row.get('age'), row.get('gender'))
+        serum = SerumPanel.from_dict(row) if 'calcium_mg_dL' in row else None
+        findings = evaluate_24hr_urine(urine, patient)
+        return (Finding.names(findings.codes),
+                generate_management_plan(row.get('stone_type', 'Unknown'),
+                                         findings, patient, serum))
+
+    def score(self, source, *args, output='out.ndjson'):
+        call_command('score_cohort', source, self.path(output), *args, stdout=StringIO())
+        with open(self.path(output)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_csv_and_ndjson_match_the_scalar_services(self):
+        with open(self.path('cohort.ndjson'), 'w') as f:
+            f.writelines(json.dumps(row) + '\n' for row in self.ROWS)
+        for source in (self.write_csv(self.ROWS), self.path('cohort.ndjson')):
+            rows = self.score(source, '--chunk-size', '2')
+            self.assertEqual([row['id'] for row in rows], ['a', 'b', 'c'])
+            for row, scored in zip(self.ROWS[:2], rows):
+                self.assertEqual((scored['findings'], scored['plan']), self.expected(row))
+            self.assertEqual(rows[2]['error'], 'Missing or invalid volume_L')
+
+    def test_checkpoint_resumes_and_drops_partial_output(self):
+        source = self.write_csv(self.ROWS[:2] * 3)
+        complete = self.score(source, '--chunk-size', '2')
+
+        checkpoint = self.path('checkpoint')
+        self.score(source, '--chunk-size', '2', '--checkpoint', checkpoint)
+        with open(checkpoint) as f:
+            offset, output_offset = map(int, f.read().split())
+        self.assertEqual(offset, os.path.getsize(source))
+        # Pretend the run stopped after its first chunk, halfway through writing the second
+        with open(self.path('out.ndjson'), 'rb') as f:
+            lines = f.readlines()
+        with open(self.path('out.ndjson'), 'wb') as f:
+            f.writelines(lines[:3])
+        with open(checkpoint, 'w') as f:
+            f.write(f"{complete[2]['offset']} {len(lines[0]) + len(lines[1])}\n")
+
+        self.assertEqual(self.score(source, '--chunk-size', '2', '--checkpoint', checkpoint), complete)
+        self.assertEqual(self.score(source, '--offset', str(complete[4]['offset']),
+                                    output='rest.ndjson'), complete[4:])
+
+
+class ColumnarLoaderTests(TestCase):
+    """load_urine_columns fills typed arrays and joins patients and their latest serum labs"""
+
+    def setUp(self):
+        self.patients = [PatientProfile.objects.create(
+            age=age, gender=gender, num_prior_stones=1, bmi=Decimal('24.5'), fluid_intake_L=2,
+            medical_conditions=conditions, medications=[])
+            for age, gender, conditions in ((50, 'Female', ['Gout']), (35, 'Male', []))]
+        SerumLabs.objects.create(patient_profile=self.patients[0], calcium_mg_dL=Decimal('9.1'),
+                                 intact_pth_pg_mL=40, bicarbonate_mEq_L=24,
+                                 potassium_mEq_L=Decimal('4.0'), creatinine_mg_dL=Decimal('0.9'))
+        self.latest = SerumLabs.objects.create(
+            patient_profile=self.patients[0], calcium_mg_dL=Decimal('10.9'), intact_pth_pg_mL=80,
+            bicarbonate_mEq_L=20, potassium_mEq_L=Decimal('3.2'), creatinine_mg_dL=Decimal('1.15'))
+        self.panels = [UrineAnalysis.objects.create(
+            patient_profile=self.patients[index % 2], volume_L=Decimal('1.5') + index, ph=Decimal('5.8'),
+            calcium_mg=200 + index, oxalate_mg=45, phosphorus_mg=800, uric_acid_mg=600,
+            sodium_mEq=150, potassium_mEq=60, magnesium_mg=100, sulfate_mmol=25,
+            ammonium_mmol=40, citrate_mg=300) for index in range(3)]
+
+    def test_urine_columns_match_the_models(self):
+        columns = load_urine_columns(chunk_size=2)
+        self.assertEqual(list(columns), ['id', 'patient_profile_id', *URINE_FIELDS])
+        self.assertEqual(columns['id'].tolist(), [panel.id for panel in self.panels])
+        self.assertEqual(columns['volume_L'].dtype, np.float64)
+        self.assertEqual(columns['calcium_mg'].dtype, np.int64)
+        for index, panel in enumerate(self.panels):
+            urine = UrineProfile.from_instance(panel)
+            self.assertEqual(UrineProfile(*(columns[field][index].item() for field in URINE_FIELDS)),
+                             urine)
+
+    def test_patient_and_latest_serum_joins(self):
+        columns = load_urine_columns(
+            UrineAnalysis.objects.filter(calcium_mg__lt=202), fields=('id', 'created_at'),
+            patient_fields=('age', 'gender', 'bmi', 'medical_conditions', 'created_at'),
+            serum_fields=SERUM_FIELDS, chunk_size=1)
+        self.assertNotIn('patient_profile_id', columns)
+        self.assertEqual(columns['age'].tolist(), [50, 35])
+        self.assertEqual(columns['gender'].tolist(), ['Female', 'Male'])
+        self.assertEqual(columns['bmi'].tolist(), [24.5, 24.5])
+        self.assertEqual(columns['medical_conditions'].tolist(), [['Gout'], []])
+        self.assertEqual(columns['created_at'].dtype, np.dtype('datetime64[us]'))
+        self.assertEqual(columns['patient_profile__created_at'][1],
+                         np.datetime64(self.patients[1].created_at.replace(tzinfo=None)))
+        # The second patient has no serum labs: NaN, whatever the field type
+        self.assertEqual(columns['calcium_mg_dL'][0], 10.9)
+        self.assertEqual(columns['intact_pth_pg_mL'].dtype, np.float64)
+        self.assertEqual(columns['intact_pth_pg_mL'][0], 80)
+        self.assertTrue(np.isnan(columns['creatinine_mg_dL'][1]))
+
+    def test_nullable_integers_load_as_float(self):
+        PatientProfile.objects.filter(pk=self.patients[1].pk).update(first_stone_age=30)
+        columns = load_columns(PatientProfile.objects.order_by('id'), ('first_stone_age',))
+        self.assertEqual(columns['first_stone_age'].dtype, np.float64)
+        self.assertTrue(np.isnan(columns['first_stone_age'][0]))
+        self.assertEqual(columns['first_stone_age'][1], 30)
+
+
+class RecurrenceScoreTests(TestCase):
+    """ROKS-style recurrence risk, per patient and in batch"""
+
+    def setUp(self):
+        self.profiles = [
+            PatientProfile.objects.create(
+                age=age, gender=gender, num_prior_stones=prior, first_stone_age=first,
+                family_history=family, bmi=30, fluid_intake_L=2,
+                medical_conditions=conditions, medications=[])
+            for age, gender, prior, first, family, conditions in (
+                (45, 'Female', 0, None, False, []),
+                (25, 'Male', 3, 18, True, ["Renal Tubular Acidosis"]),
+                (70, 'Other', 1, 60, False, ["Gout", "Osteoporosis"]),
+            )
+        ]
+
+    def test_batch_matches_single_patient(self):
+        rows = list(PatientProfile.objects.order_by('id').values(*ROKS_FIELDS))
+        risks = roks_recurrence_batch({field: [row[field] for row in rows] for field in ROKS_FIELDS})
+        for index, (profile, row) in enumerate(zip(self.profiles, rows)):
+            self.assertEqual(roks_recurrence(profile), roks_recurrence(row))
+            self.assertAlmostEqual(roks_recurrence(profile)[5], risks[5][index])
+            self.assertLess(risks[5][index], risks[10][index])
+
+    def test_risk_factors_raise_the_score(self):
+        low, high, _ = (roks_recurrence(profile)[5] for profile in self.profiles)
+        self.assertLess(low, high)
+
+    def test_command_stores_scores(self):
+        out = StringIO()
+        call_command('score_recurrence', '--batch-size', '2', '--top', '1', stdout=out)
+        self.assertIn('Scored 3 patient profiles', out.getvalue())
+        for profile in self.profiles:
+            profile.refresh_from_db()
+            self.assertEqual(profile.recurrence_version, ROKS_VERSION)
+            self.assertAlmostEqual(profile.recurrence_risk_5y, roks_recurrence(profile)[5])
+        call_command('score_recurrence', '--stale-only', stdout=out)
+        self.assertIn('Scored 0 patient profiles', out.getvalue())
+
+    def test_saving_a_profile_rescores_it(self):
+        profile = self.profiles[0]
+        self.assertEqual(profile.recurrence_version, ROKS_VERSION)
+        low = profile.recurrence_risk_5y
+        profile.num_prior_stones = 4
+        profile.save(update_fields=['num_prior_stones'])
+        profile.refresh_from_db()
+        self.assertGreater(profile.recurrence_risk_5y, low)
+        self.assertAlmostEqual(profile.recurrence_risk_5y, roks_recurrence(profile)[5])
+
+        # Fields the score does not read leave it alone
+        PatientProfile.objects.filter(id=profile.id).update(recurrence_version='')
+        profile.fluid_intake_L = 3
+        profile.save(update_fields=['fluid_intake_L'])
+        profile.refresh_from_db()
+        self.assertEqual(profile.recurrence_version, '')
+
+    def test_recurrence_view_is_read_only(self):
+        profile = self.profiles[1]
+        PatientProfile.objects.filter(id=profile.id).update(recurrence_version='roks-0')
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/patients/{profile.id}/recurrence/')
+        self.assertEqual(response.json()['version'], 'roks-0')
+        self.assertAlmostEqual(response.json()['recurrence_risk_5y'], roks_recurrence(profile)[5])
+
+
+class SimilarityIndexTests(SimpleTestCase):
+    """KD-tree kNN must agree with a brute-force scan through adds, removals and reloads"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.points = rng.normal(size=(3000, len(SIMILARITY_FEATURES)))
+        self.queries = rng.normal(size=(10, len(SIMILARITY_FEATURES)))
+
+    def brute_force(self, ids, vector, k):
+        points = np.array([self.points[urine_id] for urine_id in ids])
+        distances = np.sqrt(((points - vector) ** 2).sum(axis=1))
+        order = np.argsort(distances, kind='stable')[:k]
+        return [int(np.asarray(ids)[i]) for i in order]
+
+    def assertMatchesScan(self, index, ids):
+        for vector in self.queries:
+            self.assertEqual([urine_id for urine_id, _ in index.query(vector, 15)],
+                             self.brute_force(ids, vector, 15))
+
+    def test_tree_matches_scan(self):
+        for leaf_size in (1, 8, 32):
+            tree = KDTree(self.points, leaf_size)
+            for vector in self.queries:
+                distances, positions = tree.query(vector, 15)
+                self.assertEqual(tree.positions[positions].tolist(),
+                                 self.brute_force(range(len(self.points)), vector, 15))
+
+    def test_incremental_updates_and_snapshot(self):
+        index = SimilarityIndex(leaf_size=16, min_rebuild=100, rebuild_ratio=0.1)
+        ids = list(range(1, 2001))
+        for urine_id in ids:
+            index.add(urine_id, self.points[urine_id])
+        self.assertLess(len(index._pending), 200)
+        self.assertMatchesScan(index, ids)
+
+        for urine_id in range(1, 2001, 3):
+            index.remove(urine_id)
+        ids = [urine_id for urine_id in ids if urine_id % 3 != 1]
+        self.assertEqual(len(index), len(ids))
+        self.assertMatchesScan(index, ids)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.npz')
+            index.add(1, self.points[1])
+            index.synced_at = datetime(2026, 3, 1, 12, 30, tzinfo=dt_timezone.utc)
+            index.save(path)
+            index.save(path)
+            self.assertEqual(os.listdir(directory), ['index.npz'])
+            loaded = SimilarityIndex.load(path)
+            self.assertEqual(loaded.synced_at, index.synced_at)
+            loaded.add(2500, self.points[2500])
+            self.assertMatchesScan(loaded, ids + [1, 2500])
+            loaded.rebuild()
+            self.assertEqual(loaded._pending, {})
+            self.assertMatchesScan(loaded, ids + [1, 2500])
+            # Only build_similarity_index writes snapshots
+            self.assertMatchesScan(SimilarityIndex.load(path), ids + [1])
+
+
+class SimilarPatientsTests(TestCase):
+    """similar_panels reads the stored panels and keeps the index current on save"""
+
+    def setUp(self):
+        similarity.reset_index()
+        self.addCleanup(similarity.reset_index)
+        # No periodic catch-up unless a test asks for it
+        self.enterContext(self.settings(
+            SIMILARITY_INDEX={**settings.SIMILARITY_INDEX, 'SYNC_INTERVAL': 3600}))
+        self.panels = []
+        for calcium in (150, 160, 400, 170):
+            patient = PatientProfile.objects.create(
+                age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2)
+            self.panels.append(UrineAnalysis.objects.create(
+                patient_profile=patient, volume_L=1.5, ph=5.5, calcium_mg=calcium, oxalate_mg=45,
+                phosphorus_mg=800, uric_acid_mg=600, sodium_mEq=150, potassium_mEq=60,
+                magnesium_mg=100, sulfate_mmol=25, ammonium_mmol=40, citrate_mg=300))
+
+    def test_nearest_other_patients_first(self):
+        nearest = similarity.similar_panels(self.panels[0], k=2)
+        self.assertEqual([urine_id for urine_id, _ in nearest],
+                         [self.panels[1].id, self.panels[3].id])
+
+        # A second panel of the same patient is not listed as a separate match
+        second = UrineAnalysis.objects.get(id=self.panels[1].id)
+        second.pk = None
+        second.calcium_mg = 155
+        second.save()
+        self.assertIn(second.id, similarity.loaded_index()._pending)
+        nearest = similarity.similar_panels(self.panels[0], k=3)
+        self.assertEqual([urine_id for urine_id, _ in nearest],
+                         [second.id, self.panels[3].id, self.panels[2].id])
+
+        self.panels[3].delete()
+        self.assertNotIn(self.panels[3].id, [urine_id for urine_id, _ in
+                                             similarity.similar_panels(self.panels[0], k=3)])
+
+    def test_lookup_does_not_write_the_index(self):
+        similarity.similar_panels(self.panels[0], k=2)
+        index = similarity.loaded_index()
+        index.remove(self.panels[0].id)
+        size = len(index)
+        with mock.patch.object(SimilarityIndex, 'add', side_effect=AssertionError('index written')):
+            similarity.similar_panels(self.panels[0], k=2)
+        self.assertEqual(len(index), size)
+        # Saving the panel puts it back
+        self.panels[0].save()
+        self.assertEqual(len(index), size + 1)
+
+    def nearest(self, k=1):
+        return [urine_id for urine_id, _ in similarity.similar_panels(self.panels[0], k)]
+
+    def test_changes_of_other_processes_are_caught_up(self):
+        self.assertEqual(self.nearest(), [self.panels[1].id])
+        # Writes without signals, as this process sees another one's saves
+        UrineAnalysis.objects.filter(id=self.panels[2].id).update(
+            calcium_mg=155, updated_at=timezone.now())
+        self.assertEqual(self.nearest(), [self.panels[1].id])
+        with self.settings(SIMILARITY_INDEX={**settings.SIMILARITY_INDEX, 'SYNC_INTERVAL': 0}):
+            self.assertEqual(self.nearest(), [self.panels[2].id])
+            PatientProfile.objects.filter(id=self.panels[2].patient_profile_id).update(
+                age=90, updated_at=timezone.now())
+            self.assertEqual(self.nearest(), [self.panels[1].id])
+            SerumLabs.objects.bulk_create([SerumLabs(
+                patient_profile_id=self.panels[1].patient_profile_id, calcium_mg_dL=Decimal('12.5'),
+                intact_pth_pg_mL=250, bicarbonate_mEq_L=15, potassium_mEq_L=Decimal('2.8'),
+                creatinine_mg_dL=Decimal('2.5'))])
+            self.assertEqual(self.nearest(), [self.panels[3].id])
+
+    def test_patient_and_serum_changes_refresh_the_patient(self):
+        self.assertEqual(self.nearest(), [self.panels[1].id])
+        patient = self.panels[1].patient_profile
+        patient.age = 90
+        patient.save()
+        self.assertEqual(self.nearest(), [self.panels[3].id])
+        patient.age = 50
+        patient.save()
+        labs = SerumLabs.objects.create(
+            patient_profile=patient, calcium_mg_dL=Decimal('12.5'), intact_pth_pg_mL=250,
+            bicarbonate_mEq_L=15, potassium_mEq_L=Decimal('2.8'), creatinine_mg_dL=Decimal('2.5'))
+        self.assertEqual(self.nearest(), [self.panels[3].id])
+        labs.delete()
+        self.assertEqual(self.nearest(), [self.panels[1].id])
+        with self.assertNumQueries(1):
+            similarity.update_patient(patient.id)
+
+    def test_snapshot_catches_up_from_its_watermark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.npz')
+            call_command('build_similarity_index', output=path, stdout=StringIO())
+            # An edit of an old panel after the snapshot, made without signals
+            UrineAnalysis.objects.filter(id=self.panels[2].id).update(
+                calcium_mg=155, updated_at=timezone.now() + timedelta(minutes=5))
+            similarity.reset_index()
+            with self.settings(SIMILARITY_INDEX={**settings.SIMILARITY_INDEX, 'PATH': path}):
+                self.assertEqual(self.nearest(), [self.panels[2].id])
+
+
+class QuantileSketchTests(TestCase):
+    """Percentiles come from sketches kept current on save, close to the exact mid-rank"""
+
+    def test_digest_matches_exact_percentiles(self):
+        rng = np.random.default_rng(5)
+        values = np.rint(rng.lognormal(5, 0.5, 20000))
+        digest = TDigest()
+        for value in values[:5000]:
+            digest.add(value)
+        digest.extend(values[5000:])
+        self.assertLess(len(digest.means), 60)
+        ordered = np.sort(values)
+        for value in np.quantile(values, [0.01, 0.1, 0.5, 0.9, 0.99]):
+            exact = (np.searchsorted(ordered, value) + np.searchsorted(ordered, value, 'right')) / 2
+            self.assertAlmostEqual(digest.cdf(value), exact / len(values), delta=0.005)
+        self.assertEqual(digest.cdf(ordered[0] - 1), 0.0)
+        self.assertEqual(digest.cdf(ordered[-1] + 1), 1.0)
+
+    def test_sketches_follow_saved_panels(self):
+        patient = PatientProfile.objects.create(
+            age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2)
+        for calcium in range(100, 400, 10):
+            UrineAnalysis.objects.create(
+                patient_profile=patient, volume_L=1.5, ph=5.5, calcium_mg=calcium, oxalate_mg=45,
+                phosphorus_mg=800, uric_acid_mg=600, sodium_mEq=150, potassium_mEq=60,
+                magnesium_mg=100, sulfate_mmol=25, ammonium_mmol=40, citrate_mg=300)
+        self.assertEqual(fold_pending(), 30)
+        self.assertEqual(QuantileSketch.objects.get(field='calcium_mg').count, 30)
+
+        urine = UrineProfile(1.5, 5.5, 245, 45, 800, 600, 150, 60, 100, 25, 40, 300, 0)
+        with self.assertNumQueries(1):
+            percentiles = population_percentiles(urine)
+        self.assertAlmostEqual(percentiles['calcium_mg'], 50, delta=2)
+        self.assertEqual(percentiles['oxalate_mg'], 50)
+
+        UrineAnalysis.objects.filter(calcium_mg__lt=250).delete()
+        self.assertEqual(rebuild_sketches(), 15)
+        self.assertEqual(QuantileSketch.objects.get(field='calcium_mg').count, 15)
+        self.assertEqual(population_percentiles(urine)['calcium_mg'], 0)
+
+    def test_saves_queue_values_folded_every_fold_every_panels(self):
+        patient = PatientProfile.objects.create(
+            age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2)
+        values = dict(volume_L=1.5, ph=5.5, calcium_mg=200, oxalate_mg=45, phosphorus_mg=800,
+                      uric_acid_mg=600, sodium_mEq=150, potassium_mEq=60, magnesium_mg=100,
+                      sulfate_mmol=25, ammonium_mmol=40, citrate_mg=300)
+        with mock.patch('kidney_stones_app.quantiles.FOLD_EVERY', 4):
+            # A save only inserts its values: no sketch row is read or locked
+            with self.assertNumQueries(1):
+                record_panel(10 ** 6, {**values, 'cystine_mg': 0})
+            self.assertFalse(QuantileSketch.objects.exists())
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                for _ in range(3):
+                    UrineAnalysis.objects.create(patient_profile=patient, **values)
+            self.assertEqual(len(callbacks), 1)
+        self.assertEqual(QuantileSketch.objects.get(field='calcium_mg').count, 4)
+        self.assertFalse(PendingQuantileValues.objects.exists())
+
+        # A rebuild drops the pending values of the panels it read, and the
+        # phantom panel 10**6 it did not
+        UrineAnalysis.objects.create(patient_profile=patient, **values)
+        record_panel(10 ** 6, {**values, 'cystine_mg': 0})
+        self.assertEqual(rebuild_sketches(), 4)
+        self.assertEqual(list(PendingQuantileValues.objects.values_list('panel_id', flat=True)), [10 ** 6])
+        self.assertEqual(fold_pending(), 1)
+        self.assertEqual(QuantileSketch.objects.get(field='calcium_mg').count, 5)
+
+
+class DietGuidanceTests(TestCase):
+    """Food guidance slices rankings built once, without querying per plan"""
+
+    def setUp(self):
+        for food, food_type, oxalate_mg, level in (
+                ('Spinach', 'Vegetable', 656, 'Very High'), ('Beet Greens', 'Vegetable', 300, 'Very High'),
+                ('Okra', 'Vegetable', 57, 'High'), ('Cabbage', 'Vegetable', 2, 'Low'),
+                ('Kale', 'Vegetable', 4, 'Low'), ('Almonds', 'Nut', 122, 'Very High'),
+                ('Banana', 'Fruit', 3, 'Low')):
+            OxalateContent.objects.create(food=food, type=food_type, oxalate_mg=oxalate_mg,
+                                          serving_size='1 cup (raw)', oxalate_level=level)
+        refresh_oxalate_rankings()
+
+    def test_ranked_foods_for_elevated_oxalate(self):
+        findings = evaluate_24hr_urine(UrineProfile(2.0, 6.0, 200, 60, 800, 600, 150, 60, 100, 25, 40, 600, 0))
+        with self.assertNumQueries(0):
+            guidance = diet_guidance(findings, limit=2)
+        self.assertEqual([food.food for food in guidance['avoid']], ['Spinach', 'Beet Greens'])
+        self.assertEqual([category['type'] for category in guidance['categories']], ['Vegetable', 'Nut'])
+        vegetables = guidance['categories'][0]
+        self.assertEqual([food.food for food in vegetables['avoid']], ['Spinach', 'Beet Greens'])
+        self.assertEqual([food.food for food in vegetables['swaps']], ['Cabbage', 'Kale'])
+        self.assertEqual(guidance['categories'][1]['swaps'], [])
+
+    def test_no_guidance_for_normal_oxalate(self):
+        findings = evaluate_24hr_urine(UrineProfile(2.0, 6.0, 200, 30, 800, 600, 150, 60, 100, 25, 40, 600, 0))
+        self.assertIsNone(diet_guidance(findings))
+
+
+class MealPlanTests(SimpleTestCase):
+    """The knapsack over value levels finds the most varied menu within budget"""
+
+    @staticmethod
+    def variety(foods):
+        return sum(sum(VARIETY_WEIGHTS[:count]) for count in Counter(food.type for food in foods).values())
+
+    def test_matches_exhaustive_search(self):
+        rng = np.random.default_rng(3)
+        for _ in range(100):
+            foods = [RankedFood(f'food {index}', f'type {rng.integers(4)}', rng.integers(0, 40) / 2,
+                                '1 cup', 'Low') for index in range(9)]
+            budget, max_foods, per_category = rng.integers(0, 60) / 2, rng.integers(1, 6), rng.integers(1, 4)
+            menus = plan_meals(budget, max_foods=max_foods, per_category=per_category, menus=1,
+                               rankings=OxalateRankings(foods))['menus']
+            best = max(self.variety(combination)
+                       for size in range(max_foods + 1)
+                       for combination in itertools.combinations(foods, size)
+                       if sum(food.oxalate_mg for food in combination) <= budget
+                       and max(Counter(food.type for food in combination).values(), default=0) <= per_category)
+            self.assertEqual(self.variety(menus[0]['foods']) if menus else 0, best)
+            for menu in menus:
+                self.assertLessEqual(menu['oxalate_mg'], budget)
+                self.assertLessEqual(len(menu['foods']), max_foods)
+
+    def test_menus_use_new_foods_and_honour_preferences(self):
+        foods = [RankedFood(name, food_type, oxalate_mg, '1 cup', 'Low') for name, food_type, oxalate_mg in (
+            ('Banana', 'Fruit', 3), ('Apple', 'Fruit', 1), ('Grapes', 'Fruit', 2),
+            ('Cabbage', 'Vegetable', 2), ('Kale', 'Vegetable', 4), ('Spinach', 'Vegetable', 656),
+            ('Milk', 'Dairy', 0))]
+        plan = plan_meals(10, categories=['Fruit', 'Vegetable'], exclude=['Apple'], max_foods=2,
+                          menus=3, rankings=OxalateRankings(foods))
+        menus = [[food.food for food in menu['foods']] for menu in plan['menus']]
+        self.assertEqual(menus, [['Grapes', 'Cabbage'], ['Banana', 'Kale']])
+
+
+class FoodDiaryTests(TestCase):
+    """Intake rollups follow diary inserts, edits and deletes"""
+
+    def setUp(self):
+        self.patient = PatientProfile.objects.create(
+            age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2)
+        self.spinach = OxalateContent.objects.create(
+            food='Spinach', type='Vegetable', oxalate_mg=656, serving_size='1 cup (raw)',
+            oxalate_level='Very High')
+
+    def log(self, day, hour, oxalate_mg):
+        return FoodDiaryEntry.objects.create(
+            patient_profile=self.patient, food=self.spinach, food_name='Spinach',
+            oxalate_mg=Decimal(oxalate_mg), eaten_at=datetime(2026, 3, day, hour, tzinfo=dt_timezone.utc))
+
+    def rollups(self):
+        return {(period, start): (oxalate_mg, entries) for period, start, oxalate_mg, entries in
+                OxalateIntakeRollup.objects.values_list('period', 'start', 'oxalate_mg', 'entries')}
+
+    def test_rollups_follow_entries(self):
+        # 2026-03-09 is a Monday
+        first = self.log(10, 8, '12.50')
+        self.log(10, 19, '7.50')
+        moved = self.log(11, 12, '30.00')
+        self.log(16, 12, '5.00')
+        self.assertEqual(self.rollups(), {
+            ('day', date(2026, 3, 10)): (Decimal('20.00'), 2),
+            ('day', date(2026, 3, 11)): (Decimal('30.00'), 1),
+            ('day', date(2026, 3, 16)): (Decimal('5.00'), 1),
+            ('week', date(2026, 3, 9)): (Decimal('50.00'), 3),
+            ('week', date(2026, 3, 16)): (Decimal('5.00'), 1),
+        })
+
+        moved.eaten_at = datetime(2026, 3, 17, 12, tzinfo=dt_timezone.utc)
+        moved.save()
+        first.delete()
+        expected = {
+            ('day', date(2026, 3, 10)): (Decimal('7.50'), 1),
+            ('day', date(2026, 3, 16)): (Decimal('5.00'), 1),
+            ('day', date(2026, 3, 17)): (Decimal('30.00'), 1),
+            ('week', date(2026, 3, 9)): (Decimal('7.50'), 1),
+            ('week', date(2026, 3, 16)): (Decimal('35.00'), 2),
+        }
+        self.assertEqual(self.rollups(), expected)
+        self.assertEqual(rebuild_rollups(), 5)
+        self.assertEqual(self.rollups(), expected)
+
+        with self.assertNumQueries(1):
+            intake = intake_totals(self.patient, days=7, weeks=2, today=date(2026, 3, 17))
+        self.assertEqual([day['oxalate_mg'] for day in intake['daily']],
+                         [0, 0, 0, 0, 0, Decimal('5.00'), Decimal('30.00')])
+        self.assertEqual([week['entries'] for week in intake['weekly']], [1, 2])
+
+        self.patient.delete()
+        self.assertFalse(OxalateIntakeRollup.objects.exists())
+
+    def test_logging_from_the_page(self):
+        response = self.client.post('/food-diary/', {
+            'food': self.spinach.id, 'portions': '0.5', 'eaten_at': '2026-03-10T12:30'})
+        self.assertEqual(response.status_code, 302)
+        entry = FoodDiaryEntry.objects.get()
+        self.assertEqual((entry.food_name, entry.oxalate_mg), ('Spinach', Decimal('328.00')))
+        self.assertEqual(OxalateIntakeRollup.objects.get(period='day').oxalate_mg, Decimal('328.00'))
+
+
+class UrineTrendTests(TestCase):
+    """Trend rows are computed from the previous row as panels are saved"""
+
+    def setUp(self):
+        self.patient = PatientProfile.objects.create(
+            age=50, gender='Female', num_prior_stones=1, bmi=25, fluid_intake_L=2)
+
+    def panel(self, day, volume_L, oxalate_mg, citrate_mg):
+        with mock.patch('django.utils.timezone.now',
+                        return_value=datetime(2026, 1, 1, tzinfo=dt_timezone.utc) + timedelta(days=day)):
+            return UrineAnalysis.objects.create(
+                patient_profile=self.patient, volume_L=volume_L, ph=6.0, calcium_mg=200,
+                oxalate_mg=oxalate_mg, phosphorus_mg=800, uric_acid_mg=600, sodium_mEq=150,
+                potassium_mEq=60, magnesium_mg=100, sulfate_mmol=25, ammonium_mmol=40,
+                citrate_mg=citrate_mg)
+
+    def test_deltas_slopes_and_transitions(self):
+        self.panel(0, 1.5, 60, 300)
+        self.panel(30, 2.0, 35, 450)
+        self.panel(60, 2.5, 35, 600)
+
+        with self.assertNumQueries(1):
+            history = patient_history(self.patient)
+        first, second, third = history
+        self.assertEqual([visit['visit'] for visit in history], [1, 2, 3])
+        self.assertEqual(first['deltas'], {})
+        self.assertIn('URINE_OXALATE_HIGH', first['findings'])
+        self.assertEqual(second['days_since_previous'], 30)
+        self.assertEqual((second['deltas']['oxalate_mg'], second['deltas']['citrate_mg']), (-25, 150))
+        self.assertEqual(set(second['findings_resolved']), {'URINE_OXALATE_HIGH', 'URINE_CITRATE_LOW'})
+        self.assertEqual(second['findings_new'], [])
+        self.assertEqual(third['findings_resolved'], ['URINE_VOLUME_LOW'])
+        self.assertAlmostEqual(second['slopes']['citrate_mg'], 5 * 365.25)
+        self.assertAlmostEqual(third['slopes']['citrate_mg'], 5 * 365.25)
+        self.assertAlmostEqual(third['slopes']['volume_L'], 0.5 / 30 * 365.25)
+        self.assertAlmostEqual(third['slopes']['oxalate_mg'], -12.5 / 30 * 365.25)
+
+    def test_deleting_a_panel_relinks_the_next_visit(self):
+        first = self.panel(0, 1.5, 60, 300)
+        middle = self.panel(10, 2.0, 35, 450)
+        last = self.panel(20, 1.5, 60, 300)
+        incremental = patient_history(self.patient)
+        self.assertEqual(rebuild_trends(), 3)
+        self.assertEqual(patient_history(self.patient)[1:], incremental[1:])
+
+        middle.delete()
+        trend = UrineTrend.objects.get(urine_analysis=last)
+        self.assertEqual((trend.visit, trend.previous_id, trend.findings_new), (2, first.id, 0))
+        self.assertEqual(trend.deltas['oxalate_mg'], 0)
+
+    def test_edits_recompute_from_the_edited_visit(self):
+        first = self.panel(0, 1.5, 60, 300)
+        middle = self.panel(10, 2.0, 35, 450)
+        self.panel(20, 1.5, 60, 300)
+        first_trend = UrineTrend.objects.get(urine_analysis=first)
+
+        with mock.patch('kidney_stones_app.trends.trend_row', wraps=trends.trend_row) as trend_row:
+            middle.save()
+            self.assertEqual(trend_row.call_count, 0)
+            middle.oxalate_mg = 70
+            middle.save()
+            self.assertEqual(trend_row.call_count, 2)
+        # The first visit's row is kept as is
+        self.assertEqual(UrineTrend.objects.get(urine_analysis=first).id, first_trend.id)
+        history = patient_history(self.patient)
+        self.assertEqual(history[1]['deltas']['oxalate_mg'], 10)
+        self.assertEqual(history[2]['deltas']['oxalate_mg'], -10)
+        rebuild_trends()
+        self.assertEqual(patient_history(self.patient)[1:], history[1:])
+
+        other = PatientProfile.objects.create(
+            age=40, gender='Male', num_prior_stones=0, bmi=22, fluid_intake_L=2)
+        middle.patient_profile = other
+        middle.save()
+        self.assertEqual([visit['visit'] for visit in patient_history(self.patient)], [1, 2])
+        self.assertEqual(patient_history(self.patient)[1]['deltas']['oxalate_mg'], 0)
+        self.assertEqual([visit['urine_analysis_id'] for visit in patient_history(other)], [middle.id])
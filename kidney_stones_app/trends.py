@@ -0,0 +1,208 @@
+"""
+Longitudinal trends across a patient's urine analyses.
+
+When a urine analysis is saved, one UrineTrend row records the change since
+the patient's previous panel: the delta of every value, the findings that
+appeared or resolved, and the least-squares slope of every value over all
+panels so far. The slope regression keeps running sums in the row, so a new
+panel only reads the previous trend row; past panels are never reloaded or
+re-interpreted, and the history page only reads trend rows. An edited or
+deleted panel changes the trends from its visit on, so only those rows of
+the patient are recomputed, from the trend row before it.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from .cache import cached_interpretation
+from .models import PatientProfile, UrineAnalysis, UrineTrend
+from .services import URINE_FIELDS, UrineProfile, PatientContext, Finding
+
+DAYS_PER_YEAR = 365.25
+
+
+def trend_row(urine_analysis, patient_context, previous=None):
+    """
+    Unsaved UrineTrend of a urine analysis given the patient's previous
+    UrineTrend (None for the first panel).
+    """
+    urine = UrineProfile.from_instance(urine_analysis)
+    findings, _ = cached_interpretation(urine, patient_context)
+    values = urine._asdict()
+    collected_at = urine_analysis.created_at
+
+    if previous is None:
+        origin = collected_at.timestamp()
+        sums = {'origin': origin, 'n': 0, 't': 0.0, 'tt': 0.0,
+                'y': dict.fromkeys(URINE_FIELDS, 0.0), 'ty': dict.fromkeys(URINE_FIELDS, 0.0)}
+    else:
+        sums = previous.sums
+        sums = {**sums, 'y': dict(sums['y']), 'ty': dict(sums['ty'])}
+
+    # Time in days since the first panel
+    t = (collected_at.timestamp() - sums['origin']) / 86400
+    sums['n'] += 1
+    sums['t'] += t
+    sums['tt'] += t * t
+    for field, value in values.items():
+        sums['y'][field] += value
+        sums['ty'][field] += t * value
+
+    slopes = {}
+    n = sums['n']
+    spread = n * sums['tt'] - sums['t'] ** 2
+    # Panels on (nearly) the same day carry no slope information
+    if n > 1 and spread > 1e-9 * n * n:
+        for field in URINE_FIELDS:
+            slope = (n * sums['ty'][field] - sums['t'] * sums['y'][field]) / spread
+            slopes[field] = round(slope * DAYS_PER_YEAR, 4)
+
+    codes = findings.codes
+    trend = UrineTrend(
+        urine_analysis=urine_analysis,
+        patient_profile_id=urine_analysis.patient_profile_id,
+        visit=1,
+        collected_at=collected_at,
+        values=values,
+        slopes=slopes,
+        sums=sums,
+        findings=codes,
+        findings_new=codes,
+        rule_version=findings.rule_set.stamp,
+    )
+    if previous is not None:
+        trend.previous_id = previous.urine_analysis_id
+        trend.visit = previous.visit + 1
+        trend.days_since_previous = round(
+            (collected_at - previous.collected_at).total_seconds() / 86400, 3)
+        trend.deltas = {field: round(value - previous.values[field], 4)
+                        for field, value in values.items()}
+        trend.findings_new = codes & ~previous.findings
+        trend.findings_resolved = previous.findings & ~codes
+    return trend
+
+
+def record_panel(urine_analysis):
+    """Stores the trend of a newly saved urine analysis"""
+    with transaction.atomic():
+        patient_profile = PatientProfile.objects.select_for_update().get(
+            id=urine_analysis.patient_profile_id)
+        previous = (UrineTrend.objects.filter(patient_profile=patient_profile)
+                    .exclude(urine_analysis=urine_analysis).order_by('-visit').first())
+        trend = trend_row(urine_analysis, PatientContext.from_instance(patient_profile), previous)
+        UrineTrend.objects.update_or_create(
+            urine_analysis=urine_analysis,
+            defaults={field.attname: getattr(trend, field.attname)
+                      for field in UrineTrend._meta.concrete_fields
+                      if field.attname not in ('id', 'urine_analysis_id')})
+    return trend
+
+
+def rebuild_patient_trends(patient_id, collected_at, urine_analysis_id):
+    """
+    Recomputes one patient's trend rows from the visit of a urine analysis
+    (created_at, id) on, starting from the stored trend row before it; returns
+    the number of rows written.
+    """
+    with transaction.atomic():
+        patient_profile = PatientProfile.objects.select_for_update().filter(id=patient_id).first()
+        if patient_profile is None:
+            return 0
+        before = Q(collected_at__lt=collected_at) | Q(
+            collected_at=collected_at, urine_analysis_id__lt=urine_analysis_id)
+        trends = UrineTrend.objects.filter(patient_profile=patient_profile)
+        previous = trends.filter(before).order_by('-visit').first()
+        context = PatientContext.from_instance(patient_profile)
+        rows = []
+        for urine_analysis in (UrineAnalysis.objects.filter(patient_profile=patient_profile)
+                               .filter(Q(created_at__gt=collected_at)
+                                       | Q(created_at=collected_at, id__gte=urine_analysis_id))
+                               .order_by('created_at', 'id').iterator()):
+            previous = trend_row(urine_analysis, context, previous)
+            rows.append(previous)
+        trends.exclude(before).delete()
+        UrineTrend.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_panel(urine_analysis):
+    """
+    Refreshes the trends after an edit of a stored urine analysis, from the
+    earlier of its old and new visit on; returns the number of rows written.
+    """
+    stored = (UrineTrend.objects.filter(urine_analysis=urine_analysis)
+              .values_list('patient_profile_id', 'collected_at', 'values').first())
+    key = (urine_analysis.created_at, urine_analysis.id)
+    if stored is None:
+        return rebuild_patient_trends(urine_analysis.patient_profile_id, *key)
+    patient_id, collected_at, values = stored
+    if (patient_id, collected_at, values) == (
+            urine_analysis.patient_profile_id, urine_analysis.created_at,
+            UrineProfile.from_instance(urine_analysis)._asdict()):
+        # Nothing the trends depend on has changed
+        return 0
+    written = 0
+    if patient_id != urine_analysis.patient_profile_id:
+        # Moved to another patient: the old patient's later visits change too
+        written += rebuild_patient_trends(patient_id, collected_at, urine_analysis.id)
+    else:
+        key = min(key, (collected_at, urine_analysis.id))
+    return written + rebuild_patient_trends(urine_analysis.patient_profile_id, *key)
+
+
+def remove_panel(urine_analysis):
+    """Relinks the visits after a deleted urine analysis; returns the number of rows written"""
+    return rebuild_patient_trends(
+        urine_analysis.patient_profile_id, urine_analysis.created_at, urine_analysis.id)
+
+
+def rebuild_trends(patient_ids=None, batch_size=2000):
+    """
+    Recomputes the trend rows of every urine analysis, in visit order per
+    patient (all patients by default); returns the number of rows written.
+    """
+    patients = PatientProfile.objects.order_by('id')
+    if patient_ids is not None:
+        patients = patients.filter(id__in=patient_ids)
+    written = 0
+    last_id = 0
+    while True:
+        batch = list(patients.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return written
+        last_id = batch[-1].id
+        contexts = {patient.id: PatientContext.from_instance(patient) for patient in batch}
+        trends = []
+        previous = None
+        for urine_analysis in (UrineAnalysis.objects.filter(patient_profile_id__in=contexts)
+                               .order_by('patient_profile_id', 'created_at', 'id').iterator()):
+            if previous is not None and previous.patient_profile_id != urine_analysis.patient_profile_id:
+                previous = None
+            previous = trend_row(urine_analysis, contexts[urine_analysis.patient_profile_id], previous)
+            trends.append(previous)
+        with transaction.atomic():
+            UrineTrend.objects.filter(patient_profile_id__in=contexts).delete()
+            UrineTrend.objects.bulk_create(trends, batch_size=1000)
+        written += len(trends)
+
+
+def patient_history(patient_profile):
+    """
+    Trend rows of a patient, in visit order, with finding names, from the
+    stored trends only (one query).
+    """
+    history = []
+    for trend in UrineTrend.objects.filter(patient_profile=patient_profile).order_by('visit'):
+        history.append({
+            'urine_analysis_id': trend.urine_analysis_id,
+            'visit': trend.visit,
+            'collected_at': trend.collected_at,
+            'days_since_previous': trend.days_since_previous,
+            'values': trend.values,
+            'deltas': trend.deltas,
+            'slopes': trend.slopes,
+            'findings': Finding.names(trend.findings),
+            'findings_new': Finding.names(trend.findings_new) if trend.visit > 1 else [],
+            'findings_resolved': Finding.names(trend.findings_resolved),
+            'rule_version': trend.rule_version,
+        })
+    return history
@@ -0,0 +1,168 @@
+"""
+Monte Carlo measurement uncertainty of a 24-hour urine interpretation.
+
+A single collection is noisy, so a value close to a cutoff can produce a
+different finding at the next visit. Every urine field is resampled from an
+error model around the measured value and all samples go through the batch
+functions in one vectorized call; the result is the share of samples in which
+each finding and each plan item appears. Cohorts are split across a process
+pool, a chunk of patients per task.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from django.conf import settings
+import numpy as np
+
+from .batch import interpret_24hr_urine_batch, generate_management_plan_batch
+from .services import (
+    UrineProfile, SerumPanel, PatientContext, Finding, PLAN_STEPS, active_rule_set,
+)
+
+
+# Error of a single measurement per urine field: 'cv' is a coefficient of
+# variation (relative standard deviation), 'sd' an absolute standard
+# deviation. Values are the usual day-to-day variability of a 24-hour
+# collection; settings.UNCERTAINTY['ERROR_MODEL'] overrides single fields.
+DEFAULT_ERROR_MODEL = {
+    'volume_L': {'cv': 0.20},
+    'ph': {'sd': 0.20},
+    'calcium_mg': {'cv': 0.15},
+    'oxalate_mg': {'cv': 0.15},
+    'phosphorus_mg': {'cv': 0.15},
+    'uric_acid_mg': {'cv': 0.15},
+    'sodium_mEq': {'cv': 0.25},
+    'potassium_mEq': {'cv': 0.20},
+    'magnesium_mg': {'cv': 0.15},
+    'sulfate_mmol': {'cv': 0.15},
+    'ammonium_mmol': {'cv': 0.15},
+    'citrate_mg': {'cv': 0.20},
+    'cystine_mg': {'cv': 0.15},
+}
+
+# Upper bound on samples per panel accepted from a request
+MAX_UNCERTAINTY_SAMPLES = 100000
+
+FINDING_NAMES = tuple((name, bit) for name, bit in vars(Finding).items() if name.isupper())
+
+# Position of each plan item in a plan, to report probabilities in plan order
+PLAN_ORDER = {text: index for index, (_, _, text) in reversed(list(enumerate(PLAN_STEPS)))}
+
+
+def error_model(overrides=None):
+    """DEFAULT_ERROR_MODEL updated with the settings and then with overrides"""
+    model = dict(DEFAULT_ERROR_MODEL)
+    model.update(settings.UNCERTAINTY['ERROR_MODEL'])
+    model.update(overrides or {})
+    for field, error in model.items():
+        if field not in UrineProfile._fields:
+            raise ValueError(f"Unknown urine field '{field}' in the error model")
+        if set(error) - {'cv', 'sd'}:
+            raise ValueError(f"Error model of '{field}' takes 'cv' and/or 'sd'")
+    return model
+
+
+def sample_panels(urine_profile, samples, model, rng):
+    """
+    Column arrays of samples noisy copies of a urine panel. Values are drawn
+    from a normal distribution, clipped at 0, and integer fields are rounded
+    as a laboratory would report them.
+    """
+    columns = {}
+    for field, value in urine_profile._asdict().items():
+        error = model.get(field, {})
+        sd = error.get('sd', 0) + error.get('cv', 0) * abs(value)
+        if not sd:
+            columns[field] = np.full(samples, value, dtype=float)
+            continue
+        column = np.maximum(rng.normal(value, sd, samples), 0)
+        if UrineProfile.__annotations__[field] is int:
+            np.rint(column, out=column)
+        columns[field] = column
+    return columns
+
+
+def measurement_uncertainty(urine_profile, patient_profile=None, serum_labs=None,
+                            stone_type="Calcium Oxalate", samples=None, error_model_overrides=None,
+                            seed=None, rule_set=None):
+    """
+    Probability of every finding and plan item under measurement error, with
+    rule_set (default: the active one). Returns the measured findings and
+    plan alongside {'findings': {name: p}, 'plan': [(item, p), ...]}, plan
+    items in plan order.
+    """
+    samples = samples or settings.UNCERTAINTY['SAMPLES']
+    urine = UrineProfile.coerce(urine_profile)
+    patient = PatientContext.coerce(patient_profile)
+    serum = SerumPanel.coerce(serum_labs)
+    rule_set = (rule_set or active_rule_set()).for_patient(patient.age, patient.gender)
+    rng = np.random.default_rng(seed)
+
+    # Row 0 is the measured panel, the rest are the samples
+    columns = sample_panels(urine, samples + 1, error_model(error_model_overrides), rng)
+    for column, value in zip(columns.values(), urine):
+        column[0] = value
+    n = samples + 1
+    conditions = [patient.medical_conditions] * n
+    serum_columns = None if serum is None else {
+        name: np.full(n, value, dtype=float) for name, value in serum._asdict().items()}
+
+    codes = interpret_24hr_urine_batch(columns, conditions, rule_set=rule_set)
+    plan_ids, plan_table = generate_management_plan_batch(
+        stone_type, codes, conditions, [patient.medications] * n,
+        serum_columns=serum_columns, rule_set=rule_set)
+
+    sampled_codes = codes[1:]
+    findings = {name: float(np.count_nonzero(sampled_codes & np.uint32(bit))) / samples
+                for name, bit in FINDING_NAMES}
+    plan_counts = np.bincount(plan_ids[1:], minlength=len(plan_table))
+    item_counts = {}
+    for plan, count in zip(plan_table, plan_counts.tolist()):
+        for item in plan:
+            item_counts[item] = item_counts.get(item, 0) + count
+    plan = sorted(item_counts.items(), key=lambda item: PLAN_ORDER[item[0]])
+
+    return {
+        'samples': samples,
+        'stone_type': stone_type,
+        'rule_version': rule_set.stamp,
+        'measured': {
+            'findings': Finding.names(int(codes[0])),
+            'plan': list(plan_table[plan_ids[0]]),
+        },
+        'findings': {name: p for name, p in findings.items() if p},
+        'plan': [(item, count / samples) for item, count in plan if count],
+    }
+
+
+def _uncertainty_chunk(tasks, samples, error_model_overrides, rule_set):
+    return [measurement_uncertainty(urine, patient, serum, stone_type, samples,
+                                    error_model_overrides, seed, rule_set)
+            for urine, patient, serum, stone_type, seed in tasks]
+
+
+def cohort_uncertainty(patients, samples=None, error_model_overrides=None, seed=None,
+                       workers=None, chunk=8, rule_set=None):
+    """
+    measurement_uncertainty for every (urine_profile, patient_profile,
+    serum_labs, stone_type) in patients, in order. Chunks of patients run in
+    a process pool; each patient gets its own child of the seed, so results
+    do not depend on the number of workers. rule_set (default: the active
+    one) is passed to every task, so workers do not depend on the state
+    they were started with.
+    """
+    rule_set = rule_set or active_rule_set()
+    patients = list(patients)
+    seeds = np.random.SeedSequence(seed).spawn(len(patients))
+    tasks = [(*patient, child) for patient, child in zip(patients, seeds)]
+    chunks = [tasks[start:start + chunk] for start in range(0, len(tasks), chunk)]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        results = (_uncertainty_chunk(tasks, samples, error_model_overrides, rule_set)
+                   for tasks in chunks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_uncertainty_chunk, chunks, [samples] * len(chunks),
+                                    [error_model_overrides] * len(chunks),
+                                    [rule_set] * len(chunks)))
+    return [result for chunk_results in results for result in chunk_results]
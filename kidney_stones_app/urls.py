@@ -10,10 +10,25 @@ urlpatterns = [
     path('acute-management/', views.acute_management, name='acute_management'),
     path('chronic-management/', views.chronic_management,
          name='chronic_management'),
+    path('what-if/', views.what_if, name='what_if'),
+    path('what-if/api/', views.what_if_api, name='what_if_api'),
+    path('uncertainty/api/', views.uncertainty_api, name='uncertainty_api'),
     path('educational-resources/', views.educational_resources,
          name='educational_resources'),
     path('oxalate-finder/', views.oxalate_finder, name='oxalate_finder'),
+    path('meal-planner/', views.meal_planner, name='meal_planner'),
+    path('meal-planner/api/', views.meal_planner_api, name='meal_planner_api'),
+    path('urine-history/', views.urine_history, name='urine_history'),
+    path('food-diary/', views.food_diary, name='food_diary'),
+    path('food-diary/<int:entry_id>/delete/', views.food_diary_delete, name='food_diary_delete'),
+    path('patients/<int:patient_id>/recurrence/', views.patient_recurrence,
+         name='patient_recurrence'),
+    path('patients/<int:patient_id>/intake/', views.patient_intake, name='patient_intake'),
+    path('patients/<int:patient_id>/trends/', views.patient_trends, name='patient_trends'),
     path('management-plan/<int:plan_id>/',
          views.management_plan_detail, name='management_plan_detail'),
     path('load-oxalate-data/', views.load_oxalate_data, name='load_oxalate_data'),
+    path('services-cache-stats/', views.services_cache_stats,
+         name='services_cache_stats'),
+    path('rule-trace-stats/', views.rule_trace_stats, name='rule_trace_stats'),
 ]
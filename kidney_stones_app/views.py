@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -7,12 +8,30 @@ from django.db.models import Q
 import json
 import pandas as pd
 
-from .models import PatientProfile, UrineAnalysis, SerumLabs, OxalateContent, ManagementPlan
+from kidney_stones_engine import tracing
+
+from .models import (
+    PatientProfile, UrineAnalysis, SerumLabs, OxalateContent, ManagementPlan, FoodDiaryEntry,
+)
 from .forms import (
     PatientProfileForm, UrineAnalysisForm, SerumLabsForm,
-    AcuteManagementForm, ManagementPlanForm, OxalateSearchForm
+    AcuteManagementForm, ManagementPlanForm, OxalateSearchForm, WhatIfForm, MealPlanForm,
+    FoodDiaryEntryForm,
+)
+from .services import (
+    UrineProfile, SerumPanel, PatientContext, get_acute_management_guidance, URINE_FIELDS,
 )
-from .services import interpret_24hr_urine, generate_management_plan, get_acute_management_guidance
+from .cache import cached_interpretation, cached_management_plan, cache_stats
+from .supersaturation import supersaturation_report
+from .sweep import parameter_sweep, finding_label
+from .uncertainty import measurement_uncertainty, MAX_UNCERTAINTY_SAMPLES
+from .stone_type import load_stone_type_model
+from .similarity import similar_patients
+from .quantiles import percentile_report
+from .diet import diet_guidance, refresh_oxalate_rankings
+from .meal_plan import plan_meals
+from .diary import intake_totals, portion_oxalate
+from .trends import patient_history
 
 
 def home(request):
@@ -66,29 +85,12 @@ def urine_analysis(request):
             serum_labs.patient_profile = patient_profile
             serum_labs.save()
 
-            # Convert to dict for interpretation
-            urine_data = {
-                'volume_L': float(urine_analysis.volume_L),
-                'ph': float(urine_analysis.ph),
-                'calcium_mg': urine_analysis.calcium_mg,
-                'oxalate_mg': urine_analysis.oxalate_mg,
-                'phosphorus_mg': urine_analysis.phosphorus_mg,
-                'uric_acid_mg': urine_analysis.uric_acid_mg,
-                'sodium_mEq': urine_analysis.sodium_mEq,
-                'potassium_mEq': urine_analysis.potassium_mEq,
-                'magnesium_mg': urine_analysis.magnesium_mg,
-                'sulfate_mmol': urine_analysis.sulfate_mmol,
-                'ammonium_mmol': urine_analysis.ammonium_mmol,
-                'citrate_mg': urine_analysis.citrate_mg,
-                'cystine_mg': urine_analysis.cystine_mg,
-            }
-
-            patient_data = {
-                'medical_conditions': patient_profile.medical_conditions,
-                'medications': patient_profile.medications,
-            }
+            urine_data = UrineProfile.from_instance(urine_analysis)
+            patient_data = PatientContext.from_instance(patient_profile)
 
-            interpretation = interpret_24hr_urine(urine_data, patient_data)
+            findings, interpretation = cached_interpretation(urine_data, patient_data)
+            supersaturation = supersaturation_report(urine_data)
+            percentiles = percentile_report(urine_data)
 
             messages.success(request, 'Urine analysis completed successfully!')
 
@@ -97,6 +99,8 @@ def urine_analysis(request):
                 'serum_form': serum_form,
                 'patient_profile': patient_profile,
                 'interpretation': interpretation,
+                'supersaturation': supersaturation,
+                'percentiles': percentiles,
                 'urine_data': urine_data,
                 'active_page': 'urine_analysis',
                 'show_results': True
@@ -145,6 +149,10 @@ def acute_management(request):
     })
 
 
+# Similar prior patients listed with a chronic management plan
+SIMILAR_PATIENTS = 20
+
+
 def chronic_management(request):
     """Chronic Management Plan page"""
     # Get the most recent patient profile and urine analysis
@@ -164,44 +172,19 @@ def chronic_management(request):
             request, 'Please complete Patient Profile and Urine Analysis first.')
         return redirect('kidney_stones_app:patient_profile')
 
+    suggestion = None
     if request.method == 'POST':
         form = ManagementPlanForm(request.POST)
         if form.is_valid():
             stone_type = form.cleaned_data['stone_type']
 
-            # Convert to dict for interpretation
-            urine_data = {
-                'volume_L': float(urine_analysis.volume_L),
-                'ph': float(urine_analysis.ph),
-                'calcium_mg': urine_analysis.calcium_mg,
-                'oxalate_mg': urine_analysis.oxalate_mg,
-                'phosphorus_mg': urine_analysis.phosphorus_mg,
-                'uric_acid_mg': urine_analysis.uric_acid_mg,
-                'sodium_mEq': urine_analysis.sodium_mEq,
-                'potassium_mEq': urine_analysis.potassium_mEq,
-                'magnesium_mg': urine_analysis.magnesium_mg,
-                'sulfate_mmol': urine_analysis.sulfate_mmol,
-                'ammonium_mmol': urine_analysis.ammonium_mmol,
-                'citrate_mg': urine_analysis.citrate_mg,
-                'cystine_mg': urine_analysis.cystine_mg,
-            }
-
-            patient_data = {
-                'medical_conditions': patient_profile.medical_conditions,
-                'medications': patient_profile.medications,
-            }
-
-            serum_data = {
-                'calcium_mg_dL': float(serum_labs.calcium_mg_dL),
-                'intact_pth_pg_mL': serum_labs.intact_pth_pg_mL,
-                'bicarbonate_mEq_L': serum_labs.bicarbonate_mEq_L,
-                'potassium_mEq_L': float(serum_labs.potassium_mEq_L),
-                'creatinine_mg_dL': float(serum_labs.creatinine_mg_dL),
-            }
+            urine_data = UrineProfile.from_instance(urine_analysis)
+            patient_data = PatientContext.from_instance(patient_profile)
+            serum_data = SerumPanel.from_instance(serum_labs)
 
-            interpretation = interpret_24hr_urine(urine_data, patient_data)
-            recommendations = generate_management_plan(
-                stone_type, interpretation, patient_data, serum_data)
+            findings, interpretation = cached_interpretation(urine_data, patient_data)
+            recommendations = cached_management_plan(
+                stone_type, findings, patient_data, serum_data)
 
             # Save management plan
             management_plan = ManagementPlan.objects.create(
@@ -209,30 +192,141 @@ def chronic_management(request):
                 urine_analysis=urine_analysis,
                 serum_labs=serum_labs,
                 stone_type=stone_type,
-                urine_interpretation=interpretation,
-                recommendations=recommendations
+                urine_interpretation=interpretation.as_dict(),
+                recommendations=recommendations,
+                rule_version=findings.rule_set.stamp,
             )
 
+            uncertainty = None
+            if form.cleaned_data['estimate_uncertainty']:
+                uncertainty = measurement_uncertainty(
+                    urine_data, patient_data, serum_data, stone_type)
+                uncertainty['findings'] = [
+                    (finding_label(name), p) for name, p in uncertainty['findings'].items()]
+
             return render(request, 'kidney_stones_app/chronic_management.html', {
                 'form': form,
                 'patient_profile': patient_profile,
                 'urine_analysis': urine_analysis,
                 'interpretation': interpretation,
                 'recommendations': recommendations,
+                'uncertainty': uncertainty,
+                'diet_guidance': diet_guidance(findings),
+                'similar_patients': similar_patients(urine_analysis, SIMILAR_PATIENTS),
                 'stone_type': stone_type,
                 'active_page': 'chronic_management',
                 'show_results': True
             })
     else:
-        form = ManagementPlanForm()
+        suggestion = _suggest_stone_type(urine_analysis, serum_labs)
+        form = ManagementPlanForm(initial={'stone_type': suggestion[0]} if suggestion else None)
 
     return render(request, 'kidney_stones_app/chronic_management.html', {
         'form': form,
         'patient_profile': patient_profile,
+        'stone_type_suggestion': suggestion,
         'active_page': 'chronic_management'
     })
 
 
+def _suggest_stone_type(urine_analysis, serum_labs):
+    """(stone type, probability) from the trained model, or None without one"""
+    model = load_stone_type_model(settings.STONE_TYPE_MODEL['PATH'])
+    if model is None:
+        return None
+    return model.predict_one(UrineProfile.from_instance(urine_analysis),
+                             SerumPanel.from_instance(serum_labs) if serum_labs else None)
+
+
+def _latest_engine_inputs(request):
+    """Engine records of the latest patient profile, urine analysis and serum labs"""
+    if request.user.is_authenticated:
+        patient_profile = PatientProfile.objects.filter(user=request.user).latest('created_at')
+    else:
+        patient_profile = PatientProfile.objects.latest('created_at')
+    urine_analysis = UrineAnalysis.objects.filter(
+        patient_profile=patient_profile).latest('created_at')
+    serum_labs = SerumLabs.objects.filter(
+        patient_profile=patient_profile).order_by('-created_at').first()
+    return (
+        UrineProfile.from_instance(urine_analysis),
+        PatientContext.from_instance(patient_profile),
+        SerumPanel.from_instance(serum_labs) if serum_labs else None,
+    )
+
+
+def what_if(request):
+    """What-if page: findings and plan as one urine parameter is varied"""
+    try:
+        urine_data, patient_data, serum_data = _latest_engine_inputs(request)
+    except (PatientProfile.DoesNotExist, UrineAnalysis.DoesNotExist):
+        messages.warning(
+            request, 'Please complete Patient Profile and Urine Analysis first.')
+        return redirect('kidney_stones_app:patient_profile')
+
+    form = WhatIfForm(request.GET or None)
+    sweep = None
+    if form.is_valid():
+        sweep = parameter_sweep(urine_profile=urine_data, patient_profile=patient_data,
+                                serum_labs=serum_data, **form.sweep_arguments())
+        for state in [sweep['initial'], *sweep['transitions']]:
+            for key in ('findings', 'findings_added', 'findings_removed'):
+                if key in state:
+                    state[key] = [finding_label(name) for name in state[key]]
+
+    return render(request, 'kidney_stones_app/what_if.html', {
+        'form': form,
+        'sweep': sweep,
+        'current_value': getattr(urine_data, sweep['field']) if sweep else None,
+        'active_page': 'what_if',
+        'show_results': sweep is not None
+    })
+
+
+def what_if_api(request):
+    """
+    JSON sweep of the latest urine analysis: ?field=citrate_mg&start=0&stop=1000
+    &points=2000&stone_type=... Only the grid points where the findings or the
+    plan change are returned.
+    """
+    form = WhatIfForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+    try:
+        urine_data, patient_data, serum_data = _latest_engine_inputs(request)
+    except (PatientProfile.DoesNotExist, UrineAnalysis.DoesNotExist):
+        return JsonResponse(
+            {'errors': 'Complete Patient Profile and Urine Analysis first.'}, status=404)
+    return JsonResponse(parameter_sweep(
+        urine_profile=urine_data, patient_profile=patient_data, serum_labs=serum_data,
+        **form.sweep_arguments()))
+
+
+def uncertainty_api(request):
+    """
+    JSON probabilities of each finding and plan item of the latest urine
+    analysis under measurement error: ?stone_type=...&samples=10000&seed=...
+    """
+    stone_type = request.GET.get('stone_type', "Calcium Oxalate")
+    if stone_type not in dict(ManagementPlanForm.STONE_TYPE_CHOICES):
+        return JsonResponse({'errors': f"Unknown stone type '{stone_type}'"}, status=400)
+    try:
+        samples = int(request.GET.get('samples', 0)) or None
+        seed = int(request.GET['seed']) if 'seed' in request.GET else None
+    except ValueError:
+        return JsonResponse({'errors': 'samples and seed must be integers'}, status=400)
+    if samples is not None and not 1 <= samples <= MAX_UNCERTAINTY_SAMPLES:
+        return JsonResponse(
+            {'errors': f'samples must be between 1 and {MAX_UNCERTAINTY_SAMPLES}'}, status=400)
+    try:
+        urine_data, patient_data, serum_data = _latest_engine_inputs(request)
+    except (PatientProfile.DoesNotExist, UrineAnalysis.DoesNotExist):
+        return JsonResponse(
+            {'errors': 'Complete Patient Profile and Urine Analysis first.'}, status=404)
+    return JsonResponse(measurement_uncertainty(
+        urine_data, patient_data, serum_data, stone_type, samples, seed=seed))
+
+
 def educational_resources(request):
     """Educational Resources page"""
     return render(request, 'kidney_stones_app/educational_resources.html', {
@@ -274,6 +368,143 @@ def oxalate_finder(request):
     })
 
 
+def meal_planner(request):
+    """Meal planner page: varied food combinations within a daily oxalate budget"""
+    form = MealPlanForm(request.GET or None)
+    plan = plan_meals(**form.plan_arguments()) if form.is_valid() else None
+    return render(request, 'kidney_stones_app/meal_planner.html', {
+        'form': form,
+        'plan': plan,
+        'active_page': 'meal_planner',
+        'show_results': plan is not None
+    })
+
+
+def meal_planner_api(request):
+    """
+    JSON menus within a daily oxalate budget: ?budget_mg=50&categories=Fruit
+    &categories=Vegetable&exclude=Banana&max_foods=8&per_category=2&menus=3
+    """
+    form = MealPlanForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+    plan = plan_meals(**form.plan_arguments())
+    for menu in plan['menus']:
+        menu['foods'] = [food._asdict() for food in menu['foods']]
+    return JsonResponse(plan)
+
+
+# Diary entries listed on the food diary page
+RECENT_DIARY_ENTRIES = 20
+
+
+def food_diary(request):
+    """Food diary page: log foods and follow daily and weekly oxalate intake"""
+    try:
+        if request.user.is_authenticated:
+            patient_profile = PatientProfile.objects.filter(
+                user=request.user).latest('created_at')
+        else:
+            patient_profile = PatientProfile.objects.latest('created_at')
+    except PatientProfile.DoesNotExist:
+        messages.warning(request, 'Please complete the Patient Profile first.')
+        return redirect('kidney_stones_app:patient_profile')
+
+    if request.method == 'POST':
+        form = FoodDiaryEntryForm(request.POST)
+        if form.is_valid():
+            entry = form.save(commit=False)
+            entry.patient_profile = patient_profile
+            entry.food_name = entry.food.food
+            entry.oxalate_mg = portion_oxalate(entry.food.oxalate_mg, entry.portions)
+            entry.save()
+            messages.success(request, f'Logged {entry.food_name} ({entry.oxalate_mg} mg oxalate).')
+            return redirect('kidney_stones_app:food_diary')
+    else:
+        form = FoodDiaryEntryForm()
+
+    return render(request, 'kidney_stones_app/food_diary.html', {
+        'form': form,
+        'patient_profile': patient_profile,
+        'entries': patient_profile.food_diary.all()[:RECENT_DIARY_ENTRIES],
+        'intake': intake_totals(patient_profile),
+        'active_page': 'food_diary'
+    })
+
+
+def food_diary_delete(request, entry_id):
+    """Removes a diary entry (POST only); its oxalate leaves the totals"""
+    entry = get_object_or_404(FoodDiaryEntry, id=entry_id)
+    if request.method == 'POST':
+        entry.delete()
+        messages.success(request, f'Removed {entry.food_name} from the diary.')
+    return redirect('kidney_stones_app:food_diary')
+
+
+def patient_intake(request, patient_id):
+    """Daily (?days=, default 14) and weekly (?weeks=, default 8) oxalate intake of one patient"""
+    patient_profile = get_object_or_404(PatientProfile, id=patient_id)
+    try:
+        days = min(max(int(request.GET.get('days', 14)), 1), 366)
+        weeks = min(max(int(request.GET.get('weeks', 8)), 1), 104)
+    except ValueError:
+        return JsonResponse({'errors': 'days and weeks must be integers'}, status=400)
+    intake = intake_totals(patient_profile, days, weeks)
+    for row in intake['daily'] + intake['weekly']:
+        row['oxalate_mg'] = float(row['oxalate_mg'])
+    return JsonResponse({'patient_id': patient_profile.id, **intake})
+
+
+# Urine values shown per visit on the history page
+HISTORY_COLUMNS = [
+    ('volume_L', 'Volume (L)'),
+    ('ph', 'pH'),
+    ('calcium_mg', 'Calcium'),
+    ('oxalate_mg', 'Oxalate'),
+    ('citrate_mg', 'Citrate'),
+    ('uric_acid_mg', 'Uric Acid'),
+    ('sodium_mEq', 'Sodium'),
+]
+
+
+def urine_history(request):
+    """Urine history page: changes between the latest patient's visits, from stored trends"""
+    try:
+        if request.user.is_authenticated:
+            patient_profile = PatientProfile.objects.filter(
+                user=request.user).latest('created_at')
+        else:
+            patient_profile = PatientProfile.objects.latest('created_at')
+    except PatientProfile.DoesNotExist:
+        messages.warning(request, 'Please complete the Patient Profile first.')
+        return redirect('kidney_stones_app:patient_profile')
+
+    history = patient_history(patient_profile)
+    for visit in history:
+        visit['cells'] = [(visit['values'][field], visit['deltas'].get(field))
+                          for field, _ in HISTORY_COLUMNS]
+        for key in ('findings', 'findings_new', 'findings_resolved'):
+            visit[key] = [finding_label(name) for name in visit[key]]
+    latest = history[-1] if history else None
+    slopes = [(UrineAnalysis._meta.get_field(field).help_text, latest['slopes'][field])
+              for field in URINE_FIELDS if field in latest['slopes']] if latest else []
+
+    return render(request, 'kidney_stones_app/urine_history.html', {
+        'patient_profile': patient_profile,
+        'history': list(reversed(history)),
+        'columns': [label for _, label in HISTORY_COLUMNS],
+        'slopes': slopes,
+        'active_page': 'urine_history'
+    })
+
+
+def patient_trends(request, patient_id):
+    """Stored visit-to-visit trends of one patient's urine analyses, oldest first"""
+    patient_profile = get_object_or_404(PatientProfile, id=patient_id)
+    return JsonResponse({'patient_id': patient_profile.id,
+                         'visits': patient_history(patient_profile)})
+
+
 @csrf_exempt
 def load_oxalate_data(request):
     """Load oxalate data from JSON file into database"""
@@ -296,6 +527,7 @@ def load_oxalate_data(request):
                     serving_size=food_item['serving_size'],
                     oxalate_level=food_item['oxalate_level']
                 )
+            refresh_oxalate_rankings()
 
             return JsonResponse({'status': 'success', 'count': len(food_data_list)})
         except Exception as e:
@@ -304,6 +536,34 @@ def load_oxalate_data(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
 
+def services_cache_stats(request):
+    """Hit/miss/eviction counters of the in-process services caches"""
+    return JsonResponse(cache_stats())
+
+
+def rule_trace_stats(request):
+    """Per-rule evaluated/fired counters, when RULE_TRACING is enabled"""
+    snapshot = tracing.snapshot()
+    if snapshot is None:
+        return JsonResponse({'enabled': False})
+    return JsonResponse({'enabled': True, **snapshot})
+
+
+def patient_recurrence(request, patient_id):
+    """
+    Stored ROKS-style recurrence risk of one patient. Profiles are scored as
+    they are saved; 'version' tells a score from an older model apart until
+    score_recurrence refreshes it.
+    """
+    patient_profile = get_object_or_404(PatientProfile, id=patient_id)
+    return JsonResponse({
+        'patient_id': patient_profile.id,
+        'recurrence_risk_5y': patient_profile.recurrence_risk_5y,
+        'recurrence_risk_10y': patient_profile.recurrence_risk_10y,
+        'version': patient_profile.recurrence_version,
+    })
+
+
 def management_plan_detail(request, plan_id):
     """View detailed management plan"""
     management_plan = get_object_or_404(ManagementPlan, id=plan_id)
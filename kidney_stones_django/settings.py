@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import json
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -57,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'kidney_stones_app.middleware.RulePackMiddleware',
 ]
 
 ROOT_URLCONF = 'kidney_stones_django.urls'
@@ -147,3 +149,54 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 # Session configuration
 SESSION_COOKIE_AGE = 3600  # 1 hour
 SESSION_SAVE_EVERY_REQUEST = True
+
+# In-process memoization of urine interpretations and management plans
+SERVICES_CACHE = {
+    'INTERPRETATION_MAXSIZE': int(os.environ.get('SERVICES_CACHE_INTERPRETATION_MAXSIZE', 4096)),
+    'PLAN_MAXSIZE': int(os.environ.get('SERVICES_CACHE_PLAN_MAXSIZE', 1024)),
+    'TTL': int(os.environ.get('SERVICES_CACHE_TTL', 3600)),  # seconds
+}
+
+# Per-rule hit counters of the clinical engine, served at /rule-trace-stats/.
+# HISTORY keeps that many recent calls in the report as well.
+RULE_TRACING = {
+    'ENABLED': os.environ.get('RULE_TRACING', '') == '1',
+    'HISTORY': int(os.environ.get('RULE_TRACING_HISTORY', 0)),
+}
+
+# Monte Carlo measurement uncertainty: samples per panel, and per-field
+# overrides of kidney_stones_app.uncertainty.DEFAULT_ERROR_MODEL given as JSON,
+# e.g. UNCERTAINTY_ERROR_MODEL='{"calcium_mg": {"cv": 0.1}}'
+UNCERTAINTY = {
+    'SAMPLES': int(os.environ.get('UNCERTAINTY_SAMPLES', 10000)),
+    'ERROR_MODEL': json.loads(os.environ.get('UNCERTAINTY_ERROR_MODEL') or '{}'),
+}
+
+# Stone-type model trained by `manage.py train_stone_type` (an .npz of NumPy
+# arrays). When the file exists, the chronic management form is pre-filled
+# with the predicted stone type; it is reloaded when the file changes.
+STONE_TYPE_MODEL = {
+    'PATH': os.environ.get('STONE_TYPE_MODEL_PATH') or None,
+}
+
+# Nearest-neighbour index of similar patients on the chronic management page.
+# With a PATH the snapshot written by `manage.py build_similarity_index` is
+# loaded on startup; without one the index is built from the database on
+# first use. Saved panels are added to a buffer that is merged into the tree
+# once it exceeds REBUILD_RATIO of it. Every process catches up with panels,
+# patients and serum labs changed by other processes at most every
+# SYNC_INTERVAL seconds.
+SIMILARITY_INDEX = {
+    'PATH': os.environ.get('SIMILARITY_INDEX_PATH') or None,
+    'LEAF_SIZE': int(os.environ.get('SIMILARITY_INDEX_LEAF_SIZE', 32)),
+    'REBUILD_RATIO': float(os.environ.get('SIMILARITY_INDEX_REBUILD_RATIO', 0.05)),
+    'SYNC_INTERVAL': float(os.environ.get('SIMILARITY_INDEX_SYNC_INTERVAL', 5)),
+}
+
+# Versioned rule pack with the urine/serum thresholds (see rule_packs/).
+# Without a path the built-in defaults are used; with one, the file is
+# re-checked every POLL_INTERVAL seconds and reloaded without a restart.
+RULE_PACK = {
+    'PATH': os.environ.get('RULE_PACK_PATH') or None,
+    'POLL_INTERVAL': float(os.environ.get('RULE_PACK_POLL_INTERVAL', 2)),
+}
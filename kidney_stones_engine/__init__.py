@@ -0,0 +1,15 @@
+"""
+Framework-free clinical engine for kidney stone analysis and management.
+Importing it pulls in neither Django, Streamlit, pandas nor NumPy.
+"""
+from .rules import (  # noqa: F401
+    URINE_FIELDS, SERUM_FIELDS, Finding, FINDING_MESSAGES, SUPERSATURATION_TARGETS,
+    PH_RAISING_MEDICATIONS, PLAN_STEPS, UrineFindings, Interpretation, evaluate_24hr_urine,
+    render_findings, interpret_24hr_urine, plan_conditions, generate_management_plan,
+    plan_from_conditions, ACUTE_SYMPTOMS, STONE_SIZES, ACUTE_GUIDANCE_TABLE,
+    get_acute_management_guidance, URINE_THRESHOLDS, SERUM_THRESHOLDS, DEFAULT_THRESHOLDS,
+    RuleSet, DEFAULT_RULE_SET, active_rule_set, activate_rule_set,
+)
+from .records import (  # noqa: F401
+    UrineProfile, SerumPanel, PatientContext, NO_PATIENT_CONTEXT, RecordArray,
+)
@@ -0,0 +1,140 @@
+"""
+Exhaustive-grid equivalence harness between the engine and the frozen
+reference implementation in reference.py.
+
+Every urine field takes the values on both sides of each threshold the rules
+use, and every panel is combined with each medical condition set, medication
+list, serum lab pattern and stone type. The grid is split across a process
+pool, one slice of urine panels per task.
+
+    python -m kidney_stones_engine.equivalence [--workers N]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+import time
+
+from . import reference
+from .rules import evaluate_24hr_urine, render_findings, generate_management_plan
+
+
+# Values straddling every threshold of interpret_24hr_urine; fields that no
+# rule reads get a single value
+URINE_GRID = {
+    'volume_L': (2.4, 2.5),
+    'ph': (5.9, 6.0, 7.0, 7.1),
+    'calcium_mg': (150, 151),
+    'oxalate_mg': (40, 41, 80, 81),
+    'phosphorus_mg': (800,),
+    'uric_acid_mg': (750, 751),
+    'sodium_mEq': (100, 101),
+    'potassium_mEq': (60,),
+    'magnesium_mg': (100,),
+    'sulfate_mmol': (30, 31),
+    'ammonium_mmol': (45, 46),
+    'citrate_mg': (399, 400),
+    'cystine_mg': (30, 31, 400, 401),
+}
+
+CONDITIONS = ("Renal Tubular Acidosis", "Malabsorption (IBD, Bariatric Surgery, etc.)",
+              "chronic_diarrhea")
+MEDICATION_LISTS = ([], ["Topiramate"], ["Hydrochlorothiazide", "Acetazolamide"])
+# (age, gender) pairs cycled over the patient profiles, so every urine panel
+# is checked for each sex and for unknown and banded ages
+DEMOGRAPHICS = ((None, None), (45, "Female"), (45, "Male"), (70, "Other"))
+
+SERUM_GRID = {
+    'calcium_mg_dL': (10.7, 10.8),
+    'intact_pth_pg_mL': (69, 70),
+    'bicarbonate_mEq_L': (21, 22),
+    'potassium_mEq_L': (3.4, 3.5),
+    'creatinine_mg_dL': (1.0,),
+}
+
+STONE_TYPES = ("Calcium Oxalate", "Calcium Phosphate", "Uric Acid", "Struvite",
+               "Cystine", "Drug-induced", "Unknown")
+
+
+def _grid(spec):
+    fields = list(spec)
+    return [dict(zip(fields, values)) for values in itertools.product(*spec.values())]
+
+
+def urine_panels():
+    return _grid(URINE_GRID)
+
+
+def patient_profiles():
+    profiles = []
+    for size in range(len(CONDITIONS) + 1):
+        for conditions in itertools.combinations(CONDITIONS, size):
+            for medications in MEDICATION_LISTS:
+                age, gender = DEMOGRAPHICS[len(profiles) % len(DEMOGRAPHICS)]
+                profiles.append({'medical_conditions': list(conditions),
+                                 'medications': list(medications),
+                                 'age': age, 'gender': gender})
+    return profiles
+
+
+def serum_panels():
+    return [None] + _grid(SERUM_GRID)
+
+
+def check_slice(start, stop):
+    """Compares engine and reference on urine panels [start, stop) of the grid"""
+    patients = patient_profiles()
+    serums = serum_panels()
+    checked = 0
+    mismatches = []
+    for urine in urine_panels()[start:stop]:
+        for patient in patients:
+            expected_interpretation = reference.interpret_24hr_urine(urine, patient)
+            findings = evaluate_24hr_urine(urine, patient)
+            if (render_findings(findings) != expected_interpretation
+                    or findings.interpretation().as_dict() != expected_interpretation):
+                mismatches.append(('interpretation', urine, patient))
+            for serum in serums:
+                for stone_type in STONE_TYPES:
+                    expected = reference.generate_management_plan(
+                        stone_type, expected_interpretation, patient, serum)
+                    if generate_management_plan(stone_type, findings, patient, serum) != expected:
+                        mismatches.append(('plan', stone_type, urine, patient, serum))
+                    checked += 1
+    return checked, mismatches
+
+
+def run(workers=None, chunk=64):
+    """Runs the whole grid; returns (plans checked, mismatches, seconds)"""
+    workers = workers or os.cpu_count()
+    total = len(urine_panels())
+    bounds = [(start, min(start + chunk, total)) for start in range(0, total, chunk)]
+    started = time.perf_counter()
+    checked = 0
+    mismatches = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for slice_checked, slice_mismatches in pool.map(check_slice, *zip(*bounds)):
+            checked += slice_checked
+            mismatches.extend(slice_mismatches)
+    return checked, mismatches, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    checked, mismatches, seconds = run(args.workers)
+    print(f"{len(urine_panels())} urine panels x {len(patient_profiles())} patients x "
+          f"{len(serum_panels())} serum panels x {len(STONE_TYPES)} stone types: "
+          f"{checked} plans checked in {seconds:.1f} s")
+    for mismatch in mismatches[:20]:
+        print('MISMATCH', *mismatch)
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} mismatches")
+    print("Engine output matches the reference implementation")
+
+
+if __name__ == '__main__':
+    main()
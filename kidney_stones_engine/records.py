@@ -0,0 +1,185 @@
+"""
+Compact immutable record types for the engine inputs.
+Records are NamedTuples: slotted, hashable and built in C from a values_list()
+row, so a request or a batch job does not pay for a dict per panel.
+"""
+from array import array
+from typing import NamedTuple, Optional
+
+
+class UrineProfile(NamedTuple):
+    """One 24-hour urine panel, fields as in UrineAnalysis"""
+    volume_L: float
+    ph: float
+    calcium_mg: int
+    oxalate_mg: int
+    phosphorus_mg: int
+    uric_acid_mg: int
+    sodium_mEq: int
+    potassium_mEq: int
+    magnesium_mg: int
+    sulfate_mmol: int
+    ammonium_mmol: int
+    citrate_mg: int
+    cystine_mg: int = 0
+
+    @classmethod
+    def from_instance(cls, urine_analysis):
+        """From a UrineAnalysis model instance, with decimals as floats"""
+        return cls(
+            float(urine_analysis.volume_L), float(urine_analysis.ph),
+            urine_analysis.calcium_mg, urine_analysis.oxalate_mg, urine_analysis.phosphorus_mg,
+            urine_analysis.uric_acid_mg, urine_analysis.sodium_mEq, urine_analysis.potassium_mEq,
+            urine_analysis.magnesium_mg, urine_analysis.sulfate_mmol, urine_analysis.ammonium_mmol,
+            urine_analysis.citrate_mg, urine_analysis.cystine_mg,
+        )
+
+    @classmethod
+    def from_values(cls, row):
+        """From a UrineAnalysis.objects.values() row, with decimals as floats"""
+        return cls(
+            float(row['volume_L']), float(row['ph']), row['calcium_mg'], row['oxalate_mg'],
+            row['phosphorus_mg'], row['uric_acid_mg'], row['sodium_mEq'], row['potassium_mEq'],
+            row['magnesium_mg'], row['sulfate_mmol'], row['ammonium_mmol'], row['citrate_mg'],
+            row['cystine_mg'],
+        )
+
+    @classmethod
+    def from_dict(cls, urine_profile):
+        """From a plain dict as used by the Streamlit app, values kept as given"""
+        return cls(
+            urine_profile['volume_L'], urine_profile['ph'], urine_profile['calcium_mg'],
+            urine_profile['oxalate_mg'], urine_profile['phosphorus_mg'],
+            urine_profile['uric_acid_mg'], urine_profile['sodium_mEq'],
+            urine_profile['potassium_mEq'], urine_profile['magnesium_mg'],
+            urine_profile['sulfate_mmol'], urine_profile['ammonium_mmol'],
+            urine_profile['citrate_mg'], urine_profile.get('cystine_mg', 0),
+        )
+
+    @classmethod
+    def coerce(cls, urine_profile):
+        return urine_profile if isinstance(urine_profile, cls) else cls.from_dict(urine_profile)
+
+
+class SerumPanel(NamedTuple):
+    """Serum labs, fields as in SerumLabs"""
+    calcium_mg_dL: float = 0
+    intact_pth_pg_mL: int = 0
+    bicarbonate_mEq_L: int = 0
+    potassium_mEq_L: float = 0
+    creatinine_mg_dL: float = 0
+
+    @classmethod
+    def from_instance(cls, serum_labs):
+        """From a SerumLabs model instance, with decimals as floats"""
+        return cls(
+            float(serum_labs.calcium_mg_dL), serum_labs.intact_pth_pg_mL,
+            serum_labs.bicarbonate_mEq_L, float(serum_labs.potassium_mEq_L),
+            float(serum_labs.creatinine_mg_dL),
+        )
+
+    @classmethod
+    def from_values(cls, row):
+        """From a SerumLabs.objects.values() row, with decimals as floats"""
+        return cls(
+            float(row['calcium_mg_dL']), row['intact_pth_pg_mL'], row['bicarbonate_mEq_L'],
+            float(row['potassium_mEq_L']), float(row['creatinine_mg_dL']),
+        )
+
+    @classmethod
+    def from_dict(cls, serum_labs):
+        """From a plain dict; missing labs count as 0 like the original .get() calls"""
+        return cls(*(serum_labs.get(field, 0) for field in cls._fields))
+
+    @classmethod
+    def coerce(cls, serum_labs):
+        """None for absent labs (None or an empty dict), otherwise a SerumPanel"""
+        if not serum_labs:
+            return None
+        return serum_labs if isinstance(serum_labs, cls) else cls.from_dict(serum_labs)
+
+
+class PatientContext(NamedTuple):
+    """The parts of a PatientProfile the rules read"""
+    medical_conditions: frozenset = frozenset()
+    medications: frozenset = frozenset()
+    age: Optional[int] = None
+    gender: Optional[str] = None
+
+    @classmethod
+    def from_instance(cls, patient_profile):
+        """From a PatientProfile model instance"""
+        return cls(
+            frozenset(patient_profile.medical_conditions or ()),
+            frozenset(patient_profile.medications or ()),
+            patient_profile.age, patient_profile.gender,
+        )
+
+    @classmethod
+    def from_values(cls, row):
+        """From a PatientProfile.objects.values() row"""
+        return cls(
+            frozenset(row['medical_conditions'] or ()), frozenset(row['medications'] or ()),
+            row.get('age'), row.get('gender'),
+        )
+
+    @classmethod
+    def from_dict(cls, patient_profile):
+        """From a plain dict as used by the Streamlit app"""
+        return cls(
+            frozenset(patient_profile.get('medical_conditions') or ()),
+            frozenset(patient_profile.get('medications') or ()),
+            patient_profile.get('age'), patient_profile.get('gender'),
+        )
+
+    @classmethod
+    def coerce(cls, patient_profile):
+        if isinstance(patient_profile, cls):
+            return patient_profile
+        return cls.from_dict(patient_profile) if patient_profile else NO_PATIENT_CONTEXT
+
+
+NO_PATIENT_CONTEXT = PatientContext()
+
+_TYPECODES = {float: 'd', int: 'q'}
+
+
+class RecordArray:
+    """
+    Column-oriented container for many UrineProfile or SerumPanel records:
+    one array.array per field, 8 bytes per value instead of a tuple per row.
+    columns() can be handed to the batch functions as is.
+    """
+
+    def __init__(self, record_type, records=()):
+        self.record_type = record_type
+        self._columns = {
+            field: array(_TYPECODES[record_type.__annotations__[field]])
+            for field in record_type._fields
+        }
+        self.extend(records)
+
+    def append(self, record):
+        for column, value in zip(self._columns.values(), record):
+            column.append(value)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return len(next(iter(self._columns.values())))
+
+    def __getitem__(self, index):
+        return self.record_type._make(column[index] for column in self._columns.values())
+
+    def __iter__(self):
+        return map(self.record_type._make, zip(*self._columns.values()))
+
+    def columns(self):
+        """Field name -> array.array mapping (zero-copy with numpy.asarray)"""
+        return dict(self._columns)
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self._columns.values())
@@ -0,0 +1,134 @@
+"""
+Versioned rule-pack files for the thresholds of the urine and serum rules.
+
+A rule pack is a JSON file; thresholds it leaves out keep their defaults
+(rules.DEFAULT_THRESHOLDS). Optional reference ranges override thresholds
+by sex and/or age band [age_min, age_max):
+
+    {
+        "version": "2025.1-clinic",
+        "thresholds": {"oxalate_mg_max": 45, "citrate_mg_min": 320},
+        "reference_ranges": [
+            {"sex": "Female", "thresholds": {"citrate_mg_min": 550}},
+            {"sex": "Male", "age_min": 60, "thresholds": {"calcium_mg_max": 200}}
+        ]
+    }
+
+load_rule_pack() compiles a file into a RuleSet. RulePackWatcher checks the
+file's modification time at most once per interval and, when it changed,
+loads the new pack and swaps it in with rules.activate_rule_set(). A pack
+that fails to load is logged and the rule set in use is kept.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from . import rules
+from .rules import RuleSet
+
+
+logger = logging.getLogger(__name__)
+
+
+class RulePackError(ValueError):
+    """A rule-pack file that cannot be read or does not validate"""
+
+
+def parse_rule_pack(data, source="<rule pack>"):
+    """Compiles an already decoded rule pack into a RuleSet"""
+    if not isinstance(data, dict):
+        raise RulePackError(f"{source}: a rule pack must be a JSON object")
+    unknown = sorted(set(data) - {"version", "thresholds", "reference_ranges"})
+    if unknown:
+        raise RulePackError(f"{source}: unknown keys {', '.join(unknown)}")
+    if "version" not in data:
+        raise RulePackError(f"{source}: missing 'version'")
+    thresholds = data.get("thresholds", {})
+    if not isinstance(thresholds, dict):
+        raise RulePackError(f"{source}: 'thresholds' must be an object")
+    reference_ranges = data.get("reference_ranges", [])
+    if not isinstance(reference_ranges, list) or not all(
+            isinstance(entry, dict) for entry in reference_ranges):
+        raise RulePackError(f"{source}: 'reference_ranges' must be a list of objects")
+    try:
+        return RuleSet(data["version"], thresholds, reference_ranges)
+    except ValueError as error:
+        raise RulePackError(f"{source}: {error}") from error
+
+
+def load_rule_pack(path):
+    """Reads and compiles the rule pack at path"""
+    try:
+        with open(path, encoding="utf-8") as rule_pack:
+            data = json.load(rule_pack)
+    except (OSError, ValueError) as error:
+        raise RulePackError(f"{path}: {error}") from error
+    return parse_rule_pack(data, path)
+
+
+class RulePackWatcher:
+    """
+    Keeps the active rule set in sync with a rule-pack file. poll() is cheap
+    enough to call on every request: between checks it only compares a
+    monotonic timestamp, and a single thread does the reload.
+    """
+
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Loads and activates the file now; raises RulePackError if it is invalid"""
+        with self._lock:
+            signature = self._stat()
+            rule_set = load_rule_pack(self.path)
+            rules.activate_rule_set(rule_set)
+            self._signature = signature
+            self._next_check = time.monotonic() + self.interval
+            return rule_set
+
+    def poll(self):
+        """Reloads the file if it changed since the last check; returns the active rule set"""
+        if time.monotonic() < self._next_check or not self._lock.acquire(blocking=False):
+            return rules.active_rule_set()
+        try:
+            self._next_check = time.monotonic() + self.interval
+            signature = self._stat()
+            if signature != self._signature:
+                self._signature = signature
+                rule_set = load_rule_pack(self.path)
+                previous = rules.activate_rule_set(rule_set)
+                logger.info("Rule pack %s: %s replaces %s", self.path,
+                            rule_set.version, previous.version)
+        except (OSError, RulePackError) as error:
+            logger.error("%s; keeping rule set %s", error, rules.active_rule_set().version)
+        finally:
+            self._lock.release()
+        return rules.active_rule_set()
+
+
+_watcher = None
+
+
+def watch(path, interval=2.0):
+    """Loads the rule pack at path and keeps following it on poll()"""
+    global _watcher
+    watcher = RulePackWatcher(path, interval)
+    watcher.load()
+    _watcher = watcher
+    return watcher
+
+
+def poll():
+    """Checks the watched rule pack, if any, for changes"""
+    if _watcher is not None:
+        _watcher.poll()
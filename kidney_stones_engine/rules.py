@@ -0,0 +1,741 @@
+"""
+Clinical rules for kidney stone analysis and management.
+Shared by the Django app and the Streamlit app; only the standard library is
+imported here so the rules can be embedded anywhere.
+"""
+from bisect import bisect_right
+from collections.abc import Mapping
+import hashlib
+import itertools
+import json
+from operator import attrgetter
+from string import Formatter
+from time import perf_counter
+from types import MappingProxyType
+
+from .records import UrineProfile, SerumPanel, PatientContext
+
+
+URINE_FIELDS = (
+    "volume_L", "ph", "calcium_mg", "oxalate_mg", "phosphorus_mg",
+    "uric_acid_mg", "sodium_mEq", "potassium_mEq", "magnesium_mg",
+    "sulfate_mmol", "ammonium_mmol", "citrate_mg", "cystine_mg",
+)
+
+SERUM_FIELDS = (
+    "calcium_mg_dL", "intact_pth_pg_mL", "bicarbonate_mEq_L",
+    "potassium_mEq_L", "creatinine_mg_dL",
+)
+
+
+class Finding:
+    """
+    Finding codes produced by the 24-hour urine rules, one bit per rule.
+    Plain integers are used rather than enum.IntFlag so that combining codes
+    on the hot path costs a single integer operation.
+    """
+    URINE_VOLUME_LOW = 1 << 0
+    URINE_PH_ACIDIC = 1 << 1
+    URINE_PH_ALKALINE_RTA = 1 << 2
+    URINE_PH_VERY_ALKALINE = 1 << 3
+    URINE_CALCIUM_HIGH = 1 << 4
+    URINE_OXALATE_HIGH = 1 << 5
+    URINE_OXALATE_VERY_HIGH = 1 << 6
+    URINE_CITRATE_LOW = 1 << 7
+    URINE_URIC_ACID_HIGH = 1 << 8
+    URINE_SODIUM_HIGH = 1 << 9
+    URINE_SULFATE_HIGH = 1 << 10
+    URINE_AMMONIUM_HIGH = 1 << 11
+    URINE_CYSTINE_HIGH = 1 << 12
+    URINE_CYSTINE_VERY_HIGH = 1 << 13
+
+    @classmethod
+    def names(cls, codes):
+        """Names of the findings set in a bitmask, e.g. for logging"""
+        return [name for name, bit in vars(cls).items()
+                if name.isupper() and codes & bit]
+
+
+# Interpretation key and message template of each finding, in display order.
+# Findings sharing a key are concatenated (e.g. the >80 mg/d oxalate remark).
+# Placeholders name a urine field or a threshold of the rule set.
+FINDING_MESSAGES = (
+    (Finding.URINE_VOLUME_LOW, "urine_volume",
+     "Low urine volume ({volume_L} L/d). Goal is ~{volume_L_min} L/d for reducing recurrence risk."),
+    (Finding.URINE_PH_ACIDIC, "urine_ph",
+     "Acidic urine pH ({ph}). May increase risk of uric acid stones."),
+    (Finding.URINE_PH_ALKALINE_RTA, "urine_ph",
+     "Alkaline urine pH ({ph}) with diagnosed Renal Tubular Acidosis (RTA). Suggests a risk for calcium phosphate stones."),
+    (Finding.URINE_PH_VERY_ALKALINE, "urine_ph",
+     "Very alkaline urine pH ({ph}). May indicate urine infection by bacteria with urease and a risk for struvite stones."),
+    (Finding.URINE_CALCIUM_HIGH, "urine_calcium",
+     "Hypercalciuria ({calcium_mg} mg/d). Levels >{calcium_mg_max} mg/d increase stone risk. Correlate with urine sodium."),
+    (Finding.URINE_OXALATE_HIGH, "urine_oxalate",
+     "Elevated urine oxalate ({oxalate_mg} mg/d). Values >{oxalate_mg_max} mg/d are excessive."),
+    (Finding.URINE_OXALATE_VERY_HIGH, "urine_oxalate",
+     " For values >{oxalate_mg_primary_hyperoxaluria} mg/d, consider primary hyperoxaluria."),
+    (Finding.URINE_CITRATE_LOW, "urine_citrate",
+     "Low urine citrate ({citrate_mg} mg/d). Values <{citrate_mg_min} mg/d may limit risk for calcareous stones."),
+    (Finding.URINE_URIC_ACID_HIGH, "urine_uric_acid",
+     "High urine uric acid ({uric_acid_mg} mg/d). Consider xanthine oxidase inhibitor or reduced purine intake if recurrent calcium oxalate or uric acid stones persist."),
+    (Finding.URINE_SODIUM_HIGH, "urine_sodium",
+     "High urine sodium ({sodium_mEq} mEq). If hypercalciuria is present, a goal of <{sodium_mEq_max} mEq/d is sought."),
+    (Finding.URINE_SULFATE_HIGH, "urine_sulfate",
+     "High urine sulfate ({sulfate_mmol} mmol/d). Suggests excessive dietary animal protein."),
+    (Finding.URINE_AMMONIUM_HIGH, "urine_ammonium",
+     "High urine ammonium ({ammonium_mmol} mmol/d). Suggests excess acid production from diet, chronic diarrhea, or other cause."),
+    (Finding.URINE_CYSTINE_HIGH, "urine_cystine",
+     "Elevated urine cystine ({cystine_mg} mg/d). Normal individuals typically excrete <{cystine_mg_max} mg/d. Patients with cystinuria generally excrete >{cystine_mg_cystinuria} mg/d."),
+    (Finding.URINE_CYSTINE_VERY_HIGH, "urine_cystine",
+     " Highly suggestive of cystinuria."),
+)
+
+SUPERSATURATION_TARGETS = "General supersaturation targets for reducing risk are <4 for calcium oxalate stones and <1 for calcium phosphate and uric acid stones."
+
+# Thresholds of the urine rules, in the order evaluate_24hr_urine unpacks them.
+# The comparisons are fixed by the rules; rule packs only move the limits.
+URINE_THRESHOLDS = (
+    ("volume_L_min", 2.5),
+    ("ph_acidic_below", 6.0),
+    ("ph_alkaline_above", 7.0),
+    ("calcium_mg_max", 150),
+    ("oxalate_mg_max", 40),
+    ("oxalate_mg_primary_hyperoxaluria", 80),
+    ("citrate_mg_min", 400),
+    ("uric_acid_mg_max", 750),
+    ("sodium_mEq_max", 100),
+    ("sulfate_mmol_max", 30),
+    ("ammonium_mmol_max", 45),
+    ("cystine_mg_max", 30),
+    ("cystine_mg_cystinuria", 400),
+)
+
+# Thresholds of the serum conditions of the management plan
+SERUM_THRESHOLDS = (
+    ("serum_calcium_mg_dL_high", 10.8),
+    ("serum_pth_pg_mL_high", 70),
+    ("serum_potassium_mEq_L_low", 3.5),
+    ("serum_bicarbonate_mEq_L_low", 22),
+)
+
+DEFAULT_THRESHOLDS = MappingProxyType(dict(URINE_THRESHOLDS + SERUM_THRESHOLDS))
+
+# Bumped whenever the rule logic or message text in this module changes, so
+# stored plans can be told apart from those the current code would produce
+RULES_VERSION = "1"
+
+
+def _compile_message(template, thresholds):
+    """
+    Compiles a str.format message template once into a printf-style format
+    and a getter of the fields it reads, so rendering skips parsing the
+    template and building a dict of the panel values. Threshold placeholders
+    are filled in here.
+    """
+    parts = []
+    fields = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if spec or conversion:
+            raise ValueError(f"Unsupported format spec in message template: {template!r}")
+        parts.append(literal.replace("%", "%%"))
+        if field in thresholds:
+            parts.append(str(thresholds[field]).replace("%", "%%"))
+        elif field:
+            parts.append("%s")
+            fields.append(field)
+    fmt = "".join(parts)
+    if not fields:
+        text = fmt % ()
+        return lambda values: text
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda values: fmt % (getter(values),)
+    return lambda values: fmt % getter(values)
+
+
+def _compile_key(entries):
+    """Renderer of one interpretation key from the (finding, render) pairs under it"""
+    if len(entries) == 1:
+        render = entries[0][1]
+        return lambda codes, values: render(values)
+    return lambda codes, values: "".join(
+        [render(values) for finding, render in entries if codes & finding])
+
+
+def _compile_messages(thresholds):
+    """
+    FINDING_MESSAGES compiled per interpretation key, in display order:
+    (key, mask of every finding under the key, renderer(codes, values))
+    """
+    return tuple(
+        (key, sum(finding for finding, _ in entries), _compile_key(entries))
+        for key, entries in (
+            (key, [(finding, _compile_message(message, thresholds))
+                   for finding, message_key, message in FINDING_MESSAGES if message_key == key])
+            for key in dict.fromkeys(key for _, key, _ in FINDING_MESSAGES)
+        )
+    )
+
+
+def _check_thresholds(thresholds):
+    unknown = sorted(set(thresholds) - set(DEFAULT_THRESHOLDS))
+    if unknown:
+        raise ValueError(f"Unknown thresholds: {', '.join(unknown)}")
+    for name, value in thresholds.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Threshold {name} must be a number, got {value!r}")
+
+
+def _check_reference_range(entry):
+    unknown = sorted(set(entry) - {"sex", "age_min", "age_max", "thresholds"})
+    if unknown:
+        raise ValueError(f"Unknown reference range keys: {', '.join(unknown)}")
+    for bound in ("age_min", "age_max"):
+        value = entry.get(bound)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"Reference range {bound} must be a number, got {value!r}")
+    if entry.get("age_min") is not None and entry.get("age_max") is not None \
+            and entry["age_min"] >= entry["age_max"]:
+        raise ValueError(f"Empty reference range age band: {entry!r}")
+    _check_thresholds(entry.get("thresholds", {}))
+
+
+class RuleSet:
+    """
+    A rule pack compiled for evaluation: the thresholds unpacked into tuples
+    in the order the rules read them, and the finding messages compiled with
+    the thresholds filled in. A RuleSet is never modified after it is built,
+    so replacing the active one is a single assignment and every call works
+    on the complete set it started with.
+
+    reference_ranges optionally overrides thresholds by sex and/or age band
+    ([age_min, age_max) in years); later entries win where bands overlap.
+    Every distinct combination is compiled into its own RuleSet up front and
+    indexed per sex by sorted age breakpoints, so for_patient() is one dict
+    lookup and one bisect.
+    """
+    __slots__ = ('version', 'stamp', 'thresholds', 'urine_limits', 'serum_limits',
+                 'key_messages', 'key_renderers', 'reference_ranges', 'variants',
+                 'reference_index')
+
+    def __init__(self, version, thresholds=None, reference_ranges=()):
+        thresholds = dict(thresholds or ())
+        _check_thresholds(thresholds)
+        merged = {**DEFAULT_THRESHOLDS, **thresholds}
+
+        self.version = str(version)
+        self.thresholds = MappingProxyType(merged)
+        self.urine_limits = tuple(merged[name] for name, _ in URINE_THRESHOLDS)
+        self.serum_limits = tuple(merged[name] for name, _ in SERUM_THRESHOLDS)
+        self.key_messages = _compile_messages(merged)
+        self.key_renderers = {key: render for key, _, render in self.key_messages}
+
+        self.reference_ranges = tuple(MappingProxyType(dict(entry)) for entry in reference_ranges)
+        for entry in self.reference_ranges:
+            _check_reference_range(entry)
+        # RULES_VERSION, the pack version and a digest of everything the pack
+        # sets, stored with each plan to find the stale ones
+        digest = hashlib.sha256(json.dumps(
+            [merged, [dict(entry) for entry in self.reference_ranges]], sort_keys=True,
+        ).encode()).hexdigest()[:12]
+        self.stamp = f"{RULES_VERSION}:{self.version}:{digest}"
+
+        self.variants = (self,)
+        self.reference_index = None
+        if self.reference_ranges:
+            self._build_reference_index()
+
+    def _build_reference_index(self):
+        """
+        reference_index maps each sex (None for unknown or unlisted) to
+        (age breakpoints, variant id per age segment, variant id for an
+        unknown age); variants[id] is the range-free RuleSet to apply.
+        """
+        variants = {}
+
+        def variant_id(entries):
+            thresholds = dict(self.thresholds)
+            for entry in entries:
+                thresholds.update(entry.get("thresholds", {}))
+            key = tuple(thresholds.values())
+            if key not in variants:
+                variants[key] = (len(variants), RuleSet(self.version, thresholds))
+            return variants[key][0]
+
+        variant_id(())  # variant 0 applies the pack thresholds unchanged
+        index = {}
+        for sex in dict.fromkeys([None] + [entry.get("sex") for entry in self.reference_ranges]):
+            entries = [entry for entry in self.reference_ranges
+                       if entry.get("sex") is None or entry.get("sex") == sex]
+            breakpoints = sorted({entry[bound] for entry in entries
+                                  for bound in ("age_min", "age_max")
+                                  if entry.get(bound) is not None})
+            segments = []
+            for start in [float("-inf")] + breakpoints:
+                segments.append(variant_id(
+                    [entry for entry in entries
+                     if (entry.get("age_min") is None or entry["age_min"] <= start)
+                     and (entry.get("age_max") is None or start < entry["age_max"])]))
+            unknown_age = variant_id(
+                [entry for entry in entries
+                 if entry.get("age_min") is None and entry.get("age_max") is None])
+            index[sex] = (tuple(breakpoints), tuple(segments), unknown_age)
+
+        self.variants = tuple(rule_set for _, rule_set in variants.values())
+        for variant in self.variants:
+            variant.stamp = self.stamp
+        self.reference_index = index
+
+    def for_patient(self, age, sex):
+        """The range-free RuleSet for a patient's age (years) and sex"""
+        index = self.reference_index
+        if index is None:
+            return self
+        breakpoints, segments, unknown_age = index.get(sex) or index[None]
+        if age is None:
+            return self.variants[unknown_age]
+        return self.variants[segments[bisect_right(breakpoints, age)]]
+
+    def __reduce__(self):
+        # Recompiled from the pack when unpickled, e.g. in a worker process
+        return RuleSet, (self.version, dict(self.thresholds),
+                         [dict(entry) for entry in self.reference_ranges])
+
+    def __repr__(self):
+        return f"RuleSet({self.version!r})"
+
+
+# The default rule set is flat, as the original rules were: sex- and
+# age-specific limits are opt-in (see rule_packs/sex_specific_uric_acid.json)
+DEFAULT_RULE_SET = RuleSet("default")
+
+# The rule set used when a call does not pass one; see activate_rule_set()
+_active_rule_set = DEFAULT_RULE_SET
+
+
+def active_rule_set():
+    return _active_rule_set
+
+
+def activate_rule_set(rule_set):
+    """Makes rule_set the one used by subsequent calls; returns the previous one"""
+    global _active_rule_set
+    previous, _active_rule_set = _active_rule_set, rule_set
+    return previous
+
+
+PH_RAISING_MEDICATIONS = ("Topiramate", "Acetazolamide")
+
+# Every recommendation generate_management_plan can emit, in output order.
+# Each step is (stone type or None for all types, condition or None, text).
+PLAN_STEPS = (
+    (None, None, "Increase urine volume to ~2.5 L/day. This is always helpful in lowering supersaturation."),
+
+    ("Calcium Oxalate", None, "Focus on addressing reversible factors for calcium oxalate stones."),
+    ("Calcium Oxalate", "hypercalciuria", "Restrict sodium intake (<2,300 mg/d)."),
+    ("Calcium Oxalate", "hypercalciuria", "Administer thiazide if hypercalciuric."),
+    ("Calcium Oxalate", None, "Optimize calcium intake (1,000-1,200 mg/d). Avoid strict calcium restriction as it can worsen hyperoxaluria and bone loss."),
+    ("Calcium Oxalate", "hypocitraturia", "Administer potassium citrate and/or treat potassium deficiency if hypocitraturic."),
+    ("Calcium Oxalate", "hyperoxaluria", "Consider oxalate restriction for significant hyperoxaluria."),
+    ("Calcium Oxalate", "hyperoxaluria", "Consider sucrose/fructose restriction."),
+    ("Calcium Oxalate", "hyperoxaluria", "Consider calcium citrate with meals to bind intestinal oxalate."),
+    ("Calcium Oxalate", None, "Restrict animal protein."),
+    ("Calcium Oxalate", "malabsorption", "Given history of malabsorption, consider enteric hyperoxaluria. Calcium citrate with meals is particularly relevant."),
+    ("Calcium Oxalate", "hyperparathyroidism", "Given hypercalcemia and non-suppressed PTH, primary hyperparathyroidism is likely. Parathyroidectomy is the most appropriate therapy."),
+
+    ("Calcium Phosphate", None, "Focus on addressing reversible factors for calcium phosphate stones."),
+    ("Calcium Phosphate", "alkalinizing_medication", "Discontinuation of offending medications that increase urine pH (e.g., topiramate, acetazolamide) is critical."),
+    ("Calcium Phosphate", None, "Restrict sodium intake."),
+    ("Calcium Phosphate", None, "Administer thiazide if hypercalciuric."),
+    # Simplified check for hypokalemia
+    ("Calcium Phosphate", "hypokalemia", "Treat hypokalemia if hypocitraturic."),
+    ("Calcium Phosphate", "hypokalemia", "Consider adding potassium chloride if there is concomitant potassium deficiency to help lower urine pH and increase citrate."),
+    # Simplified check for acidosis
+    ("Calcium Phosphate", "acidosis", "Treat metabolic acidosis with potassium citrate while avoiding excessive urinary alkalinization."),
+
+    ("Uric Acid", None, "Focus on raising urine pH to 6.5-7.0 using alkali therapy (potassium citrate or sodium bicarbonate)."),
+    ("Uric Acid", "chronic_diarrhea", "Treat chronic diarrhea if present."),
+    ("Uric Acid", None, "Advise lower animal protein intake."),
+    ("Uric Acid", "hyperuricosuria", "Consider allopurinol if hyperuricosuric and stones persist despite pH normalization."),
+
+    ("Struvite", None, "Eradication of infection with antibiotics and early surgical removal of bacteria-laden stones are the cornerstones of treatment."),
+    ("Struvite", None, "Increase urine volume."),
+    ("Struvite", None, "Urease inhibitors (e.g., acetohydroxamic acid) may be considered but have side effects."),
+
+    ("Cystine", None, "Increase urine volume to achieve urine cystine <250 mg/L."),
+    ("Cystine", None, "Restrict dietary sodium."),
+    ("Cystine", None, "Reduce methionine and cystine intake through dietary restriction of animal protein."),
+    ("Cystine", None, "Apply alkali therapy (potassium citrate or sodium bicarbonate) to maintain urine pH between 7.0 and 7.5 to enhance cystine solubility."),
+    ("Cystine", None, "If stones persist despite initial measures, consider thiol drugs (tiopronin, penicillamine, captopril), acknowledging their cost and side effects."),
+
+    ("Drug-induced", None, "Withdraw the offending medication."),
+    ("Drug-induced", None, "Increase urine volume."),
+)
+
+# The steps above grouped by stone type, so a plan only walks its own steps
+_PLAN_STEPS_BY_TYPE = {
+    stone_type: tuple(
+        (condition, text) for step_type, condition, text in PLAN_STEPS
+        if step_type is None or step_type == stone_type)
+    for stone_type in {step[0] for step in PLAN_STEPS if step[0]}
+}
+_GENERAL_PLAN_STEPS = tuple(
+    (condition, text) for step_type, condition, text in PLAN_STEPS if step_type is None)
+
+
+# Fixed leading text of every finding message, to read findings back from
+# rendered interpretations
+_MESSAGE_PREFIXES = tuple(
+    (finding, key, message.split("{", 1)[0]) for finding, key, message in FINDING_MESSAGES)
+
+# Active tracing.RuleTracer; None keeps tracing off the hot path
+_tracer = None
+
+
+class UrineFindings:
+    """
+    Finding codes of one 24-hour urine panel with the UrineProfile they refer
+    to and the RuleSet that produced them (the active one by default).
+    """
+    __slots__ = ('codes', 'values', 'rule_set')
+
+    def __init__(self, codes, values, rule_set=None):
+        self.codes = codes
+        self.values = values
+        self.rule_set = rule_set or _active_rule_set
+
+    def __contains__(self, finding):
+        return bool(self.codes & finding)
+
+    def __repr__(self):
+        return f"UrineFindings({' | '.join(Finding.names(self.codes)) or 0})"
+
+    @classmethod
+    def from_interpretation(cls, interpretation, rule_set=None):
+        """
+        From a rendered interpretation dict, as returned by interpret_24hr_urine
+        and stored with older management plans. The codes are recovered from
+        the message texts; the measured values are not, so the result can feed
+        the plan rules but not be rendered again.
+        """
+        codes = 0
+        for finding, key, prefix in _MESSAGE_PREFIXES:
+            if prefix in interpretation.get(key, ""):
+                codes |= finding
+        return cls(codes, None, rule_set)
+
+    @classmethod
+    def coerce(cls, findings):
+        """UrineFindings of an evaluate_24hr_urine result, an Interpretation or a legacy dict"""
+        if isinstance(findings, cls):
+            return findings
+        if isinstance(findings, Interpretation):
+            return findings.findings
+        if isinstance(findings, Mapping):
+            return cls.from_interpretation(findings)
+        raise TypeError(
+            f"Expected UrineFindings or an interpretation dict, got {type(findings).__name__}")
+
+    def interpretation(self):
+        """Lazily rendered interpretation of these findings"""
+        return Interpretation(self)
+
+
+class Interpretation(Mapping):
+    """
+    Read-only interpretation mapping whose messages are rendered on first
+    access. The keys come from the finding codes alone, so code that only
+    checks which abnormalities exist never formats any text; templates
+    iterate its items() like the dict returned by render_findings, and
+    as_dict() gives a JSON-serializable copy.
+    """
+    __slots__ = ('findings', '_keys', '_rendered')
+
+    def __init__(self, findings):
+        self.findings = findings
+        codes = findings.codes
+        self._keys = tuple(
+            [key for key, mask, _ in findings.rule_set.key_messages if codes & mask]
+            + ["supersaturation_targets"])
+        self._rendered = {"supersaturation_targets": SUPERSATURATION_TARGETS}
+
+    def __getitem__(self, key):
+        text = self._rendered.get(key)
+        if text is not None:
+            return text
+        if key not in self._keys:
+            raise KeyError(key)
+        text = self.findings.rule_set.key_renderers[key](self.findings.codes, self.findings.values)
+        self._rendered[key] = text
+        return text
+
+    def as_dict(self):
+        """Every message rendered, as a fresh JSON-serializable dict"""
+        rendered = self._rendered
+        if len(rendered) < len(self._keys):
+            codes = self.findings.codes
+            values = self.findings.values
+            renderers = self.findings.rule_set.key_renderers
+            for key in self._keys:
+                if key not in rendered:
+                    rendered[key] = renderers[key](codes, values)
+        return {key: rendered[key] for key in self._keys}
+
+    def items(self):
+        return self.as_dict().items()
+
+    def values(self):
+        return self.as_dict().values()
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __repr__(self):
+        return f"Interpretation({list(self._keys)})"
+
+
+def evaluate_24hr_urine(urine_profile, patient_profile=None, rule_set=None):
+    """
+    Applies the 24-hour urine rules of Box 5 of the manuscript with the
+    thresholds of rule_set (default: the active rule set) for the patient's
+    age and sex.
+    Accepts UrineProfile/PatientContext records or plain dicts and returns
+    the UrineFindings for the panel without producing any text.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        started = perf_counter()
+    urine = UrineProfile.coerce(urine_profile)
+    patient = PatientContext.coerce(patient_profile)
+    rule_set = rule_set or _active_rule_set
+    if rule_set.reference_index is not None:
+        rule_set = rule_set.for_patient(patient.age, patient.gender)
+    (volume_min, ph_acidic, ph_alkaline, calcium_max, oxalate_max, oxalate_primary,
+     citrate_min, uric_acid_max, sodium_max, sulfate_max, ammonium_max, cystine_max,
+     cystinuria) = rule_set.urine_limits
+    codes = 0
+
+    # Volume
+    if urine.volume_L < volume_min:
+        codes |= Finding.URINE_VOLUME_LOW
+
+    # pH
+    if urine.ph < ph_acidic:
+        codes |= Finding.URINE_PH_ACIDIC
+    # Explicitly check for RTA
+    elif "Renal Tubular Acidosis" in patient.medical_conditions:
+        # As per manuscript, pH >= 6.0 with RTA suggests CaP stones
+        codes |= Finding.URINE_PH_ALKALINE_RTA
+    elif urine.ph > ph_alkaline:
+        codes |= Finding.URINE_PH_VERY_ALKALINE
+
+    # Calcium
+    # Graded increase in risk from 150 mg/d as per manuscript
+    if urine.calcium_mg > calcium_max:
+        codes |= Finding.URINE_CALCIUM_HIGH
+
+    # Oxalate
+    if urine.oxalate_mg > oxalate_max:
+        codes |= Finding.URINE_OXALATE_HIGH
+        if urine.oxalate_mg > oxalate_primary:
+            codes |= Finding.URINE_OXALATE_VERY_HIGH
+
+    # Citrate
+    if urine.citrate_mg < citrate_min:
+        codes |= Finding.URINE_CITRATE_LOW
+
+    # Uric Acid
+    # Using ~750-800 mg/d as general upper limit
+    if urine.uric_acid_mg > uric_acid_max:
+        codes |= Finding.URINE_URIC_ACID_HIGH
+
+    # Sodium
+    # If hypercalciuria is present, sodium target is <100 mEq/d
+    if codes & Finding.URINE_CALCIUM_HIGH and urine.sodium_mEq > sodium_max:
+        codes |= Finding.URINE_SODIUM_HIGH
+
+    # Sulfate (indicative of animal protein intake)
+    if urine.sulfate_mmol > sulfate_max:
+        codes |= Finding.URINE_SULFATE_HIGH
+
+    # Ammonium (indicative of acid production)
+    if urine.ammonium_mmol > ammonium_max:
+        codes |= Finding.URINE_AMMONIUM_HIGH
+
+    # Cystine
+    if urine.cystine_mg > cystine_max:  # Normal <30 mg/d
+        codes |= Finding.URINE_CYSTINE_HIGH
+        if urine.cystine_mg > cystinuria:
+            codes |= Finding.URINE_CYSTINE_VERY_HIGH
+
+    if tracer is not None:
+        tracer.record_urine(codes, perf_counter() - started)
+    return UrineFindings(codes, urine, rule_set)
+
+
+def render_findings(findings):
+    """
+    Renders UrineFindings into the human-readable interpretation dictionary
+    stored with management plans. Display paths that may not need every
+    message use findings.interpretation() instead.
+    """
+    codes = findings.codes
+    values = findings.values
+    interpretation = {}
+    for key, mask, render in findings.rule_set.key_messages:
+        if codes & mask:
+            interpretation[key] = render(codes, values)
+
+    # Supersaturation targets; the estimated values come from supersaturation.py
+    interpretation["supersaturation_targets"] = SUPERSATURATION_TARGETS
+    return interpretation
+
+
+def interpret_24hr_urine(urine_profile, patient_profile=None):
+    """
+    Interprets 24-hour urine parameters based on Box 5 of the manuscript.
+    Returns a dictionary of findings and potential implications.
+    """
+    return render_findings(evaluate_24hr_urine(urine_profile, patient_profile))
+
+
+def plan_conditions(findings, patient_profile, serum_labs=None):
+    """
+    Evaluates every condition referenced by PLAN_STEPS for one patient, with
+    the serum thresholds of the rule set that produced the findings.
+    findings may also be a legacy interpretation dict (see UrineFindings.coerce).
+    """
+    findings = UrineFindings.coerce(findings)
+    codes = findings.codes
+    patient = PatientContext.coerce(patient_profile)
+    serum = SerumPanel.coerce(serum_labs)
+    medical_conditions = patient.medical_conditions
+    calcium_high, pth_high, potassium_low, bicarbonate_low = findings.rule_set.serum_limits
+    return {
+        "hypercalciuria": bool(codes & Finding.URINE_CALCIUM_HIGH),
+        "hypocitraturia": bool(codes & Finding.URINE_CITRATE_LOW),
+        "hyperoxaluria": bool(codes & Finding.URINE_OXALATE_HIGH),
+        "hyperuricosuria": bool(codes & Finding.URINE_URIC_ACID_HIGH),
+        "malabsorption": "Malabsorption (IBD, Bariatric Surgery, etc.)" in medical_conditions,
+        "chronic_diarrhea": "chronic_diarrhea" in medical_conditions,
+        "alkalinizing_medication": bool(codes & Finding.URINE_PH_ALKALINE_RTA) and any(
+            med in patient.medications for med in PH_RAISING_MEDICATIONS),
+        "hyperparathyroidism": serum is not None and serum.calcium_mg_dL >= calcium_high
+        and serum.intact_pth_pg_mL >= pth_high,
+        "hypokalemia": serum is not None and serum.potassium_mEq_L < potassium_low,
+        "acidosis": "Renal Tubular Acidosis" in medical_conditions
+        or (serum is not None and serum.bicarbonate_mEq_L < bicarbonate_low),
+    }
+
+
+def generate_management_plan(stone_type, urine_interpretation, patient_profile, serum_labs=None):
+    """
+    Generates a management plan based on stone type, urine findings, patient profile, and serum labs.
+    urine_interpretation is the UrineFindings returned by evaluate_24hr_urine
+    (or the interpretation dict of interpret_24hr_urine, as before).
+    """
+    return plan_from_conditions(
+        stone_type, plan_conditions(urine_interpretation, patient_profile, serum_labs))
+
+
+def plan_from_conditions(stone_type, conditions):
+    """Selects the PLAN_STEPS of a stone type whose conditions hold"""
+    tracer = _tracer
+    if tracer is not None:
+        started = perf_counter()
+    steps = _PLAN_STEPS_BY_TYPE.get(stone_type, _GENERAL_PLAN_STEPS)
+    plan = [text for condition, text in steps if condition is None or conditions[condition]]
+    if tracer is not None:
+        tracer.record_plan(stone_type, conditions, perf_counter() - started)
+    return plan
+
+
+def _evaluate_acute_guidance(symptoms, stone_size):
+    """
+    Acute management decision rules, evaluated once per possible input when
+    the guidance table below is built.
+    """
+    guidance = {
+        'admission_needed': False,
+        'urgency_level': 'routine',
+        'recommendations': []
+    }
+
+    # Check for severe symptoms requiring admission
+    severe_symptoms = symptoms.get('uncontrolled_pain', False) or symptoms.get(
+        'vomiting', False) or symptoms.get('fevers', False) or symptoms.get('hydronephrosis', False)
+
+    if severe_symptoms:
+        guidance['admission_needed'] = True
+        guidance['recommendations'].append("Consider Admission.")
+
+        # Check for urgent symptoms
+        urgent_symptoms = symptoms.get('fevers', False) or symptoms.get(
+            'aki', False) or symptoms.get('anuria', False)
+        if urgent_symptoms:
+            guidance['urgency_level'] = 'urgent'
+            guidance['recommendations'].append(
+                "Urgent urology evaluation is required!")
+        else:
+            guidance['urgency_level'] = 'moderate'
+    else:
+        guidance['recommendations'].append("Can likely manage as outpatient.")
+
+    # Add stone size specific guidance
+    if stone_size == "< 5mm":
+        guidance['recommendations'].append(
+            "Acute Management: >60% chance of passing. Supportive treatment, Hydration, Strain urine.")
+    elif stone_size == "5-10mm":
+        guidance['recommendations'].append(
+            "Acute Management: ~50% chance of passing. Supportive care, Hydration, Medical expulsive therapy (e.g., alpha-blockers for distal stones), Strain urine.")
+    elif stone_size == "> 10mm":
+        guidance['recommendations'].append(
+            "Acute Management: <25% chance of passing. Urology evaluation, Strain urine.")
+    else:
+        guidance['recommendations'].append(
+            "Acute Management: Supportive care, Hydration, Strain urine. Consider imaging for size if not done.")
+
+    return guidance
+
+
+ACUTE_SYMPTOMS = ('uncontrolled_pain', 'vomiting', 'fevers', 'hydronephrosis', 'aki', 'anuria')
+STONE_SIZES = ("< 5mm", "5-10mm", "> 10mm", "Unknown")
+_STONE_SIZE_INDEX = {size: index for index, size in enumerate(STONE_SIZES)}
+
+
+def _build_acute_guidance_table():
+    """
+    Every symptom combination and stone size has a fixed answer, so all 256
+    guidance results are computed at import time as read-only mappings.
+    """
+    table = []
+    for flags in itertools.product((False, True), repeat=len(ACUTE_SYMPTOMS)):
+        symptoms = dict(zip(ACUTE_SYMPTOMS, flags))
+        for stone_size in STONE_SIZES:
+            guidance = _evaluate_acute_guidance(symptoms, stone_size)
+            guidance['recommendations'] = tuple(guidance['recommendations'])
+            table.append(MappingProxyType(guidance))
+    return tuple(table)
+
+
+ACUTE_GUIDANCE_TABLE = _build_acute_guidance_table()
+
+
+def get_acute_management_guidance(symptoms, stone_size):
+    """
+    Provides acute management guidance based on symptoms and stone size.
+    Returns a shared read-only mapping from ACUTE_GUIDANCE_TABLE.
+    """
+    get = symptoms.get
+    # Bit order follows ACUTE_SYMPTOMS, the stone size fills the two low bits.
+    # Sizes outside the known choices get the same advice as "Unknown".
+    index = ((128 if get('uncontrolled_pain') else 0) | (64 if get('vomiting') else 0)
+             | (32 if get('fevers') else 0) | (16 if get('hydronephrosis') else 0)
+             | (8 if get('aki') else 0) | (4 if get('anuria') else 0))
+    return ACUTE_GUIDANCE_TABLE[index | _STONE_SIZE_INDEX.get(stone_size, 3)]
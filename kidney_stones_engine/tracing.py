@@ -0,0 +1,159 @@
+"""
+Optional tracing of the urine and plan rules.
+
+While disabled, the rules only test a module global for None. Once enabled,
+every evaluate_24hr_urine and plan_from_conditions call records its finding
+code or plan conditions and its duration. Calls are aggregated by outcome, so
+recording is a counter increment; per-rule evaluated/fired counts are derived
+when a snapshot is taken.
+
+    from kidney_stones_engine import tracing
+    tracing.enable()
+    ...
+    tracing.snapshot()
+"""
+from collections import Counter, deque
+import threading
+
+from . import rules
+from .rules import Finding, PLAN_STEPS
+
+
+# When each urine rule is evaluated, as (findings that must be set, findings
+# that must not be): mirrors the nesting and elif chains of evaluate_24hr_urine
+URINE_RULE_GUARDS = {
+    Finding.URINE_PH_ALKALINE_RTA: (0, Finding.URINE_PH_ACIDIC),
+    Finding.URINE_PH_VERY_ALKALINE: (0, Finding.URINE_PH_ACIDIC | Finding.URINE_PH_ALKALINE_RTA),
+    Finding.URINE_OXALATE_VERY_HIGH: (Finding.URINE_OXALATE_HIGH, 0),
+    Finding.URINE_SODIUM_HIGH: (Finding.URINE_CALCIUM_HIGH, 0),
+    Finding.URINE_CYSTINE_VERY_HIGH: (Finding.URINE_CYSTINE_HIGH, 0),
+}
+
+URINE_RULES = tuple(
+    (name, bit) for name, bit in vars(Finding).items() if name.isupper())
+
+
+def _plan_step_indices(stone_type):
+    """Indices in PLAN_STEPS of the steps plan_from_conditions walks for a stone type"""
+    if stone_type not in rules._PLAN_STEPS_BY_TYPE:
+        stone_type = None
+    return [index for index, (step_type, _, _) in enumerate(PLAN_STEPS)
+            if step_type is None or step_type == stone_type]
+
+
+class RuleTracer:
+    """
+    Thread-safe per-rule counters. history > 0 also keeps that many of the
+    most recent calls as (kind, outcome, seconds) tuples.
+    """
+
+    def __init__(self, history=0):
+        self.history = history
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._urine = Counter()
+            self._plans = Counter()
+            self._seconds = Counter()
+            self._max_seconds = Counter()
+            self._recent = deque(maxlen=self.history) if self.history else None
+
+    def _timing(self, kind, seconds):
+        self._seconds[kind] += seconds
+        if seconds > self._max_seconds[kind]:
+            self._max_seconds[kind] = seconds
+
+    def record_urine(self, codes, seconds):
+        with self._lock:
+            self._urine[codes] += 1
+            self._timing('urine', seconds)
+            if self._recent is not None:
+                self._recent.append(('urine', Finding.names(codes), seconds))
+
+    def record_plan(self, stone_type, conditions, seconds):
+        with self._lock:
+            self._plans[stone_type, tuple(conditions.items())] += 1
+            self._timing('plan', seconds)
+            if self._recent is not None:
+                fired = [name for name, value in conditions.items() if value]
+                self._recent.append(('plan', [stone_type] + fired, seconds))
+
+    def _urine_snapshot(self):
+        evaluated = Counter()
+        fired = Counter()
+        for codes, count in self._urine.items():
+            for name, bit in URINE_RULES:
+                required, excluded = URINE_RULE_GUARDS.get(bit, (0, 0))
+                if codes & required == required and not codes & excluded:
+                    evaluated[name] += count
+                    if codes & bit:
+                        fired[name] += count
+        return {name: {'evaluated': evaluated[name], 'fired': fired[name]}
+                for name, _ in URINE_RULES}
+
+    def _plan_snapshot(self):
+        stone_types = Counter()
+        conditions = {}
+        steps = [{'stone_type': stone_type, 'condition': condition, 'text': text,
+                  'evaluated': 0, 'fired': 0}
+                 for stone_type, condition, text in PLAN_STEPS]
+        for (stone_type, condition_items), count in self._plans.items():
+            stone_types[stone_type] += count
+            values = dict(condition_items)
+            for name, value in condition_items:
+                counters = conditions.setdefault(name, {'evaluated': 0, 'fired': 0})
+                counters['evaluated'] += count
+                counters['fired'] += count if value else 0
+            for index in _plan_step_indices(stone_type):
+                step = steps[index]
+                step['evaluated'] += count
+                if step['condition'] is None or values[step['condition']]:
+                    step['fired'] += count
+        return dict(stone_types), conditions, steps
+
+    def snapshot(self):
+        """JSON-serializable counters: calls, time and per-rule evaluated/fired counts"""
+        with self._lock:
+            stone_types, conditions, steps = self._plan_snapshot()
+            snapshot = {
+                'urine': {
+                    'calls': sum(self._urine.values()),
+                    'seconds': self._seconds['urine'],
+                    'max_seconds': self._max_seconds['urine'],
+                    'rules': self._urine_snapshot(),
+                },
+                'plan': {
+                    'calls': sum(self._plans.values()),
+                    'seconds': self._seconds['plan'],
+                    'max_seconds': self._max_seconds['plan'],
+                    'stone_types': stone_types,
+                    'conditions': conditions,
+                    'steps': steps,
+                },
+            }
+            if self._recent is not None:
+                snapshot['recent'] = list(self._recent)
+            return snapshot
+
+
+def enable(history=0):
+    """Starts tracing with a fresh RuleTracer (replacing any active one) and returns it"""
+    tracer = RuleTracer(history)
+    rules._tracer = tracer
+    return tracer
+
+
+def disable():
+    rules._tracer = None
+
+
+def get_tracer():
+    """The active RuleTracer, or None while tracing is disabled"""
+    return rules._tracer
+
+
+def snapshot():
+    tracer = rules._tracer
+    return tracer.snapshot() if tracer is not None else None